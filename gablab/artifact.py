@@ -0,0 +1,343 @@
+"""
+Artifact detection
+------------------
+
+:class:`nipype.algorithms.rapidart.ArtifactDetect` loads every realigned run
+into memory to compute the global intensity of each volume and then loops
+over volumes to compute intensity z-scores and motion norms.
+:class:`ArtifactDetect` in this module implements the same outlier logic
+vectorized over volumes, and either takes the global intensity computed
+upstream (e.g. the ``global_values`` of
+:class:`~mindflows.gablab.intensitynorm.TemporalStats`) or computes it with a
+single block-wise reduction over the memory-mapped runs.
+"""
+
+import os                                    # system functions
+
+import numpy as np
+from scipy import signal
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits, isdefined)
+from nipype.utils.filemanip import split_filename, save_json
+
+from mindflows.gablab.imageio import load_image, iter_slabs
+
+
+def global_signal(fname, mask_type='file', mask_file=None, mask_threshold=0.,
+                  global_threshold=8., intersect_mask=True, block_size=32768):
+    """Return the global intensity of each volume of a 4D run
+
+    ``file`` averages the voxels inside `mask_file`, ``thresh`` the voxels
+    above `mask_threshold` and ``spm_global`` the voxels above the mean of
+    the volume divided by `global_threshold` (which takes a second pass).
+    With `intersect_mask`, ``spm_global`` averages the voxels above that
+    threshold in every volume, unless they are fewer than a tenth of the
+    volume, as rapidart does. ``all`` averages all voxels. The run is
+    streamed in z-slabs of about `block_size` voxels.
+    """
+    _, data = load_image(fname)
+    ntimepoints = data.shape[3]
+    if mask_type == 'file':
+        _, mask = load_image(mask_file)
+        mask = np.asarray(mask) > 0.5
+    if mask_type == 'spm_global':
+        total = np.zeros(ntimepoints)
+        for slab in iter_slabs(data.shape, block_size):
+            block = np.asarray(data[:, :, slab], dtype=np.float64)
+            total += block.reshape(-1, ntimepoints).sum(axis=0)
+        thresh = total / np.prod(data.shape[:3]) / global_threshold
+    total = np.zeros(ntimepoints)
+    count = np.zeros(ntimepoints)
+    common_total = np.zeros(ntimepoints)
+    common_count = 0
+    for slab in iter_slabs(data.shape, block_size):
+        block = np.asarray(data[:, :, slab], dtype=np.float64)
+        if mask_type == 'file':
+            block = block[mask[:, :, slab]]
+            total += block.sum(axis=0)
+            count += block.shape[0]
+            continue
+        block = block.reshape(-1, ntimepoints)
+        if mask_type == 'all':
+            inmask = np.ones(block.shape, dtype=bool)
+        elif mask_type == 'thresh':
+            inmask = block > mask_threshold
+        else:
+            inmask = block > thresh
+            common = np.all(inmask, axis=1)
+            common_total += block[common].sum(axis=0)
+            common_count += np.sum(common)
+        total += np.sum(block * inmask, axis=0)
+        count += np.sum(inmask, axis=0)
+    if (mask_type == 'spm_global' and intersect_mask and
+        common_count >= np.prod(data.shape[:3]) / 10.):
+        return common_total / common_count
+    return total / np.maximum(count, 1)
+
+
+def normalize_params(params, source):
+    """Reorder motion parameters to SPM order (3 translations in mm, 3
+    rotations in radians, then scalings and shears if present)
+    """
+    params = np.array(np.atleast_2d(params), dtype=np.float64)
+    if source == 'FSL':
+        params = params[:, [3, 4, 5, 0, 1, 2]]
+    elif source in ('AFNI', 'FSFAST'):
+        params = params[:, np.array([4, 5, 3, 1, 2, 0]) +
+                        (params.shape[1] > 6)]
+        params[:, 3:] = params[:, 3:] * np.pi / 180.
+    return params
+
+
+def _rotations(angles, axes):
+    """Return rotation matrices about one axis for an array of angles
+    """
+    mats = np.tile(np.eye(4), (len(angles), 1, 1))
+    i, j = axes
+    mats[:, i, i] = np.cos(angles)
+    mats[:, i, j] = np.sin(angles)
+    mats[:, j, i] = -np.sin(angles)
+    mats[:, j, j] = np.cos(angles)
+    return mats
+
+
+def motion_affines(params, source):
+    """Return the affine matrix of every row of motion parameters
+
+    Uses the same conventions as rapidart (``T.Rx.Ry.Rz.S.Sh``, with the
+    rotations in ``Ry.Rx.Rz`` order for AFNI and FSFAST).
+    """
+    params = normalize_params(params, source)
+    ntimepoints = params.shape[0]
+    defaults = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0], dtype=float)
+    full = np.tile(defaults, (ntimepoints, 1))
+    full[:, :params.shape[1]] = params[:, :12]
+    trans = np.tile(np.eye(4), (ntimepoints, 1, 1))
+    trans[:, :3, 3] = full[:, :3]
+    rx = _rotations(full[:, 3], (1, 2))
+    ry = _rotations(full[:, 4], (0, 2))
+    rz = _rotations(full[:, 5], (0, 1))
+    scale = np.tile(np.eye(4), (ntimepoints, 1, 1))
+    scale[:, [0, 1, 2], [0, 1, 2]] = full[:, 6:9]
+    shear = np.tile(np.eye(4), (ntimepoints, 1, 1))
+    shear[:, [0, 0, 1], [1, 2, 2]] = full[:, 9:12]
+    if source in ('AFNI', 'FSFAST'):
+        rot = np.matmul(ry, np.matmul(rx, rz))
+    else:
+        rot = np.matmul(rx, np.matmul(ry, rz))
+    return np.matmul(trans, np.matmul(rot, np.matmul(scale, shear)))
+
+
+def motion_norm(params, source, use_differences=True):
+    """Return the composite motion of every volume in mm
+
+    Displacements of the centers of the faces of a box around the brain
+    (``[70, 70, 75]`` and ``[-70, -110, -45]`` mm). With `use_differences`,
+    the largest volume-to-volume displacement of these points; otherwise the
+    root mean square deviation of their positions from the mean position.
+    """
+    points = np.vstack((np.hstack((np.diag([70, 70, 75]),
+                                   np.diag([-70, -110, -45]))),
+                        np.ones((1, 6))))
+    newpos = np.matmul(motion_affines(params, source), points)[:, :3, :]
+    if use_differences:
+        delta = np.concatenate((np.zeros((1,) + newpos.shape[1:]),
+                                np.diff(newpos, axis=0)))
+        return np.sqrt(np.sum(delta ** 2, axis=1)).max(axis=1)
+    newpos = newpos.reshape(newpos.shape[0], -1)
+    newpos = newpos - newpos.mean(axis=0)
+    return np.sqrt(np.mean(newpos ** 2, axis=1))
+
+
+def intensity_zscores(values, use_differences=False):
+    """Return z-scores of the detrended (and differenced) global intensity
+    """
+    gz = signal.detrend(np.asarray(values, dtype=np.float64))
+    if use_differences:
+        gz = np.concatenate(([0.], np.diff(gz)))
+    return (gz - gz.mean()) / gz.std()
+
+
+def detect_outliers(values, params, source, use_differences=(True, False),
+                    use_norm=True, norm_threshold=1.,
+                    rotation_threshold=None, translation_threshold=None,
+                    zintensity_threshold=3.):
+    """Return the indices of outlier volumes and the statistics used
+
+    Volumes are outliers if the z-score of their global intensity exceeds
+    `zintensity_threshold` or if their motion exceeds `norm_threshold`
+    (when `use_norm` is True) or the rotation or translation thresholds.
+    """
+    gz = intensity_zscores(values, use_differences[1])
+    iidx = np.nonzero(np.abs(gz) > zintensity_threshold)[0]
+    params = np.atleast_2d(params)
+    normval = None
+    if use_norm:
+        normval = motion_norm(params, source, use_differences[0])
+        midx = np.nonzero((normval > norm_threshold) | (normval < 0))[0]
+    else:
+        mc = normalize_params(params, source)
+        if use_differences[0]:
+            mc = np.concatenate((np.zeros((1, mc.shape[1])),
+                                 np.diff(mc, axis=0)))
+        midx = np.nonzero(np.any(np.abs(mc[:, :3]) > translation_threshold,
+                                 axis=1) |
+                          np.any(np.abs(mc[:, 3:6]) > rotation_threshold,
+                                 axis=1))[0]
+    outliers = np.union1d(iidx, midx)
+    stats = [{'common_outliers': len(np.intersect1d(iidx, midx)),
+              'intensity_outliers': len(np.setdiff1d(iidx, midx)),
+              'motion_outliers': len(np.setdiff1d(midx, iidx))},
+             {'motion': [{'using differences': bool(use_differences[0])},
+                         {'mean': np.mean(params, axis=0).tolist(),
+                          'min': np.min(params, axis=0).tolist(),
+                          'max': np.max(params, axis=0).tolist(),
+                          'std': np.std(params, axis=0).tolist()}]},
+             {'intensity': [{'using differences': bool(use_differences[1])},
+                            {'mean': float(np.mean(gz)),
+                             'min': float(np.min(gz)),
+                             'max': float(np.max(gz)),
+                             'std': float(np.std(gz))}]}]
+    if normval is not None:
+        stats.append({'motion_norm': {'mean': float(np.mean(normval)),
+                                      'min': float(np.min(normval)),
+                                      'max': float(np.max(normval)),
+                                      'std': float(np.std(normval))}})
+    return outliers, normval, stats
+
+
+class ArtifactDetectInputSpec(BaseInterfaceInputSpec):
+    realigned_files = InputMultiPath(File(exists=True),
+                                     desc='realigned runs (not needed if '
+                                     'global_values is given)')
+    global_values = traits.List(traits.List(traits.Float),
+                                desc='global intensity of each volume of '
+                                'each run, computed upstream')
+    realignment_parameters = InputMultiPath(File(exists=True),
+                                            mandatory=True,
+                                            desc='motion parameters of each '
+                                            'run')
+    parameter_source = traits.Enum('SPM', 'FSL', 'AFNI', 'FSFAST',
+                                   mandatory=True,
+                                   desc='package that estimated the motion')
+    use_differences = traits.List(traits.Bool, [True, False], minlen=2,
+                                  maxlen=2, usedefault=True,
+                                  desc='use volume-to-volume differences of '
+                                  'the motion and the intensity')
+    use_norm = traits.Bool(True, usedefault=True,
+                           desc='use the composite motion norm')
+    norm_threshold = traits.Float(1., usedefault=True,
+                                  desc='motion norm (mm) above which a '
+                                  'volume is an outlier')
+    rotation_threshold = traits.Float(0.05, usedefault=True,
+                                      desc='rotation (radians) above which a '
+                                      'volume is an outlier (no norm)')
+    translation_threshold = traits.Float(1., usedefault=True,
+                                         desc='translation (mm) above which '
+                                         'a volume is an outlier (no norm)')
+    zintensity_threshold = traits.Float(3., usedefault=True,
+                                        desc='intensity z-score above which '
+                                        'a volume is an outlier')
+    mask_type = traits.Enum('spm_global', 'file', 'thresh', 'all',
+                            mandatory=True,
+                            desc='voxels averaged into the global intensity')
+    mask_file = File(exists=True, desc='mask for mask_type file')
+    mask_threshold = traits.Float(0., usedefault=True,
+                                  desc='threshold for mask_type thresh')
+    global_threshold = traits.Float(8., usedefault=True,
+                                    desc='divisor of the mean for mask_type '
+                                    'spm_global')
+    intersect_mask = traits.Bool(True, usedefault=True,
+                                 desc='for mask_type spm_global, average the '
+                                 'voxels above threshold in every volume')
+    block_size = traits.Int(32768, usedefault=True,
+                            desc='number of voxels read at a time')
+
+
+class ArtifactDetectOutputSpec(TraitedSpec):
+    outlier_files = OutputMultiPath(File(exists=True),
+                                    desc='indices of the outlier volumes')
+    intensity_files = OutputMultiPath(File(exists=True),
+                                      desc='global intensity of each volume')
+    statistic_files = OutputMultiPath(File(exists=True),
+                                      desc='outlier statistics')
+    norm_files = OutputMultiPath(File(exists=True),
+                                 desc='motion norm of each volume')
+
+
+class ArtifactDetect(BaseInterface):
+    """Vectorized replacement for rapidart's ArtifactDetect
+
+    Output files are named and formatted as rapidart's, so they can be
+    consumed by ``SpecifyModel`` and ``StimulusCorrelation``. If
+    ``global_values`` is given the runs are not read at all.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.artifact import ArtifactDetect
+    >>> art = ArtifactDetect(parameter_source='FSL', mask_type='file')
+    >>> art.inputs.realignment_parameters = ['f3_mcf.par', 'f5_mcf.par']
+    >>> art.inputs.global_values = [[734.2, 735.0], [712.9, 713.5]]
+    >>> art.run() # doctest: +SKIP
+    """
+
+    input_spec = ArtifactDetectInputSpec
+    output_spec = ArtifactDetectOutputSpec
+
+    def _run_interface(self, runtime):
+        paramfiles = self.inputs.realignment_parameters
+        if isdefined(self.inputs.global_values):
+            names = paramfiles
+            values = self.inputs.global_values
+        elif isdefined(self.inputs.realigned_files):
+            names = self.inputs.realigned_files
+            mask_file = None
+            if isdefined(self.inputs.mask_file):
+                mask_file = self.inputs.mask_file
+            values = [global_signal(fname, self.inputs.mask_type,
+                                    mask_file, self.inputs.mask_threshold,
+                                    self.inputs.global_threshold,
+                                    self.inputs.intersect_mask,
+                                    self.inputs.block_size)
+                      for fname in names]
+        else:
+            raise ValueError('Either realigned_files or global_values '
+                             'must be provided')
+        self._results = dict(outlier_files=[], intensity_files=[],
+                             statistic_files=[], norm_files=[])
+        for name, g, paramfile in zip(names, values, paramfiles):
+            _, base, _ = split_filename(name)
+            params = np.loadtxt(paramfile)
+            outliers, normval, stats = detect_outliers(
+                g, params, self.inputs.parameter_source,
+                self.inputs.use_differences, self.inputs.use_norm,
+                self.inputs.norm_threshold, self.inputs.rotation_threshold,
+                self.inputs.translation_threshold,
+                self.inputs.zintensity_threshold)
+            stats.insert(0, {'motion_file': paramfile,
+                             'functional_file': name})
+            outfile = os.path.join(runtime.cwd, 'art.%s_outliers.txt' % base)
+            np.savetxt(outfile, outliers, fmt='%d')
+            self._results['outlier_files'].append(outfile)
+            outfile = os.path.join(runtime.cwd,
+                                   'global_intensity.%s.txt' % base)
+            np.savetxt(outfile, np.asarray(g), fmt='%.2f')
+            self._results['intensity_files'].append(outfile)
+            outfile = os.path.join(runtime.cwd, 'stats.%s.txt' % base)
+            save_json(outfile, stats)
+            self._results['statistic_files'].append(outfile)
+            if normval is not None:
+                outfile = os.path.join(runtime.cwd, 'norm.%s.txt' % base)
+                np.savetxt(outfile, normval, fmt='%.4f')
+                self._results['norm_files'].append(outfile)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for key in outputs:
+            if self._results[key]:
+                outputs[key] = self._results[key]
+        return outputs
@@ -0,0 +1,317 @@
+"""
+Block GLM estimation
+--------------------
+
+First-level models were estimated by ``FILMGLS``, one process per run, and
+the contrasts computed by ``ContrastMgr``, another process reading back the
+parameter estimates, residual variances and degrees of freedom from the
+results directory.
+
+:class:`BlockGLM` estimates a run and all its t contrasts in one in-process
+pass. As FILM does, the autocorrelation of the residuals of an ordinary
+least-squares fit is estimated for every voxel, tapered with a Tukey window,
+optionally smoothed spatially, and used to prewhiten the data and the design
+in the frequency domain. Voxels are then processed in blocks: the whitened
+designs of a block are stacked and solved with batched linear algebra, and
+the copes, varcopes, t and z statistics of every contrast are computed from
+the same solution. Blocks are solved by a pool of threads; numpy releases
+the GIL in the FFTs and matrix products.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os                                    # system functions
+
+import numpy as np
+from scipy import ndimage, stats
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, Directory,
+                                    OutputMultiPath, traits, isdefined)
+
+from mindflows.gablab.imageio import load_image, save_image, output_ext
+
+
+def read_vest(fname):
+    """Read an FSL VEST matrix (design.mat, design.con)
+
+    Returns the matrix and the names given by ``/ContrastName`` lines (empty
+    for designs).
+    """
+    names = {}
+    rows = []
+    inmatrix = False
+    for line in open(fname):
+        line = line.strip()
+        if not line:
+            continue
+        if inmatrix:
+            rows.append([float(val) for val in line.split()])
+        elif line.startswith('/ContrastName'):
+            parts = line.split(None, 1)
+            names[int(parts[0][len('/ContrastName'):])] = \
+                len(parts) > 1 and parts[1] or ''
+        elif line.startswith('/Matrix'):
+            inmatrix = True
+    return np.atleast_2d(np.array(rows)), [names[key]
+                                           for key in sorted(names)]
+
+
+def autocorrelation(residuals, maxlag):
+    """Return the autocorrelation of each column of `residuals` at lags
+    ``0 .. maxlag - 1``
+    """
+    ntimepoints = residuals.shape[0]
+    var = np.sum(residuals ** 2, axis=0)
+    var[var == 0] = 1
+    ac = np.zeros((maxlag, residuals.shape[1]))
+    for lag in range(maxlag):
+        ac[lag] = np.sum(residuals[:ntimepoints - lag] * residuals[lag:],
+                         axis=0) / var
+    return ac
+
+
+def tukey_taper(ac):
+    """Taper autocorrelations (lags along the first axis) with a Tukey
+    window of the same length
+    """
+    lags = np.arange(ac.shape[0])
+    window = 0.5 * (1 + np.cos(np.pi * lags / float(ac.shape[0])))
+    return ac * window[:, None]
+
+
+def whitening_filters(ac, nfft):
+    """Return the frequency-domain prewhitening filter of each column of
+    autocorrelations `ac`
+    """
+    maxlag = ac.shape[0]
+    full = np.zeros((nfft, ac.shape[1]))
+    full[0] = 1
+    full[1:maxlag] = ac[1:]
+    full[nfft - maxlag + 1:] = ac[:0:-1]
+    spectrum = np.fft.rfft(full, axis=0).real
+    floor = 1e-6 * spectrum.max(axis=0)
+    return 1. / np.sqrt(np.maximum(spectrum, floor))
+
+
+def t_to_z(tstat, dof):
+    """Convert t statistics to z statistics of the same tail probability
+    """
+    prob = stats.t.sf(np.abs(tstat), dof)
+    zstat = stats.norm.isf(np.maximum(prob, 1e-300))
+    return np.sign(tstat) * zstat
+
+
+def fit_block(Y, X, C, dof, filters=None, nfft=None):
+    """Fit a GLM to the columns of `Y` and compute the contrasts `C`
+
+    With `filters`, the data and design of each voxel are prewhitened by
+    its filter first. Returns the parameter estimates, the residual
+    variances and the copes and varcopes of the contrasts, with voxels along
+    the last axis.
+    """
+    ntimepoints = X.shape[0]
+    if filters is None:
+        pinv_xtx = np.linalg.pinv(np.dot(X.T, X))
+        beta = np.dot(np.linalg.pinv(X), Y)
+        resid = Y - np.dot(X, beta)
+        sigmasq = np.sum(resid ** 2, axis=0) / dof
+        conv = np.einsum('cp,pq,cq->c', C, pinv_xtx, C)
+        varcope = conv[:, None] * sigmasq[None, :]
+    else:
+        Yw = np.fft.irfft(np.fft.rfft(Y, nfft, axis=0) * filters, nfft,
+                          axis=0)[:ntimepoints]
+        Xf = np.fft.rfft(X, nfft, axis=0)
+        Xw = np.fft.irfft(Xf[:, None, :] * filters[:, :, None], nfft,
+                          axis=0)[:ntimepoints]
+        pinv_xtx = np.linalg.pinv(np.einsum('tvp,tvq->vpq', Xw, Xw))
+        beta = np.einsum('vpq,tvq,tv->pv', pinv_xtx, Xw, Yw)
+        resid = Yw - np.einsum('tvp,pv->tv', Xw, beta)
+        sigmasq = np.sum(resid ** 2, axis=0) / dof
+        varcope = np.einsum('cp,vpq,cq->cv', C, pinv_xtx, C) * sigmasq
+    cope = np.dot(C, beta)
+    return beta, sigmasq, cope, varcope
+
+
+def estimate_glm(in_file, design_file, tcon_file, results_dir,
+                 threshold=1000., autocorr=True, tukey_size=None,
+                 autocorr_fwhm=5., num_threads=1, block_size=1024):
+    """Estimate a first-level GLM and its t contrasts
+
+    Writes FILM's and ContrastMgr's outputs (``pe<n>``, ``sigmasquareds``,
+    ``threshac1``, ``dof``, ``cope<n>``, ``varcope<n>``, ``tstat<n>``,
+    ``zstat<n>``) to `results_dir`. Voxels whose mean is below `threshold`
+    are not estimated; the others are demeaned. `tukey_size` defaults to
+    the square root of the number of timepoints; autocorrelations are
+    smoothed with a Gaussian of `autocorr_fwhm` mm (0 to skip). Returns a
+    dictionary of the filenames.
+    """
+    img, data = load_image(in_file)
+    X = read_vest(design_file)[0]
+    C = read_vest(tcon_file)[0]
+    ntimepoints = data.shape[3]
+    if X.shape[0] != ntimepoints:
+        raise ValueError('Design has %d timepoints, %s has %d' %
+                         (X.shape[0], in_file, ntimepoints))
+    mask = data.mean(axis=3, dtype=np.float64) > threshold
+    # FEAT designs have no intercept: as FILM, remove the mean of every voxel
+    Y = np.asarray(data[mask], dtype=np.float32).T
+    Y -= Y.mean(axis=0)
+    nvox = Y.shape[1]
+    dof = ntimepoints - np.linalg.matrix_rank(X)
+    blocks = [slice(start, min(start + block_size, nvox))
+              for start in range(0, nvox, block_size)]
+    pool = ThreadPoolExecutor(max(1, num_threads))
+    filters = None
+    nfft = None
+    ac = None
+    try:
+        if autocorr:
+            if tukey_size is None:
+                tukey_size = int(np.round(np.sqrt(ntimepoints)))
+            tukey_size = max(2, min(tukey_size, ntimepoints - 1))
+            pinv_x = np.linalg.pinv(X)
+            ac = np.zeros((tukey_size, nvox))
+
+            def estimate_ac(block):
+                Yb = np.asarray(Y[:, block], dtype=np.float64)
+                resid = Yb - np.dot(X, np.dot(pinv_x, Yb))
+                ac[:, block] = autocorrelation(resid, tukey_size)
+            list(pool.map(estimate_ac, blocks))
+            if autocorr_fwhm > 0:
+                sigma = autocorr_fwhm / (2 * np.sqrt(2 * np.log(2))) / \
+                    np.array(img.header.get_zooms()[:3])
+                weight = ndimage.gaussian_filter(mask.astype(np.float64),
+                                                 sigma)[mask]
+                vol = np.zeros(mask.shape)
+                for lag in range(1, tukey_size):
+                    vol[mask] = ac[lag]
+                    ac[lag] = ndimage.gaussian_filter(vol, sigma)[mask] / \
+                        weight
+            ac = tukey_taper(ac)
+            nfft = int(2 ** np.ceil(np.log2(2 * ntimepoints)))
+        beta = np.zeros((X.shape[1], nvox))
+        sigmasq = np.zeros(nvox)
+        cope = np.zeros((C.shape[0], nvox))
+        varcope = np.zeros((C.shape[0], nvox))
+
+        def estimate_block(block):
+            Yb = np.asarray(Y[:, block], dtype=np.float64)
+            filt = None
+            if ac is not None:
+                filt = whitening_filters(ac[:, block], nfft)
+            (beta[:, block], sigmasq[block], cope[:, block],
+             varcope[:, block]) = fit_block(Yb, X, C, dof, filt, nfft)
+        list(pool.map(estimate_block, blocks))
+    finally:
+        pool.shutdown()
+    del Y
+    tstat = cope / np.sqrt(np.where(varcope > 0, varcope, np.inf))
+    zstat = t_to_z(tstat, dof)
+
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    ext = output_ext()
+
+    def save(values, name):
+        vol = np.zeros(mask.shape + values.shape[:-1], dtype=np.float32)
+        vol[mask] = values.T
+        return save_image(vol, img, os.path.join(results_dir, name + ext),
+                          np.float32)
+    outputs = dict(param_estimates=[save(beta[idx], 'pe%d' % (idx + 1))
+                                    for idx in range(X.shape[1])],
+                   sigmasquareds=save(sigmasq, 'sigmasquareds'),
+                   copes=[], varcopes=[], tstats=[], zstats=[])
+    if ac is not None:
+        outputs['thresholdac'] = save(ac, 'threshac1')
+    for idx in range(C.shape[0]):
+        for key, values, name in [('copes', cope, 'cope'),
+                                  ('varcopes', varcope, 'varcope'),
+                                  ('tstats', tstat, 'tstat'),
+                                  ('zstats', zstat, 'zstat')]:
+            outputs[key].append(save(values[idx], '%s%d' % (name, idx + 1)))
+    dof_file = os.path.join(results_dir, 'dof')
+    fp = open(dof_file, 'wt')
+    fp.write('%d\n' % dof)
+    fp.close()
+    outputs['dof_file'] = dof_file
+    outputs['results_dir'] = results_dir
+    return outputs
+
+
+class BlockGLMInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc='functional run')
+    design_file = File(exists=True, mandatory=True,
+                       desc='design matrix (design.mat from FEATModel)')
+    tcon_file = File(exists=True, mandatory=True,
+                     desc='t contrasts (design.con from FEATModel)')
+    threshold = traits.Float(1000., usedefault=True,
+                             desc='lowest mean intensity of estimated voxels')
+    autocorr_noestimate = traits.Bool(False, usedefault=True,
+                                      desc='do not prewhiten')
+    tukey_window = traits.Int(desc='Tukey window size (default: square root '
+                              'of the number of timepoints)')
+    autocorr_fwhm = traits.Float(5., usedefault=True,
+                                 desc='FWHM (mm) of the spatial smoothing of '
+                                 'the autocorrelations (0 to skip)')
+    results_dir = Directory('results', usedefault=True,
+                            desc='directory to store the results in')
+    num_threads = traits.Int(4, usedefault=True, nohash=True,
+                             desc='number of threads solving voxel blocks')
+    block_size = traits.Int(1024, usedefault=True,
+                            desc='number of voxels solved at a time')
+
+
+class BlockGLMOutputSpec(TraitedSpec):
+    results_dir = Directory(exists=True, desc='directory with the results')
+    param_estimates = OutputMultiPath(File(exists=True),
+                                      desc='parameter estimates')
+    sigmasquareds = File(exists=True, desc='residual variance')
+    dof_file = File(exists=True, desc='degrees of freedom')
+    thresholdac = File(desc='tapered autocorrelation estimates')
+    copes = OutputMultiPath(File(exists=True), desc='contrast estimates')
+    varcopes = OutputMultiPath(File(exists=True),
+                               desc='variance of the contrast estimates')
+    tstats = OutputMultiPath(File(exists=True), desc='t statistics')
+    zstats = OutputMultiPath(File(exists=True), desc='z statistics')
+
+
+class BlockGLM(BaseInterface):
+    """Estimate a prewhitened GLM and its t contrasts in one pass
+
+    Replaces ``fsl.FILMGLS`` followed by ``fsl.ContrastMgr``; outputs are
+    named as theirs.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.blockglm import BlockGLM
+    >>> glm = BlockGLM(in_file='functional.nii', design_file='design.mat')
+    >>> glm.inputs.tcon_file = 'design.con'
+    >>> glm.run() # doctest: +SKIP
+    """
+
+    input_spec = BlockGLMInputSpec
+    output_spec = BlockGLMOutputSpec
+
+    def _run_interface(self, runtime):
+        tukey_size = None
+        if isdefined(self.inputs.tukey_window):
+            tukey_size = self.inputs.tukey_window
+        self._results = estimate_glm(
+            self.inputs.in_file, self.inputs.design_file,
+            self.inputs.tcon_file,
+            os.path.join(runtime.cwd, self.inputs.results_dir),
+            threshold=self.inputs.threshold,
+            autocorr=not self.inputs.autocorr_noestimate,
+            tukey_size=tukey_size, autocorr_fwhm=self.inputs.autocorr_fwhm,
+            num_threads=self.inputs.num_threads,
+            block_size=self.inputs.block_size)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for key in outputs:
+            if key in self._results:
+                outputs[key] = self._results[key]
+        return outputs
@@ -0,0 +1,183 @@
+"""
+Lazy branch selection
+---------------------
+
+Workflows often compute two alternatives and pick one of them afterwards
+with a :class:`nipype.interfaces.utility.Select` node, e.g. smoothed or
+unsmoothed data depending on the fwhm. Since the workflow graph is static,
+every node of the unselected alternative still runs.
+
+:func:`add_branch_select` creates the usual ``Merge -> Select`` pair and
+records which node provides the value the choice depends on.
+:func:`resolve_branches` evaluates the recorded choices whose value is
+already known, connects the selected alternative directly to the consumers
+of the ``Select`` node and removes every node that only fed the unselected
+alternatives, so that they are never executed. Choices that depend on
+values only known at runtime are left to the ``Select`` node. A guard node
+(:func:`check_branch`) takes the place of the ``Select`` node and fails the
+run if the value is changed or connected afterwards so that it selects
+another alternative.
+
+Example
+-------
+
+>>> preproc = create_featpreproc() # doctest: +SKIP
+>>> preproc.inputs.inputspec.fwhm = 0 # doctest: +SKIP
+>>> resolve_branches(preproc) # doctest: +SKIP
+>>> preproc.run() # doctest: +SKIP
+"""
+
+import nipype.interfaces.utility as util     # utility
+import nipype.pipeline.engine as pe          # pypeline engine
+
+from nipype.interfaces.base import isdefined
+from nipype.utils.functions import getsource
+
+
+def add_branch_select(workflow, branches, choice, choose, name='select',
+                      concatname='concat'):
+    """Select the output of one of several branches of a workflow
+
+    Parameters
+    ----------
+
+    workflow : workflow the branches belong to
+    branches : list of (node, output) pairs, one per alternative
+    choice : (node, field) pair providing the value the choice depends on
+    choose : function mapping that value to the index of the selected
+             branch (an int or a list with a single int)
+    name : name of the select node
+    concatname : name of the node merging the branch outputs
+
+    Returns the select node, whose ``out`` output is the output of the
+    selected branch.
+    """
+    concatnode = pe.Node(interface=util.Merge(len(branches)),
+                         name=concatname)
+    for idx, (node, field) in enumerate(branches):
+        workflow.connect(node, (field, lambda x: [x]),
+                         concatnode, 'in%d' % (idx + 1))
+    selectnode = pe.Node(interface=util.Select(), name=name)
+    workflow.connect(concatnode, 'out', selectnode, 'inlist')
+    workflow.connect(choice[0], (choice[1], choose), selectnode, 'index')
+    if not hasattr(workflow, '_lazy_branches'):
+        workflow._lazy_branches = []
+    workflow._lazy_branches.append(dict(select=name,
+                                        concat=concatname,
+                                        branches=[(node.name, field)
+                                                  for node, field in branches],
+                                        choice=(choice[0].name, choice[1]),
+                                        choose=choose))
+    return selectnode
+
+
+def check_branch(value, choose_source, index, choice):
+    """Return `value` if it selects the branch a workflow was resolved for
+
+    Runs in the guard node left by :func:`resolve_branches`; raises a
+    ValueError if the value was set or connected after the unselected
+    branches were removed and now selects another one.
+    """
+    from nipype.utils.functions import create_function_from_source
+    selected = create_function_from_source(choose_source)(value)
+    if isinstance(selected, (list, tuple)):
+        selected = selected[0]
+    if selected != index:
+        raise ValueError('%s = %r selects branch %d, but the workflow was '
+                         'resolved for branch %d; set it before calling '
+                         'resolve_branches' % (choice, value, selected,
+                                               index))
+    return value
+
+
+def _is_connected(workflow, node, field):
+    """Return True if an input of a node is connected within the workflow
+    """
+    for _, _, data in workflow._graph.in_edges(node, data=True):
+        if field in [dest for _, dest in data['connect']]:
+            return True
+    return False
+
+
+def _resolve(workflow, branch, keep):
+    """Resolve a single recorded choice; returns True if it was resolved
+    """
+    if set([branch['select'], branch['concat']]) & keep:
+        return False
+    choicenode = workflow.get_node(branch['choice'][0])
+    value = getattr(choicenode.inputs, branch['choice'][1])
+    if not isdefined(value) or _is_connected(workflow, choicenode,
+                                             branch['choice'][1]):
+        return False
+    index = branch['choose'](value)
+    if isinstance(index, (list, tuple)):
+        index = index[0]
+    selected, selectedfield = branch['branches'][index]
+    selected = workflow.get_node(selected)
+    selectnode = workflow.get_node(branch['select'])
+    consumers = [(dest, list(data['connect'])) for _, dest, data in
+                 workflow._graph.out_edges(selectnode, data=True)]
+    workflow.remove_nodes([selectnode, workflow.get_node(branch['concat'])])
+    for dest, connects in consumers:
+        for src, destfield in connects:
+            if isinstance(src, tuple):
+                src = (selectedfield,) + tuple(src[1:])
+            else:
+                src = selectedfield
+            workflow.connect(selected, src, dest, destfield)
+    """
+    Remove the nodes whose outputs are only used by unselected branches
+    """
+    removed = set()
+    candidates = [workflow.get_node(nodename) for idx, (nodename, _) in
+                  enumerate(branch['branches']) if idx != index]
+    while candidates:
+        node = candidates.pop()
+        if node in removed or node is selected or node.name in keep:
+            continue
+        if [succ for succ in workflow._graph.successors(node)
+            if succ not in removed]:
+            continue
+        removed.add(node)
+        candidates.extend(workflow._graph.predecessors(node))
+    workflow.remove_nodes(list(removed))
+    guard = pe.Node(util.Function(input_names=['value', 'choose_source',
+                                               'index', 'choice'],
+                                  output_names=['value'],
+                                  function=check_branch),
+                    name=branch['select'] + '_guard')
+    guard.inputs.choose_source = getsource(branch['choose'])
+    guard.inputs.index = index
+    guard.inputs.choice = '%s.%s' % branch['choice']
+    workflow.connect(choicenode, branch['choice'][1], guard, 'value')
+    return True
+
+
+def resolve_branches(workflow, keep=None):
+    """Remove unselected branches of a workflow and its subworkflows
+
+    Call this after setting the workflow inputs and before running it.
+    Nodes named in `keep` are never removed; nodes of a subworkflow that
+    are connected in the parent workflow are kept automatically. The run
+    fails in a guard node if a resolved choice is later set or connected to
+    a value selecting another branch.
+    """
+    keep = set(keep or [])
+    for node in workflow._graph.nodes():
+        if isinstance(node, pe.Workflow):
+            used = set()
+            for edges, isout in [(workflow._graph.out_edges(node, data=True),
+                                  True),
+                                 (workflow._graph.in_edges(node, data=True),
+                                  False)]:
+                for _, _, data in edges:
+                    for src, dest in data['connect']:
+                        if isout:
+                            field = src[0] if isinstance(src, tuple) else src
+                        else:
+                            field = dest
+                        used.add(field.split('.')[0])
+            resolve_branches(node, used)
+    branches = getattr(workflow, '_lazy_branches', [])
+    workflow._lazy_branches = [branch for branch in branches
+                               if not _resolve(workflow, branch, keep)]
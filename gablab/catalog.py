@@ -0,0 +1,273 @@
+"""
+Output catalog
+--------------
+
+Level-2 flows found first-level outputs with a ``DataGrabber`` glob per
+contrast and sorted them by subject with a substring scan of every file for
+every subject, and an ``os.path.exists`` call on every element to tell files
+from subject ids. On networked storage and with thousands of subjects the
+globbing dominates the setup of the group analysis.
+
+:class:`CatalogDataSink` records, as it stores the first-level outputs of a
+subject, one ``(subject, run, contrast, kind) -> path`` entry per stored
+file in an SQLite catalog. The subject is the sink's ``container`` and the
+kind is the datasink field without its ``@`` (``modelfit.copes`` for
+``modelfit.@copes``), so flows storing different fields never overwrite
+each other's entries. The contrast is the 1-based position of the file in
+the field; in a nested field (e.g. the contrasts of every run) it is the
+position in each inner list and the run is the 1-based position of that
+list, otherwise the run is 0. Fields holding a single file (registration
+files, masks) and the fields listed in ``any_contrast`` are recorded as
+contrast 0, which matches any contrast; the files of a flat list in
+``any_contrast`` are recorded as the runs. Each entry is the path the file
+was stored at. :class:`CatalogGrabber` resolves the outputs of all subjects
+for one contrast with a single indexed query, returned in the order of the
+subjects.
+"""
+
+import os                                    # system functions
+import sqlite3
+
+from nipype.interfaces.base import (BaseInterfaceInputSpec, File, traits,
+                                    isdefined)
+import nipype.interfaces.io as nio           # Data i/o
+
+from mindflows.gablab.imageio import (CompressingDataSink,
+                                      CompressingDataSinkInputSpec)
+
+
+default_catalog_name = 'catalog.sqlite'
+
+
+def open_catalog(catalog_file, timeout=60.):
+    """Open (and create if needed) an output catalog
+    """
+    db = sqlite3.connect(catalog_file, timeout=timeout)
+    db.execute('CREATE TABLE IF NOT EXISTS outputs '
+               '(subject TEXT NOT NULL, run INTEGER NOT NULL, '
+               'contrast INTEGER NOT NULL, kind TEXT NOT NULL, '
+               'path TEXT NOT NULL, '
+               'PRIMARY KEY (kind, run, contrast, subject))')
+    return db
+
+
+def add_outputs(catalog_file, entries):
+    """Add (or replace) ``(subject, run, contrast, kind, path)`` entries
+    """
+    db = open_catalog(catalog_file)
+    try:
+        with db:
+            db.executemany('INSERT OR REPLACE INTO outputs '
+                           '(subject, run, contrast, kind, path) '
+                           'VALUES (?, ?, ?, ?, ?)', entries)
+    finally:
+        db.close()
+
+
+def find_outputs(catalog_file, kind, contrast, subjects, run=0):
+    """Return the paths of an output kind for a contrast, one per subject
+
+    `run` selects the run of nested fields (0 for fields not split by run).
+    Entries recorded with contrast 0 (single-file fields) match every
+    contrast. Raises an IOError naming the subjects without an entry.
+    """
+    db = open_catalog(catalog_file)
+    try:
+        rows = db.execute('SELECT subject, contrast, path FROM outputs '
+                          'WHERE kind = ? AND run = ? AND contrast IN (0, ?)',
+                          (kind, run, contrast)).fetchall()
+    finally:
+        db.close()
+    paths = {}
+    for subject, con, path in sorted(rows, key=lambda row: row[1]):
+        paths[subject] = path
+    missing = [subject for subject in subjects if subject not in paths]
+    if missing:
+        raise IOError('No %s for contrast %d of subjects %s in %s' %
+                      (kind, contrast, ', '.join(missing), catalog_file))
+    return [paths[subject] for subject in subjects]
+
+
+def output_kind(field):
+    """Return the output kind of a datasink field
+
+    >>> output_kind('modelfit.contrasts.@copes')
+    'modelfit.contrasts.copes'
+    """
+    return '.'.join([folder.lstrip('@') for folder in field.split('.')])
+
+
+def field_contrasts(files):
+    """Return ``(run, contrast, file)`` triples of the value of a datasink
+    field
+
+    >>> field_contrasts('register.dat')
+    [(0, 0, 'register.dat')]
+    >>> field_contrasts(['cope1.nii', 'cope2.nii'])
+    [(0, 1, 'cope1.nii'), (0, 2, 'cope2.nii')]
+    >>> field_contrasts([['r1/cope1.nii', 'r1/cope2.nii'], ['r2/cope1.nii']])
+    [(1, 1, 'r1/cope1.nii'), (1, 2, 'r1/cope2.nii'), (2, 1, 'r2/cope1.nii')]
+    """
+    if not isinstance(files, list):
+        return [(0, 0, files)]
+    if files and isinstance(files[0], list):
+        return [(run + 1, idx + 1, fname)
+                for run, sublist in enumerate(files)
+                for idx, fname in enumerate(sublist)]
+    if len(files) == 1:
+        return [(0, 0, files[0])]
+    return [(0, idx + 1, fname) for idx, fname in enumerate(files)]
+
+
+class CatalogDataSinkInputSpec(CompressingDataSinkInputSpec):
+    catalog_file = File(desc='catalog recording the stored outputs '
+                        '(default: catalog.sqlite in base_directory)')
+    any_contrast = traits.List(traits.Str,
+                               desc='fields recorded as contrast 0 (matching '
+                               'any contrast), one run per file of a flat '
+                               'list')
+
+
+class CatalogDataSink(CompressingDataSink):
+    """DataSink that records the files it stores in an output catalog
+
+    Outputs are recorded under the ``container`` as subject; see the module
+    documentation for the contrast and kind of each file.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.catalog import CatalogDataSink
+    >>> datasink = CatalogDataSink()
+    >>> datasink.inputs.base_directory = 'l1out'
+    >>> datasink.inputs.container = 's1'
+    >>> datasink.inputs.copes = ['cope1.nii.gz', 'cope2.nii.gz']
+    >>> datasink.run() # doctest: +SKIP
+    """
+
+    input_spec = CatalogDataSinkInputSpec
+
+    def _catalog_file(self):
+        if isdefined(self.inputs.catalog_file):
+            return os.path.abspath(self.inputs.catalog_file)
+        base_dir = '.'
+        if isdefined(self.inputs.base_directory):
+            base_dir = self.inputs.base_directory
+        return os.path.abspath(os.path.join(base_dir, default_catalog_name))
+
+    def _destination(self, field, src):
+        """Return the path a source file of a field is stored at, as the
+        datasink computes it (before compression)
+        """
+        outdir = '.'
+        if isdefined(self.inputs.local_copy):
+            outdir = self.inputs.local_copy
+        elif isdefined(self.inputs.base_directory):
+            outdir = self.inputs.base_directory
+        outdir = os.path.abspath(os.path.join(outdir, self.inputs.container))
+        for folder in field.split('.'):
+            if not folder.startswith('@'):
+                outdir = os.path.join(outdir, folder)
+        return self._substitute(os.path.join(
+            outdir, self._get_dst(os.path.abspath(src))))
+
+    def _list_outputs(self):
+        outputs = super(CatalogDataSink, self)._list_outputs()
+        if not isdefined(self.inputs.container):
+            return outputs
+        stored = set(outputs['out_file'])
+        any_contrast = []
+        if isdefined(self.inputs.any_contrast):
+            any_contrast = self.inputs.any_contrast
+        entries = []
+        keys = set()
+        for field, files in list(self.inputs._outputs.items()):
+            if not isdefined(files):
+                continue
+            for run, contrast, src in field_contrasts(files):
+                if not os.path.isfile(src):
+                    # the datasink stores no files for other sources
+                    continue
+                path = self._destination(field, src)
+                if path + '.gz' in stored:
+                    path = path + '.gz'
+                elif path not in stored:
+                    continue
+                if field in any_contrast:
+                    # the files of a flat list are those of each run
+                    if not run:
+                        run = contrast
+                    contrast = 0
+                key = (output_kind(field), run, contrast)
+                if key in keys:
+                    raise ValueError('Field %s stores several files as run '
+                                     '%d of contrast %d' % (field, run,
+                                                            contrast))
+                keys.add(key)
+                entries.append((self.inputs.container, run, contrast,
+                                output_kind(field), path))
+        if entries:
+            add_outputs(self._catalog_file(), entries)
+        return outputs
+
+
+class CatalogGrabberInputSpec(BaseInterfaceInputSpec):
+    catalog_file = File(exists=True, mandatory=True,
+                        desc='catalog written by CatalogDataSink')
+    subjects = traits.List(traits.Str, mandatory=True,
+                           desc='subjects, in the order of the outputs')
+    contrast = traits.Either(traits.Int, traits.List(traits.Int),
+                             mandatory=True,
+                             desc='contrast number (1-based), or a list of '
+                             'contrasts to get one list of files per '
+                             'contrast')
+    run = traits.Int(0, usedefault=True,
+                     desc='run (1-based) of nested per-run fields; 0 for '
+                     'fields not split by run')
+
+
+class CatalogGrabber(nio.IOBase):
+    """Look up first-level outputs of many subjects in an output catalog
+
+    Replaces a glob ``DataGrabber`` followed by sorting the files by
+    subject. Kinds are datasink fields without their ``@``; each kind is an
+    output, named after the last component of the kind, listing one file
+    per subject, or one such list per contrast when `contrast` is a list.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.catalog import CatalogGrabber
+    >>> grabber = CatalogGrabber(kinds=['modelfit.copes',
+    ...                                 'modelfit.varcopes'])
+    >>> grabber.inputs.subjects = ['s1', 's2']
+    >>> grabber.inputs.contrast = 1
+    >>> grabber.run() # doctest: +SKIP
+    """
+
+    input_spec = CatalogGrabberInputSpec
+    output_spec = nio.DynamicTraitedSpec
+
+    def __init__(self, kinds=None, **inputs):
+        self._kinds = kinds or ['modelfit.copes']
+        super(CatalogGrabber, self).__init__(**inputs)
+
+    def _add_output_traits(self, base):
+        return nio.add_traits(base, [kind.split('.')[-1]
+                                     for kind in self._kinds])
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for kind in self._kinds:
+            name = kind.split('.')[-1]
+            if isinstance(self.inputs.contrast, list):
+                outputs[name] = [find_outputs(self.inputs.catalog_file, kind,
+                                              contrast, self.inputs.subjects,
+                                              self.inputs.run)
+                                 for contrast in self.inputs.contrast]
+            else:
+                outputs[name] = find_outputs(self.inputs.catalog_file, kind,
+                                             self.inputs.contrast,
+                                             self.inputs.subjects,
+                                             self.inputs.run)
+        return outputs
@@ -0,0 +1,163 @@
+"""
+ROI connectivity
+----------------
+
+The resting state workflow brings ROI atlases to MNI space but stops before
+any connectivity measure; ROI time series were extracted by looping over
+the ROIs, reading the run once per ROI mask.
+
+:func:`roi_timeseries` averages the voxels of every label of an atlas in a
+single pass over a memory-mapped 4D run: each z-slab of the run is reduced
+to label sums with one sparse (labels x voxels) product, so the run is
+never held in memory and the cost does not grow with the number of ROIs.
+:class:`ROIConnectivity` drops the volumes flagged by ``art`` and computes
+the ROI-by-ROI correlation matrix of every run in float32.
+"""
+
+import os                                    # system functions
+
+import numpy as np
+from scipy import ndimage, sparse
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits, isdefined)
+from nipype.utils.filemanip import split_filename
+
+from mindflows.gablab.imageio import load_image, iter_slabs
+
+
+def labels_on_grid(label_file, ref_img):
+    """Return the integer labels of `label_file` on the voxel grid of
+    `ref_img`, resampled with nearest neighbour interpolation if the grids
+    differ
+    """
+    img, labels = load_image(label_file)
+    labels = np.round(np.asarray(labels)).astype(np.int64)
+    while labels.ndim > 3:
+        labels = labels[..., 0]
+    shape = ref_img.shape[:3]
+    if labels.shape == shape and np.allclose(img.affine, ref_img.affine):
+        return labels
+    vox2vox = np.dot(np.linalg.inv(img.affine), ref_img.affine)
+    return ndimage.affine_transform(labels, vox2vox[:3, :3],
+                                    offset=vox2vox[:3, 3],
+                                    output_shape=shape, order=0,
+                                    mode='constant', cval=0)
+
+
+def roi_timeseries(in_file, label_file, block_size=32768):
+    """Return the labels and the mean time series of every label
+    (timepoints x labels) of a 4D run
+
+    Label 0 is background. The run is streamed in z-slabs of about
+    `block_size` voxels.
+    """
+    img, data = load_image(in_file)
+    labels = labels_on_grid(label_file, img)
+    values, index = np.unique(labels, return_inverse=True)
+    index = index.reshape(labels.shape)
+    if values[0] == 0:
+        values = values[1:]
+        index = index - 1
+    ntimepoints = data.shape[3]
+    sums = np.zeros((values.size, ntimepoints))
+    counts = np.bincount(index[index >= 0], minlength=values.size)
+    for slab in iter_slabs(data.shape, block_size):
+        rows = index[:, :, slab].reshape(-1)
+        inroi = np.flatnonzero(rows >= 0)
+        if not inroi.size:
+            continue
+        block = np.asarray(data[:, :, slab],
+                           dtype=np.float32).reshape(-1, ntimepoints)
+        average = sparse.csr_matrix((np.ones(inroi.size, dtype=np.float32),
+                                     (rows[inroi], inroi)),
+                                    shape=(values.size, rows.size))
+        sums += average.dot(block)
+    return values, (sums / np.maximum(counts, 1)[:, None]).T
+
+
+def correlation_matrix(timeseries):
+    """Return the float32 correlation matrix of the columns of
+    `timeseries`; constant columns have zero correlations
+    """
+    data = np.asarray(timeseries, dtype=np.float32)
+    data = data - data.mean(axis=0)
+    norms = np.sqrt(np.sum(data ** 2, axis=0))
+    data /= np.where(norms > 0, norms, 1)
+    return np.dot(data.T, data)
+
+
+class ROIConnectivityInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='4D runs')
+    label_file = File(exists=True, mandatory=True,
+                      desc='atlas of integer labels (0 is background)')
+    outlier_files = InputMultiPath(File(exists=True),
+                                   desc='art outlier indices of each run')
+    block_size = traits.Int(32768, usedefault=True, nohash=True,
+                            desc='number of voxels read at a time')
+
+
+class ROIConnectivityOutputSpec(TraitedSpec):
+    timeseries_files = OutputMultiPath(File(exists=True),
+                                       desc='ROI time series of each run '
+                                       '(without outliers), one column per '
+                                       'label')
+    correlation_files = OutputMultiPath(File(exists=True),
+                                        desc='ROI-by-ROI correlation matrix '
+                                        'of each run (float32 .npy)')
+    labels_file = File(exists=True, desc='label of each column and row')
+
+
+class ROIConnectivity(BaseInterface):
+    """ROI time series and correlation matrices of each run
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.connectivity import ROIConnectivity
+    >>> conn = ROIConnectivity()
+    >>> conn.inputs.in_files = ['swrf1.nii', 'swrf2.nii']
+    >>> conn.inputs.label_file = 'waparc.nii'
+    >>> conn.inputs.outlier_files = ['art.wrf1_outliers.txt',
+    ...                              'art.wrf2_outliers.txt']
+    >>> conn.run() # doctest: +SKIP
+    """
+
+    input_spec = ROIConnectivityInputSpec
+    output_spec = ROIConnectivityOutputSpec
+
+    def _run_interface(self, runtime):
+        outlier_files = [None] * len(self.inputs.in_files)
+        if isdefined(self.inputs.outlier_files):
+            outlier_files = self.inputs.outlier_files
+            if len(outlier_files) != len(self.inputs.in_files):
+                raise ValueError('ROIConnectivity needs one outlier file per '
+                                 'run')
+        self._results = dict(timeseries_files=[], correlation_files=[])
+        for idx, (in_file, outlier_file) in enumerate(zip(self.inputs.in_files,
+                                                          outlier_files)):
+            _, base, _ = split_filename(in_file)
+            prefix = '%03d_%s' % (idx, base)
+            values, timeseries = roi_timeseries(in_file,
+                                                self.inputs.label_file,
+                                                self.inputs.block_size)
+            if outlier_file is not None and os.path.getsize(outlier_file):
+                outliers = np.loadtxt(outlier_file, ndmin=1).astype(int)
+                timeseries = np.delete(timeseries, outliers, axis=0)
+            outfile = os.path.join(runtime.cwd, 'roits.%s.txt' % prefix)
+            np.savetxt(outfile, timeseries, fmt='%.6g')
+            self._results['timeseries_files'].append(outfile)
+            outfile = os.path.join(runtime.cwd, 'roicorr.%s.npy' % prefix)
+            np.save(outfile, correlation_matrix(timeseries))
+            self._results['correlation_files'].append(outfile)
+        outfile = os.path.join(runtime.cwd, 'roilabels.txt')
+        np.savetxt(outfile, values, fmt='%d')
+        self._results['labels_file'] = outfile
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
@@ -0,0 +1,195 @@
+"""
+Fixed effects over run subsets
+------------------------------
+
+Combining runs with ``FLAMEO(run_mode='fe')`` for several run combinations
+meant one ``Select -> Merge -> L2Model -> FLAMEO -> ztop`` chain per
+combination, each merging and reading the same per-run images again.
+
+Fixed effects has a closed form: with weights ``w = 1 / varcope``, the
+combined ``varcope`` is ``1 / sum(w)`` and the combined ``cope`` is
+``varcope * sum(w * cope)``. :class:`FixedEffects` loads the copes and
+varcopes of every run once and computes the combination of any number of
+run subsets (all subsets, leave-one-out or an explicit list) from shared
+partial sums: subsets are visited in lexicographic order, so that each one
+extends the sums of its longest common prefix with the previous subset by
+one addition per run.
+"""
+
+from itertools import combinations
+import os                                    # system functions
+
+import numpy as np
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits, isdefined)
+
+from mindflows.gablab.blockglm import t_to_z
+from mindflows.gablab.imageio import load_image, save_image, output_ext
+
+
+def run_subsets(nruns, subsets='all', min_runs=2):
+    """Return run subsets as sorted tuples of run indices
+
+    `subsets` is 'all' (every subset of at least `min_runs` runs),
+    'leave_one_out' (every subset missing one run, and all the runs) or a
+    list of subsets.
+
+    >>> run_subsets(3)
+    [(0, 1), (0, 1, 2), (0, 2), (1, 2)]
+    >>> run_subsets(3, 'leave_one_out')
+    [(0, 1), (0, 1, 2), (0, 2), (1, 2)]
+    """
+    if subsets == 'all':
+        result = [subset for size in range(max(1, min_runs), nruns + 1)
+                  for subset in combinations(range(nruns), size)]
+    elif subsets == 'leave_one_out':
+        result = [tuple(idx for idx in range(nruns) if idx != left)
+                  for left in range(nruns)] + [tuple(range(nruns))]
+    else:
+        result = [tuple(sorted(set(subset))) for subset in subsets]
+    for subset in result:
+        if not subset or subset[0] < 0 or subset[-1] >= nruns:
+            raise ValueError('Invalid run subset %s for %d runs' %
+                             (subset, nruns))
+    return sorted(set(result))
+
+
+def fixed_effects(copes, varcopes, subsets, dofs=None):
+    """Combine runs with fixed effects for each subset
+
+    `copes` and `varcopes` are arrays with runs along the first axis. For
+    each subset, in the order of `subsets` (sorted tuples), yields the
+    subset and its cope, varcope and z statistic. The z statistic is
+    ``cope / sqrt(varcope)`` converted from a t statistic with the summed
+    degrees of freedom of the runs when `dofs` are given.
+    """
+    copes = np.asarray(copes, dtype=np.float64)
+    varcopes = np.asarray(varcopes, dtype=np.float64)
+    weights = np.zeros(varcopes.shape)
+    positive = varcopes > 0
+    weights[positive] = 1. / varcopes[positive]
+    weighted = weights * copes
+    # running sums of the current prefix: (subset, sum(w), sum(w * cope))
+    stack = [((), np.zeros(copes.shape[1:]), np.zeros(copes.shape[1:]))]
+    for subset in sorted(subsets):
+        while stack[-1][0] != subset[:len(stack[-1][0])]:
+            stack.pop()
+        for run in subset[len(stack[-1][0]):]:
+            prefix, wsum, wcsum = stack[-1]
+            stack.append((prefix + (run,), wsum + weights[run],
+                          wcsum + weighted[run]))
+        _, wsum, wcsum = stack[-1]
+        varcope = np.zeros(wsum.shape)
+        cope = np.zeros(wsum.shape)
+        valid = wsum > 0
+        varcope[valid] = 1. / wsum[valid]
+        cope[valid] = wcsum[valid] * varcope[valid]
+        zstat = np.zeros(wsum.shape)
+        zstat[valid] = cope[valid] / np.sqrt(varcope[valid])
+        if dofs is not None:
+            zstat = t_to_z(zstat, sum([dofs[run] for run in subset]))
+        yield subset, cope, varcope, zstat
+
+
+class FixedEffectsInputSpec(BaseInterfaceInputSpec):
+    copes = traits.List(InputMultiPath(File(exists=True)), mandatory=True,
+                        desc='copes of each contrast (outer list) and run '
+                        '(inner list)')
+    varcopes = traits.List(InputMultiPath(File(exists=True)),
+                           mandatory=True,
+                           desc='varcopes ordered as the copes')
+    dof_files = InputMultiPath(File(exists=True),
+                               desc='degrees of freedom of each run (FILM '
+                               'dof files); z statistics assume infinite '
+                               'degrees of freedom without them')
+    mask_file = File(exists=True, desc='voxels to estimate')
+    subsets = traits.Either(traits.Enum('all', 'leave_one_out'),
+                            traits.List(traits.List(traits.Int)),
+                            default='all', usedefault=True,
+                            desc="run subsets to combine: 'all', "
+                            "'leave_one_out' or a list of run indices lists")
+    min_runs = traits.Int(2, usedefault=True,
+                          desc="smallest subset size with subsets='all'")
+
+
+class FixedEffectsOutputSpec(TraitedSpec):
+    copes = OutputMultiPath(File(exists=True),
+                            desc='combined copes, by subset then contrast')
+    varcopes = OutputMultiPath(File(exists=True),
+                               desc='combined varcopes, ordered as copes')
+    zstats = OutputMultiPath(File(exists=True),
+                             desc='z statistics, ordered as copes')
+    subsets = traits.List(traits.List(traits.Int),
+                          desc='run subset of each group of outputs')
+
+
+class FixedEffects(BaseInterface):
+    """Fixed-effects combination of runs for many run subsets at once
+
+    Replaces ``iterables`` over run subsets feeding
+    ``FLAMEO(run_mode='fe')``. Outputs of contrast ``c`` for runs ``0, 2``
+    are named ``cope<c>_runs0-2`` etc.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.fixedfx import FixedEffects
+    >>> fixedfx = FixedEffects(subsets='leave_one_out')
+    >>> fixedfx.inputs.copes = [['run0/cope1.nii', 'run1/cope1.nii',
+    ...                          'run2/cope1.nii']]
+    >>> fixedfx.inputs.varcopes = [['run0/varcope1.nii', 'run1/varcope1.nii',
+    ...                             'run2/varcope1.nii']]
+    >>> fixedfx.run() # doctest: +SKIP
+    """
+
+    input_spec = FixedEffectsInputSpec
+    output_spec = FixedEffectsOutputSpec
+
+    def _run_interface(self, runtime):
+        nruns = len(self.inputs.copes[0])
+        subsets = run_subsets(nruns, self.inputs.subsets,
+                              self.inputs.min_runs)
+        dofs = None
+        if isdefined(self.inputs.dof_files):
+            dofs = [float(np.loadtxt(fname))
+                    for fname in self.inputs.dof_files]
+        ext = output_ext()
+        results = dict([(subset, dict(copes=[], varcopes=[], zstats=[]))
+                        for subset in subsets])
+        for con, (cope_files, varcope_files) in enumerate(
+                zip(self.inputs.copes, self.inputs.varcopes)):
+            ref_img, data = load_image(cope_files[0])
+            if isdefined(self.inputs.mask_file):
+                mask = np.asarray(load_image(self.inputs.mask_file)[1]) > 0
+            else:
+                mask = np.ones(data.shape, dtype=bool)
+            copes = [np.asarray(load_image(fname)[1])[mask]
+                     for fname in cope_files]
+            varcopes = [np.asarray(load_image(fname)[1])[mask]
+                        for fname in varcope_files]
+            for subset, cope, varcope, zstat in fixed_effects(copes, varcopes,
+                                                              subsets, dofs):
+                suffix = '%d_runs%s' % (con + 1,
+                                        '-'.join([str(run) for run in subset]))
+                for key, values, name in [('copes', cope, 'cope'),
+                                          ('varcopes', varcope, 'varcope'),
+                                          ('zstats', zstat, 'zstat')]:
+                    vol = np.zeros(mask.shape, dtype=np.float32)
+                    vol[mask] = values
+                    fname = os.path.join(runtime.cwd, name + suffix + ext)
+                    results[subset][key].append(save_image(vol, ref_img,
+                                                           fname, np.float32))
+        self._results = dict(copes=[], varcopes=[], zstats=[],
+                             subsets=[list(subset) for subset in subsets])
+        for subset in subsets:
+            for key in ['copes', 'varcopes', 'zstats']:
+                self._results[key].extend(results[subset][key])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for key in outputs:
+            outputs[key] = self._results[key]
+        return outputs
@@ -0,0 +1,196 @@
+"""
+Chunked FLAME1
+--------------
+
+``fsl.FLAMEO(run_mode='flame1')`` estimates the mixed-effects model of a
+group analysis in a single process over the whole brain, after
+decompressing the merged copes and varcopes.
+
+:class:`FLAME1` reads the copes and varcopes from two group stores
+(:mod:`mindflows.gablab.groupstore`) chunk by chunk and estimates each
+chunk in a pool of processes. At every voxel the model is ``cope = X b +
+e`` with ``var(e_i) = varcope_i + s``: the between-subject variance ``s``
+maximizes the restricted likelihood (found by a golden-section search run
+on all voxels of a chunk at once), and ``b`` is the weighted least squares
+estimate given ``s``. The t statistics of the contrasts are converted to z
+statistics with ``n - rank(X)`` degrees of freedom, as FLAME1's fast
+approximation. Outputs are named as those of FLAMEO.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os                                    # system functions
+
+import numpy as np
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, OutputMultiPath,
+                                    traits, isdefined)
+
+from mindflows.gablab.blockglm import read_vest, t_to_z
+from mindflows.gablab.groupstore import GroupStore
+
+
+def _weighted_fit(X, Y, V, s):
+    """Weighted least squares of every column of `Y` with variances
+    ``V + s``; returns the estimates, (X'WX)^-1 and the negative
+    restricted log-likelihood (up to a constant)
+    """
+    W = 1. / np.maximum(V + s, 1e-12)
+    xtwx = np.einsum('ip,iv,iq->vpq', X, W, X)
+    xtwy = np.einsum('ip,iv->vp', X, W * Y)
+    inv = np.linalg.pinv(xtwx)
+    beta = np.einsum('vpq,vq->vp', inv, xtwy)
+    resid = Y - np.dot(X, beta.T)
+    _, logdet = np.linalg.slogdet(xtwx)
+    cost = -np.sum(np.log(W), axis=0) + logdet + np.sum(W * resid ** 2,
+                                                        axis=0)
+    return beta, inv, cost
+
+
+def flame1(copes, varcopes, X, C, niters=40):
+    """Estimate the mixed-effects model at every column (voxel)
+
+    `copes` and `varcopes` are (subjects x voxels), `X` the design and `C`
+    the t contrasts (contrasts x regressors). Returns the contrast copes,
+    varcopes, t and z statistics (contrasts x voxels) and the between-subject
+    variance of every voxel.
+    """
+    Y = np.asarray(copes, dtype=np.float64)
+    V = np.maximum(np.asarray(varcopes, dtype=np.float64), 0)
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+    # the between-subject variance is below the spread of the copes
+    low = np.zeros(Y.shape[1])
+    high = 2 * np.var(Y, axis=0) + 1e-12
+    ratio = (np.sqrt(5) - 1) / 2
+    left = high - ratio * (high - low)
+    right = low + ratio * (high - low)
+    cost_left = _weighted_fit(X, Y, V, left)[2]
+    cost_right = _weighted_fit(X, Y, V, right)[2]
+    for _ in range(niters):
+        lower = cost_left < cost_right
+        high = np.where(lower, right, high)
+        low = np.where(lower, low, left)
+        new = np.where(lower, high - ratio * (high - low),
+                       low + ratio * (high - low))
+        cost_new = _weighted_fit(X, Y, V, new)[2]
+        right, cost_right, left, cost_left = (
+            np.where(lower, left, new), np.where(lower, cost_left, cost_new),
+            np.where(lower, new, right), np.where(lower, cost_new, cost_right))
+    s = (low + high) / 2
+    # keep the boundary when it fits better than the interior
+    s = np.where(_weighted_fit(X, Y, V, 0.)[2] <=
+                 _weighted_fit(X, Y, V, s)[2], 0., s)
+    beta, inv, _ = _weighted_fit(X, Y, V, s)
+    cope = np.dot(C, beta.T)
+    varcope = np.einsum('cp,vpq,cq->cv', C, inv, C)
+    tstat = np.zeros(cope.shape)
+    valid = varcope > 0
+    tstat[valid] = cope[valid] / np.sqrt(varcope[valid])
+    return cope, varcope, tstat, t_to_z(tstat, dof), s
+
+
+def flame1_chunk(cope_store, varcope_store, idx, subjects, X, C):
+    """Estimate chunk `idx` of a pair of group stores
+    """
+    copes = GroupStore(cope_store).read_chunk(idx, subjects)
+    varcopes = GroupStore(varcope_store).read_chunk(idx, subjects)
+    return flame1(copes, varcopes, X, C)
+
+
+class FLAME1InputSpec(BaseInterfaceInputSpec):
+    cope_store = File(exists=True, mandatory=True,
+                      desc='header (store.json) of the group store of copes')
+    var_cope_store = File(exists=True, mandatory=True,
+                          desc='header (store.json) of the group store of '
+                          'varcopes, with the voxels of the copes')
+    subjects = traits.List(traits.Str,
+                           desc='subjects, in the order of the design rows '
+                           '(default: all stored subjects)')
+    design_file = File(exists=True, mandatory=True,
+                       desc='design matrix (design.mat)')
+    t_con_file = File(exists=True, mandatory=True,
+                      desc='t contrasts (design.con)')
+    num_processes = traits.Int(4, usedefault=True, nohash=True,
+                               desc='number of chunks estimated '
+                               'concurrently')
+
+
+class FLAME1OutputSpec(TraitedSpec):
+    copes = OutputMultiPath(File(exists=True), desc='contrast estimates')
+    var_copes = OutputMultiPath(File(exists=True),
+                                desc='variance of the contrast estimates')
+    tstats = OutputMultiPath(File(exists=True), desc='t statistics')
+    zstats = OutputMultiPath(File(exists=True), desc='z statistics')
+    mean_random_effects_var_file = File(exists=True,
+                                        desc='between-subject variance')
+    dof = traits.Int(desc='degrees of freedom of the t statistics')
+
+
+class FLAME1(BaseInterface):
+    """Mixed-effects group analysis estimated by voxel chunks in parallel
+
+    Replaces ``fsl.FLAMEO(run_mode='flame1')`` for designs with a single
+    variance group.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.flame import FLAME1
+    >>> flame = FLAME1(num_processes=16)
+    >>> flame.inputs.cope_store = 'copes/store.json'
+    >>> flame.inputs.var_cope_store = 'varcopes/store.json'
+    >>> flame.inputs.design_file = 'design.mat'
+    >>> flame.inputs.t_con_file = 'design.con'
+    >>> flame.run() # doctest: +SKIP
+    """
+
+    input_spec = FLAME1InputSpec
+    output_spec = FLAME1OutputSpec
+
+    def _run_interface(self, runtime):
+        copes = GroupStore(os.path.dirname(self.inputs.cope_store))
+        varcopes = GroupStore(os.path.dirname(self.inputs.var_cope_store))
+        if not np.array_equal(copes.voxels, varcopes.voxels):
+            raise ValueError('The cope and varcope stores hold different '
+                             'voxels')
+        subjects = None
+        if isdefined(self.inputs.subjects):
+            subjects = self.inputs.subjects
+        X = read_vest(self.inputs.design_file)[0]
+        C = read_vest(self.inputs.t_con_file)[0]
+        nsubjects = len(copes.rows(subjects))
+        if X.shape[0] != nsubjects:
+            raise ValueError('The design has %d rows for %d subjects' %
+                             (X.shape[0], nsubjects))
+        results = [np.zeros((C.shape[0], copes.voxels.size))
+                   for _ in range(4)] + [np.zeros(copes.voxels.size)]
+        pool = ProcessPoolExecutor(max(1, self.inputs.num_processes))
+        try:
+            jobs = [(idx, pool.submit(flame1_chunk, copes.store_dir,
+                                      varcopes.store_dir, idx, subjects, X,
+                                      C))
+                    for idx in range(copes.nchunks)]
+            for idx, job in jobs:
+                chunk = copes.chunk_slice(idx)
+                for result, values in zip(results, job.result()):
+                    result[..., chunk] = values
+        finally:
+            pool.shutdown()
+        self._results = dict(copes=[], var_copes=[], tstats=[], zstats=[],
+                             dof=int(X.shape[0] - np.linalg.matrix_rank(X)))
+        for key, name, values in zip(['copes', 'var_copes', 'tstats',
+                                      'zstats'],
+                                     ['cope', 'varcope', 'tstat', 'zstat'],
+                                     results[:4]):
+            for con in range(C.shape[0]):
+                self._results[key].append(copes.save(
+                    values[con], os.path.join(runtime.cwd,
+                                              '%s%d' % (name, con + 1))))
+        self._results['mean_random_effects_var_file'] = copes.save(
+            results[4], os.path.join(runtime.cwd, 'mean_random_effects_var1'))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
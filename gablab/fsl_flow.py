@@ -3,7 +3,6 @@ import os                                    # system functions
 import numpy as np
 
 import nipype.algorithms.modelgen as model   # model generation
-import nipype.algorithms.rapidart as ra      # artifact detection
 import nipype.interfaces.freesurfer as fs    # freesurfer
 import nipype.interfaces.io as nio           # i/o routines
 import nipype.interfaces.fsl as fsl          # fsl
@@ -12,6 +11,20 @@ import nipype.pipeline.engine as pe          # pypeline engine
 
 from nibabel import load
 
+from mindflows.gablab.artifact import ArtifactDetect
+from mindflows.gablab.blockglm import BlockGLM
+from mindflows.gablab.branching import add_branch_select
+from mindflows.gablab.catalog import CatalogDataSink
+from mindflows.gablab.imageio import ExtractVolume, set_storage_policy
+from mindflows.gablab.intensitynorm import TemporalStats
+from mindflows.gablab.motion import MotionPlots
+from mindflows.gablab.report import StatReport
+from mindflows.gablab.resultstore import share_results
+from mindflows.gablab.tempfilt import TemporalFilter
+from mindflows.gablab.templates import TemplateBundle
+from mindflows.gablab.warp import BatchResample
+from mindflows.gablab.ztop import ZtoP
+
 """
 Preliminaries
 -------------
@@ -22,10 +35,18 @@ rarely would you put this in your own code.)
 
 """
 Setup any package specific configuration. The output file format for FSL
-routines is being set to compressed NIFTI.
+routines is being set to uncompressed NIFTI, which downstream nodes can
+memory-map. Only outputs stored by a datasink are compressed.
+
+Note that this changes the default for every FSL interface in the process,
+not only for the workflows defined here: once this module is imported, a
+plain ``nio.DataSink`` elsewhere stores uncompressed images. Use
+:class:`~mindflows.gablab.imageio.CompressingDataSink`, or call
+``set_storage_policy(compress_intermediates=True)`` after the import to
+restore compressed outputs.
 """
 
-fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+set_storage_policy()
 
 """
 Setting up workflows
@@ -68,12 +89,13 @@ img2float = pe.MapNode(interface=fsl.ImageMaths(out_data_type='float',
 preproc.connect(inputnode, 'func', img2float, 'in_file')
 
 """
-Extract the middle volume of the first run as the reference
+Extract the middle volume of the first run as the reference. Only the
+bytes of that volume are read, straight from the original run, so this does
+not wait for the float conversion.
 """
 
-extract_ref = pe.Node(interface=fsl.ExtractROI(t_size=1,
-                                               t_min=0),
-                      name = 'extractref')
+extract_ref = pe.Node(interface=ExtractVolume(t_min=0),
+                      name='extractref')
 
 """
 Define a function to pick the first file from a list of files
@@ -85,7 +107,7 @@ def pickfirst(files):
     else:
         return files
 
-preproc.connect(img2float, ('out_file', pickfirst), extract_ref, 'in_file')
+preproc.connect(inputnode, ('func', pickfirst), extract_ref, 'in_file')
 
 """
 Realign the functional runs to the middle volume of the first run
@@ -94,19 +116,19 @@ Realign the functional runs to the middle volume of the first run
 motion_correct = pe.MapNode(interface=fsl.MCFLIRT(save_mats = True,
                                                   save_plots = True),
                             name='realign',
-                            iterfield = ['in_file'])
+                            iterfield = ['in_file'],
+                            n_procs=1, mem_gb=1.5)
 preproc.connect(img2float, 'out_file', motion_correct, 'in_file')
 preproc.connect(extract_ref, 'roi_file', motion_correct, 'ref_file')
 
 """
-Plot the estimated motion parameters
+Plot the estimated motion parameters and compute the framewise displacement
+of all runs in a single node
 """
 
-plot_motion = pe.MapNode(interface=fsl.PlotMotionParams(in_source='fsl'),
-                        name='plot_motion',
-                        iterfield=['in_file'])
-plot_motion.iterables = ('plot_type', ['rotations', 'translations'])
-preproc.connect(motion_correct, 'par_file', plot_motion, 'in_file')
+plot_motion = pe.Node(interface=MotionPlots(in_source='fsl'),
+                      name='plot_motion')
+preproc.connect(motion_correct, 'par_file', plot_motion, 'in_files')
 
 """
 Extract the mean volume of the first functional run
@@ -128,62 +150,14 @@ meanfuncmask = pe.Node(interface=fsl.BET(mask = True,
 preproc.connect(meanfunc, 'out_file', meanfuncmask, 'in_file')
 
 """
-Mask the functional runs with the extracted mask
-"""
-
-maskfunc = pe.MapNode(interface=fsl.ImageMaths(suffix='_bet',
-                                               op_string='-mas'),
-                      iterfield=['in_file'],
-                      name = 'maskfunc')
-preproc.connect(motion_correct, 'out_file', maskfunc, 'in_file')
-preproc.connect(meanfuncmask, 'mask_file', maskfunc, 'in_file2')
-
-
-"""
-Determine the 2nd and 98th percentile intensities of each functional run
-"""
-
-getthresh = pe.MapNode(interface=fsl.ImageStats(op_string='-p 2 -p 98'),
-                       iterfield = ['in_file'],
-                       name='getthreshold')
-preproc.connect(maskfunc, 'out_file', getthresh, 'in_file')
-
-
-"""
-Threshold the first run of the functional data at 10% of the 98th percentile
-"""
-
-threshold = pe.Node(interface=fsl.ImageMaths(out_data_type='char',
-                                             suffix='_thresh'),
-                       name='threshold')
-preproc.connect(maskfunc, ('out_file', pickfirst), threshold, 'in_file')
-
-"""
-Define a function to get 10% of the intensity
-"""
-
-def getthreshop(thresh):
-    return '-thr %.10f -Tmin -bin'%(0.1*thresh[0][1])
-preproc.connect(getthresh, ('out_stat', getthreshop), threshold, 'op_string')
-
-"""
-Determine the median value of the functional runs using the mask
+Determine the robust intensity range and median intensity of each run, the
+dilated intensity mask and the mean image of each run in a single pass over
+each run
 """
 
-medianval = pe.MapNode(interface=fsl.ImageStats(op_string='-k %s -p 50'),
-                       iterfield = ['in_file'],
-                       name='medianval')
-preproc.connect(motion_correct, 'out_file', medianval, 'in_file')
-preproc.connect(threshold, 'out_file', medianval, 'mask_file')
-
-"""
-Dilate the mask
-"""
-
-dilatemask = pe.Node(interface=fsl.ImageMaths(suffix='_dil',
-                                              op_string='-dilF'),
-                       name='dilatemask')
-preproc.connect(threshold, 'out_file', dilatemask, 'in_file')
+tempstats = pe.Node(interface=TemporalStats(), name='tempstats', mem_gb=2)
+preproc.connect(motion_correct, 'out_file', tempstats, 'in_files')
+preproc.connect(meanfuncmask, 'mask_file', tempstats, 'mask_file')
 
 """
 Mask the motion corrected functional runs with the dilated mask
@@ -194,17 +168,7 @@ maskfunc2 = pe.MapNode(interface=fsl.ImageMaths(suffix='_mask',
                       iterfield=['in_file'],
                       name='maskfunc2')
 preproc.connect(motion_correct, 'out_file', maskfunc2, 'in_file')
-preproc.connect(dilatemask, 'out_file', maskfunc2, 'in_file2')
-
-"""
-Determine the mean image from each functional run
-"""
-
-meanfunc2 = pe.MapNode(interface=fsl.ImageMaths(op_string='-Tmean',
-                                                suffix='_mean'),
-                       iterfield=['in_file'],
-                       name='meanfunc2')
-preproc.connect(maskfunc2, 'out_file', meanfunc2, 'in_file')
+preproc.connect(tempstats, 'mask_file', maskfunc2, 'in_file2')
 
 """
 Merge the median values with the mean functional images into a coupled list
@@ -212,8 +176,8 @@ Merge the median values with the mean functional images into a coupled list
 
 mergenode = pe.Node(interface=util.Merge(2, axis='hstack'),
                     name='merge')
-preproc.connect(meanfunc2,'out_file', mergenode, 'in1')
-preproc.connect(medianval,'out_stat', mergenode, 'in2')
+preproc.connect(tempstats, 'mean_files', mergenode, 'in1')
+preproc.connect(tempstats, 'median_values', mergenode, 'in2')
 
 
 """
@@ -230,7 +194,7 @@ median value for each run and a mask consituting the mean functional
 
 smooth = pe.MapNode(interface=fsl.SUSAN(),
                     iterfield=['in_file', 'brightness_threshold','usans'],
-                    name='smooth')
+                    name='smooth', n_procs=1, mem_gb=1.5)
 
 """
 Define a function to get the brightness threshold for SUSAN
@@ -242,7 +206,7 @@ def getusanval(intuples):
     return [[tuple([val[0], 0.75*val[1]])] for val in intuples]
 preproc.connect(smoothval, 'fwhm', smooth, 'fwhm')
 preproc.connect(maskfunc2, 'out_file', smooth, 'in_file')
-preproc.connect(medianval, ('out_stat', getbtthresh), smooth, 'brightness_threshold')
+preproc.connect(tempstats, ('median_values', getbtthresh), smooth, 'brightness_threshold')
 preproc.connect(mergenode, ('out', getusanval), smooth, 'usans')
 
 """
@@ -254,62 +218,39 @@ maskfunc3 = pe.MapNode(interface=fsl.ImageMaths(suffix='_mask',
                       iterfield=['in_file'],
                       name='maskfunc3')
 preproc.connect(smooth, 'smoothed_file', maskfunc3, 'in_file')
-preproc.connect(dilatemask, 'out_file', maskfunc3, 'in_file2')
-
-
-concatnode = pe.Node(interface=util.Merge(2),
-                     name='concat')
-preproc.connect(maskfunc2,('out_file', lambda x:[x]), concatnode, 'in1')
-preproc.connect(maskfunc3,('out_file', lambda x:[x]), concatnode, 'in2')
+preproc.connect(tempstats, 'mask_file', maskfunc3, 'in_file2')
 
-selectnode = pe.Node(interface=util.Select(),name='select')
 
-preproc.connect(concatnode, 'out', selectnode, 'inlist')
+"""
+Select the smoothed or unsmoothed data depending on the fwhm. Both branches
+run unless the caller sets preproc.inputs.smoothval.fwhm and then calls
+:func:`mindflows.gablab.branching.resolve_branches` on the top-level workflow
+(l1pipeline) before running it, which removes the unused branch.
+"""
 
 def chooseindex(fwhm):
     if fwhm<1:
         return [0]
     else:
         return [1]
-    
-preproc.connect(smoothval, ('fwhm', chooseindex), selectnode, 'index')
-
-
-"""
-Scale the median value of the run is set to 10000
-"""
-
-meanscale = pe.MapNode(interface=fsl.ImageMaths(suffix='_gms'),
-                      iterfield=['in_file','op_string'],
-                      name='meanscale')
-preproc.connect(selectnode, 'out', meanscale, 'in_file')
-
-"""
-Define a function to get the scaling factor for intensity normalization
-"""
 
-def getmeanscale(medianvals):
-    return ['-mul %.10f'%(10000./val) for val in medianvals]
-preproc.connect(medianval, ('out_stat', getmeanscale), meanscale, 'op_string')
+selectnode = add_branch_select(preproc,
+                               [(maskfunc2, 'out_file'),
+                                (maskfunc3, 'out_file')],
+                               (smoothval, 'fwhm'), chooseindex)
 
-"""
-Perform temporal highpass filtering on the data
-"""
-
-highpass = pe.MapNode(interface=fsl.ImageMaths(suffix='_tempfilt'),
-                      iterfield=['in_file'],
-                      name='highpass')
-preproc.connect(meanscale, 'out_file', highpass, 'in_file')
 
 """
-Generate a mean functional image from the first run
+Scale the runs so that their median value is 10000 and perform temporal
+highpass filtering on the data in a single multi-threaded pass. The filter
+also generates a mean functional image from the first run (mean_file). Set the
+highpass sigma (in volumes) with preproc.inputs.highpass.highpass_sigma.
 """
 
-meanfunc3 = pe.MapNode(interface=fsl.ImageMaths(op_string='-Tmean',
-                                                suffix='_mean'),
-                       iterfield=['in_file'],
-                      name='meanfunc3')
-preproc.connect(highpass, ('out_file', pickfirst), meanfunc3, 'in_file')
+highpass = pe.Node(interface=TemporalFilter(), name='highpass',
+                   n_procs=4, mem_gb=3)
+preproc.connect(selectnode, 'out', highpass, 'in_files')
+preproc.connect(tempstats, 'median_values', highpass, 'median_values')
 
 
 """
@@ -321,18 +262,23 @@ surfregister = pe.Node(interface=fs.BBRegister(init='fsl',
                                                out_fsl_file=True),
                      name = 'surfregister')
 
+# Reuse registrations computed by other analyses of the same data
+share_results(surfregister)
+
 
 """
-Use :class:`nipype.algorithms.rapidart` to determine which of the
-images in the functional series are outliers based on deviations in
-intensity and/or movement.
+Use :class:`mindflows.gablab.artifact.ArtifactDetect` to determine which of
+the images in the functional series are outliers based on deviations in
+intensity and/or movement. The global intensity of each volume within the
+dilated mask comes from the temporal statistics node, so the runs are not
+read again.
 """
 
-art = pe.Node(interface=ra.ArtifactDetect(use_differences = [True, False],
-                                          use_norm = True,
-                                          zintensity_threshold = 3,
-                                          parameter_source = 'FSL',
-                                          mask_type = 'file'),
+art = pe.Node(interface=ArtifactDetect(use_differences = [True, False],
+                                       use_norm = True,
+                                       zintensity_threshold = 3,
+                                       parameter_source = 'FSL',
+                                       mask_type = 'file'),
               name="art")
 
 # Get information from the FreeSurfer directories (brainmask, etc)
@@ -349,14 +295,13 @@ convert2nii = pe.Node(interface=fs.MRIConvert(out_type='niigz'),name='convert2ni
 
 preproc.connect([(inputnode, surfregister,[('fssubject_id','subject_id'),
                                            ('surf_dir','subjects_dir')]),
-                 (meanfunc2, surfregister,[(('out_file',pickfirst),'source_file')]),
+                 (tempstats, surfregister,[(('mean_files',pickfirst),'source_file')]),
                  (motion_correct, art, [('par_file','realignment_parameters')]),
-                 (maskfunc2, art, [('out_file','realigned_files')]),
-                 (dilatemask, art, [('out_file', 'mask_file')]),
+                 (tempstats, art, [('global_values', 'global_values')]),
                  (inputnode, FreeSurferSource,[('fssubject_id','subject_id')]),
                  (FreeSurferSource, ApplyVolTransform,[('brainmask','target_file')]),
                  (surfregister, ApplyVolTransform,[('out_reg_file','reg_file')]),
-                 (meanfunc2, ApplyVolTransform,[(('out_file', pickfirst), 'source_file')]),
+                 (tempstats, ApplyVolTransform,[(('mean_files', pickfirst), 'source_file')]),
                  (ApplyVolTransform, convert2nii,[('transformed_file','in_file')])
                  ])
 
@@ -371,39 +316,37 @@ normalize = pe.Workflow(name='normalize')
 niftimask = pe.Node(fs.MRIConvert(out_type="niigz"),
                     name="niftimask")
 
-# Get the standard-space FLIRT target
-targetbrain = fsl.Info.standard_image("avg152T1_brain.nii.gz")
+# Get the standard-space targets and the FNIRT config from the template bundle
+templates = pe.Node(TemplateBundle(), name="templates")
 
 # Register the brainmask to the target using a 12-dof affine transformation
-regstruct = pe.Node(fsl.FLIRT(reference=targetbrain,
-                              searchr_x=[-180,180],
+regstruct = pe.Node(fsl.FLIRT(searchr_x=[-180,180],
                               searchr_y=[-180,180],
                               searchr_z=[-180,180]),
                     name="regstruct")
+share_results(regstruct)
 
 # XXX Insert slicer report node here
 # Convert the T1 to nifti so FNIRT can read it
 niftit1 = pe.Node(fs.MRIConvert(out_type="niigz"),
                   name="niftit1")
 
-# Path to the standard FNIRT config file
-fnirtcfg = "/usr/share/fsl/4.1/etc/flirtsch/T1_2_MNI152_2mm.cnf"
-
-# Get the standard space fnirt target
-targethead = fsl.Info.standard_image("avg152T1.nii.gz")
-
 # Use FNIRT to get a nonlinear transformation to the target
-fnirt = pe.Node(fsl.FNIRT(config_file=fnirtcfg,
-                          ref_file=targethead,
-                          fieldcoeff_file=True),
+fnirt = pe.Node(fsl.FNIRT(fieldcoeff_file=True),
                 name="fnirt")
 
+# The warps depend only on the anatomy: reuse them across analyses
+share_results(fnirt)
+
 # Concatenate the func to anat and anat to standard transform matrices
 matconcat = pe.Node(fsl.ConvertXFM(concat_xfm=True),
                     name="matconcat")
 
 # Connect the registration pipeline
 normalize.connect([
+    (templates,   regstruct, [("brain", "reference")]),
+    (templates,   fnirt,     [("head", "ref_file"),
+                              ("fnirt_config", "config_file")]),
     (niftimask,   regstruct, [("out_file", "in_file")]),
     (niftit1,     fnirt,     [("out_file", "in_file")]),
     (regstruct,   fnirt,     [("out_matrix_file", "affine_file")]),
@@ -417,73 +360,127 @@ Set up model fitting workflow
 
 """
 
-modelfit = pe.Workflow(name='modelfit')
-
-"""
-Use :class:`nipype.algorithms.modelgen.SpecifyModel` to generate design information.
-"""
-
-modelspec = pe.Node(interface=model.SpecifyModel(),  name="modelspec")
-modelspec.inputs.concatenate_runs = False
-
-"""
-Use :class:`nipype.interfaces.fsl.Level1Design` to generate a run specific fsf
-file for analysis
-"""
-
-level1design = pe.Node(interface=fsl.Level1Design(), name="level1design")
-
-"""
-Use :class:`nipype.interfaces.fsl.FEATModel` to generate a run specific mat
-file for use by FILMGLS
-"""
-
-modelgen = pe.MapNode(interface=fsl.FEATModel(), name='modelgen',
-                      iterfield = ['fsf_file'])
-
-"""
-Set the model generation to run everytime. Since the fsf file, which is the
-input to modelgen only references the ev files, modelgen will not run if the ev
-file contents are changed but the fsf file is untouched.
-"""
-
-#modelgen.overwrite = True
-
-"""
-Use :class:`nipype.interfaces.fsl.FILMGLS` to estimate a model specified by a
-mat file and a functional run
-"""
-
-modelestimate = pe.MapNode(interface=fsl.FILMGLS(smooth_autocorr=True,
-                                                 mask_size=5,
-                                                 threshold=1000),
-                           name='modelestimate',
-                           iterfield = ['design_file','in_file'])
-
-"""
-Use :class:`nipype.interfaces.fsl.ContrastMgr` to generate contrast estimates
-"""
+# Node configuration hashing input files by content rather than timestamp;
+# only for nodes whose file inputs are small (modelspec keeps timestamp
+# hashing, since its functional_runs are the uncompressed 4D runs)
+content_hashing = {'execution': {'hash_method': 'content'}}
+
+def create_modelfit(name='modelfit', engine='film'):
+    """Create the first-level model fitting workflow
+
+    With `engine` 'film', each run is estimated by ``FILMGLS`` and its
+    contrasts by ``ContrastMgr``. With 'blockglm', both are done in one
+    in-process pass by :class:`~mindflows.gablab.blockglm.BlockGLM`; the
+    ``conestimate`` node then only passes the contrast images on, so that
+    the workflow keeps the same node and field names.
+    """
+
+    modelfit = pe.Workflow(name=name)
+
+    """
+    Use :class:`nipype.algorithms.modelgen.SpecifyModel` to generate design
+    information.
+    """
+
+    modelspec = pe.Node(interface=model.SpecifyModel(),  name="modelspec")
+    modelspec.inputs.concatenate_runs = False
+
+    """
+    Use :class:`nipype.interfaces.fsl.Level1Design` to generate a run specific
+    fsf file for analysis
+    """
+
+    level1design = pe.Node(interface=fsl.Level1Design(), name="level1design")
+    level1design.config = content_hashing
+
+    """
+    Use :class:`nipype.interfaces.fsl.FEATModel` to generate a run specific mat
+    file for use by FILMGLS
+    """
+
+    modelgen = pe.MapNode(interface=fsl.FEATModel(), name='modelgen',
+                          iterfield = ['fsf_file', 'ev_files'])
+
+    """
+    The fsf file only references the ev files, so the ev files are passed to
+    modelgen as well. With level1design and modelgen hashing their small ev
+    and fsf files by content, design matrices are rebuilt exactly when an
+    ev, confound or outlier regressor changes, instead of on every run
+    (``modelgen.overwrite``).
+    """
+
+    modelgen.config = content_hashing
+
+    if engine == 'film':
+        """
+        Use :class:`nipype.interfaces.fsl.FILMGLS` to estimate a model
+        specified by a mat file and a functional run
+        """
+
+        modelestimate = pe.MapNode(interface=fsl.FILMGLS(smooth_autocorr=True,
+                                                         mask_size=5,
+                                                         threshold=1000),
+                                   name='modelestimate',
+                                   iterfield = ['design_file','in_file'],
+                                   n_procs=1, mem_gb=2)
+
+        """
+        Use :class:`nipype.interfaces.fsl.ContrastMgr` to generate contrast
+        estimates
+        """
+
+        conestimate = pe.MapNode(interface=fsl.ContrastMgr(),
+                                 name='conestimate',
+                                 iterfield = ['tcon_file','stats_dir'])
+        modelfit.connect([
+           (modelgen,modelestimate,[('design_file','design_file')]),
+           (modelgen,conestimate,[('con_file','tcon_file')]),
+           (modelestimate,conestimate,[('results_dir','stats_dir')]),
+           ])
+    elif engine == 'blockglm':
+        """
+        Use :class:`mindflows.gablab.blockglm.BlockGLM` to estimate the model
+        and its contrasts in one pass
+        """
+
+        modelestimate = pe.MapNode(interface=BlockGLM(threshold=1000,
+                                                      autocorr_fwhm=5),
+                                   name='modelestimate',
+                                   iterfield = ['design_file','in_file',
+                                                'tcon_file'],
+                                   n_procs=4, mem_gb=3)
+        conestimate = pe.Node(interface=util.IdentityInterface(
+                                  fields=['copes', 'varcopes', 'tstats',
+                                          'zstats']),
+                              name='conestimate')
+        modelfit.connect([
+           (modelgen,modelestimate,[('design_file','design_file'),
+                                    ('con_file','tcon_file')]),
+           (modelestimate,conestimate,[('copes','copes'),
+                                       ('varcopes','varcopes'),
+                                       ('tstats','tstats'),
+                                       ('zstats','zstats')]),
+           ])
+    else:
+        raise ValueError('Unknown GLM engine: %s' % engine)
 
-conestimate = pe.MapNode(interface=fsl.ContrastMgr(), name='conestimate',
-                         iterfield = ['tcon_file','stats_dir'])
+    # Convert all the z statistics to p values in one process
+    ztopval = pe.Node(interface=ZtoP(), name='ztop')
 
-ztopval = pe.MapNode(interface=fsl.ImageMaths(op_string='-ztop',
-                                              suffix='_pval'),name='ztop',
-                     iterfield=['in_file'])
+    mergedestimate = pe.Node(interface=util.Merge(3),
+                           name='mergedestimate')
+    modelfit.connect([
+       (modelspec,level1design,[('session_info','session_info')]),
+       (level1design,modelgen,[('fsf_files','fsf_file'),
+                               ('ev_files','ev_files')]),
+       (conestimate, ztopval, [(('zstats', lambda x:x[0]),'in_files')]),
+       (modelestimate, mergedestimate, [(('param_estimates', lambda x:x[0]),'in3')]),
+       (conestimate, mergedestimate, [(('copes', lambda x:x[0]),'in1'),
+                                    (('varcopes', lambda x:x[0]),'in2')]),
+       ])
+    return modelfit
 
-mergedestimate = pe.Node(interface=util.Merge(3),
-                       name='mergedestimate')
-modelfit.connect([
-   (modelspec,level1design,[('session_info','session_info')]),
-   (level1design,modelgen,[('fsf_files','fsf_file')]),
-   (modelgen,modelestimate,[('design_file','design_file')]),
-   (modelgen,conestimate,[('con_file','tcon_file')]),
-   (modelestimate,conestimate,[('results_dir','stats_dir')]),
-   (conestimate, ztopval, [(('zstats', lambda x:x[0]),'in_file')]),
-   (modelestimate, mergedestimate, [(('param_estimates', lambda x:x[0]),'in3')]),
-   (conestimate, mergedestimate, [(('copes', lambda x:x[0]),'in1'),
-                                (('varcopes', lambda x:x[0]),'in2')]),   
-   ])
+modelfit = create_modelfit()
 
 """
 Setup overlay workflow
@@ -492,21 +489,18 @@ Setup overlay workflow
 """
 
 overlay = pe.Workflow(name='overlay')
-overlaystats = pe.MapNode(interface=fsl.Overlay(), name="overlaystats",
-                          iterfield=['stat_image'])
-overlaystats.inputs.show_negative_stats=True
-overlaystats.inputs.auto_thresh_bg=True
 
-"""Use :class:`nipype.interfaces.fsl.Slicer` to create images of the overlaid
-statistical volumes for a report of the first-level results.
+"""Use :class:`mindflows.gablab.report.StatReport` to overlay the statistical
+volumes on the anatomy and create a single report of the first-level results.
 """
 
-slicestats = pe.MapNode(interface=fsl.Slicer(), name="slicestats",
-                        iterfield=['in_file'])
-slicestats.inputs.all_axial = True
-slicestats.inputs.image_width = 512
+statreport = pe.Node(interface=StatReport(title='First-level statistics'),
+                     name="statreport", n_procs=4, mem_gb=1)
+statreport.inputs.show_negative_stats=True
+statreport.inputs.auto_thresh_bg=True
+statreport.inputs.image_width = 512
 
-overlay.connect(overlaystats, 'out_file', slicestats, 'in_file')
+overlay.add_nodes([statreport])
 
 """
 Set up first-level workflow
@@ -530,17 +524,27 @@ Apply transformations to copes and varcopes
 applynorm = pe.Workflow(name='applynorm')
 
 
-# Apply the nonlinear warp to the timeseries
-warpfunc = pe.MapNode(fsl.ApplyWarp(ref_file=targethead),
-                      iterfield=["in_file"],
-                      name="warpfunc")
+# Get the standard-space targets from the template bundle
+applytemplates = pe.Node(TemplateBundle(), name="templates")
+
+# Combine the func to anat matrix and the FNIRT affine and coefficients into
+# one dense displacement field
+convertwarp = pe.Node(fsl.ConvertWarp(out_relwarp=True),
+                      name="convertwarp")
 
-# Apply the concatenated transformation to each timeseries
-funcxfm = pe.MapNode(fsl.FLIRT(apply_xfm=True,
-                               reference=targetbrain),
-                     iterfield=["in_file"],
-                     name="funcxfm")
-applynorm.add_nodes([warpfunc, funcxfm])
+# Apply the warp field to all the images at once
+warpfunc = pe.Node(BatchResample(suffix="_warp"),
+                   name="warpfunc", n_procs=4, mem_gb=2)
+
+# Apply the concatenated transformation to all the images at once
+funcxfm = pe.Node(BatchResample(suffix="_flirt"),
+                  name="funcxfm", n_procs=4, mem_gb=2)
+applynorm.connect([
+    (applytemplates, convertwarp, [("head", "reference")]),
+    (applytemplates, warpfunc, [("head", "reference")]),
+    (applytemplates, funcxfm,  [("brain", "reference")]),
+    (convertwarp, warpfunc, [("out_file", "field_file")]),
+    ])
 
 
 
@@ -563,9 +567,26 @@ inputnode = pe.Node(interface=util.IdentityInterface(fields=['func',
                                                              'subject_id',
                                                              'fssubject_id',
                                                              'session_info',
-                                                             'contrasts']),
+                                                             'contrasts',
+                                                             'outdir']),
                     name='inputnode')
 
+"""
+Store the normalized copes and varcopes of the subject under outdir and
+record them in the output catalog (outdir/catalog.sqlite) read by the
+level-2 volume flows
+"""
+
+datasink = pe.Node(interface=CatalogDataSink(), name='datasink')
+
+def pickcopes(files):
+    import os
+    return [f for f in files if os.path.basename(f).startswith('cope')]
+
+def pickvarcopes(files):
+    import os
+    return [f for f in files if os.path.basename(f).startswith('varcope')]
+
 """
 Connect the components into an integrated workflow.
 """
@@ -586,13 +607,19 @@ l1pipeline.connect([(inputnode,preproc,[('func','inputspec.func'),
                                          ('realign.par_file',
                                           'modelspec.realignment_parameters'),
                                          ('art.outlier_files', 'modelspec.outlier_files')]),
-                    (normalize, applynorm, [("fnirt.fieldcoeff_file", "warpfunc.field_file"),
+                    (normalize, applynorm, [("fnirt.fieldcoeff_file", "convertwarp.warp1"),
                                             ("matconcat.out_file", "funcxfm.in_matrix_file")]),
-                    (preproc, applynorm, [("surfregister.out_fsl_file", "warpfunc.premat")]),
-                    (modelfit, applynorm, [("mergedestimate.out", "warpfunc.in_file"),
-                                           ("mergedestimate.out", "funcxfm.in_file")]),
+                    (preproc, applynorm, [("surfregister.out_fsl_file", "convertwarp.premat")]),
+                    (modelfit, applynorm, [("mergedestimate.out", "warpfunc.in_files"),
+                                           ("mergedestimate.out", "funcxfm.in_files")]),
                     (preproc, overlay, [('convert2nii.out_file',
-                                         'overlaystats.background_image')]),
-                    (modelfit, overlay, [(('conestimate.zstats', lambda x: x[0]),'overlaystats.stat_image')]),
+                                         'statreport.background_image')]),
+                    (modelfit, overlay, [(('conestimate.zstats', lambda x: x[0]),'statreport.stat_images')]),
+                    (inputnode, datasink, [('outdir', 'base_directory'),
+                                           ('subject_id', 'container')]),
+                    (applynorm, datasink, [(('warpfunc.out_files', pickcopes),
+                                            'modelfit.@copes'),
+                                           (('warpfunc.out_files', pickvarcopes),
+                                            'modelfit.@varcopes')]),
                     ])
 
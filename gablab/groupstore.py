@@ -0,0 +1,729 @@
+"""
+Group stack store
+-----------------
+
+Level-2 flows concatenated every subject's image with
+``fsl.Merge(dimension='t')`` into a 4D image for each contrast. The group
+estimator then decompresses the whole stack, and adding a subject rewrites
+all of it.
+
+A :class:`GroupStore` keeps the stack in voxel chunks instead: the voxels
+(of a mask, or of the whole image) are split, in NIFTI file order, into
+chunks of ``chunk_voxels`` voxels, and each chunk is a raw float32 file with
+one row per subject. Adding a subject appends one row to each chunk, past
+the rows listed in the header, and an estimator reads (memory-maps) only
+the chunks it processes, from any number of processes. Replacing or
+removing subjects writes a new generation of the chunk files instead of
+changing rows in place. The subjects, the images they were read from, the
+chunk generation, geometry and chunking are recorded in ``store.json``,
+which is replaced atomically after the chunks are written, so readers never
+see a partial subject; writers hold a lock on the store. The previous
+generation is kept for readers of the previous header and removed by the
+next write that replaces it.
+
+Level-2 flows keep one store per contrast outside their working directory
+(see :func:`contrast_store_dir`), since nipype empties a node's directory
+whenever it reruns; a rerun with more subjects then only reads the images
+of the new ones. The surface flow projects straight into its stores with
+:class:`~mindflows.gablab.surfproj.SurfaceProject`, which checks each
+subject against its store before projecting it.
+
+Running statistics
+------------------
+
+The store also keeps the one-sample sufficient statistics of its subjects
+at every voxel (count, mean and sum of squared deviations, ``M2``). They
+are updated with Welford's (Chan et al.'s pairwise) update from the images
+of the subjects being added, replaced or removed only, so
+:class:`GroupOneSample` produces interim group maps without reading the
+other subjects' data. The statistics are saved with the version of the
+header they belong to; statistics saved by a write that was interrupted
+before its header was replaced do not match the header and are recomputed
+from the chunks.
+
+Example
+-------
+
+>>> from mindflows.gablab.groupstore import GroupStore
+>>> store = GroupStore('/data/group/cope1') # doctest: +SKIP
+>>> store.add([('s1', 's1/cope1.nii.gz'), ('s2', 's2/cope1.nii.gz')]) # doctest: +SKIP
+>>> data = store.read_chunk(0) # doctest: +SKIP
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os                                    # system functions
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy as np
+
+import nibabel as nb
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, Directory,
+                                    InputMultiPath, traits, isdefined)
+
+from mindflows.gablab.blockglm import t_to_z
+from mindflows.gablab.imageio import load_image, save_image, output_ext
+
+
+def image_signature(image):
+    """Identify the content of an image given as a file (by path, size and
+    modification time) or as an array (by checksum)
+    """
+    if isinstance(image, str):
+        info = os.stat(image)
+        return '%s:%d:%d' % (os.path.abspath(image), info.st_size,
+                             int(info.st_mtime * 1e6))
+    data = np.ascontiguousarray(image, dtype=np.float32)
+    return 'sha1:' + hashlib.sha1(data.tobytes()).hexdigest()
+
+
+def contrast_store_dir(store_root, contrast, name):
+    """Return the directory of the group store of a contrast, e.g.
+    ``<store_root>/con1/copes``
+
+    Self-contained, so that it can run in a ``util.Function`` node.
+    """
+    import os
+    return os.path.join(store_root, 'con%d' % contrast, name)
+
+
+def welford_add(count, mean, m2, values):
+    """Add samples (along the first axis of `values`) to running
+    statistics; returns the new count, mean and M2
+
+    >>> count, mean, m2 = welford_add(0, 0., 0., np.array([1., 2., 6.]))
+    >>> count, float(mean), float(m2 / (count - 1))
+    (3, 3.0, 7.0)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    nvalues = values.shape[0]
+    if not nvalues:
+        return count, mean, m2
+    vmean = values.mean(axis=0)
+    vm2 = np.sum((values - vmean) ** 2, axis=0)
+    total = count + nvalues
+    delta = vmean - mean
+    mean = mean + delta * nvalues / float(total)
+    m2 = m2 + vm2 + delta ** 2 * count * nvalues / float(total)
+    return total, mean, m2
+
+
+def welford_remove(count, mean, m2, values):
+    """Remove samples from running statistics; the inverse of
+    :func:`welford_add`
+
+    >>> count, mean, m2 = welford_remove(3, 3., 14., np.array([6.]))
+    >>> count, float(mean), float(m2)
+    (2, 1.5, 0.5)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    nvalues = values.shape[0]
+    if not nvalues:
+        return count, mean, m2
+    rest = count - nvalues
+    if rest <= 0:
+        return 0, np.zeros_like(mean), np.zeros_like(m2)
+    vmean = values.mean(axis=0)
+    vm2 = np.sum((values - vmean) ** 2, axis=0)
+    rmean = (count * mean - nvalues * vmean) / float(rest)
+    delta = vmean - rmean
+    m2 = m2 - vm2 - delta ** 2 * rest * nvalues / float(count)
+    return rest, rmean, np.maximum(m2, 0)
+
+
+class GroupStore(object):
+    """Chunked, appendable stack of one image per subject
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = os.path.abspath(store_dir)
+        self._header = None
+        self._voxels = None
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.store_dir, 'store.json'))
+
+    @property
+    def header(self):
+        if self._header is None:
+            fp = open(os.path.join(self.store_dir, 'store.json'))
+            self._header = json.load(fp)
+            fp.close()
+        return self._header
+
+    @property
+    def subjects(self):
+        return list(self.header['subjects'])
+
+    @property
+    def shape(self):
+        return tuple(self.header['shape'])
+
+    @property
+    def affine(self):
+        return np.array(self.header['affine'])
+
+    @property
+    def voxels(self):
+        """Flat (NIFTI order) indices of the stored voxels
+        """
+        if self._voxels is None:
+            self._voxels = np.load(os.path.join(self.store_dir, 'voxels.npy'))
+        return self._voxels
+
+    @property
+    def nchunks(self):
+        chunk = self.header['chunk_voxels']
+        return (self.voxels.size + chunk - 1) // chunk
+
+    def chunk_slice(self, idx):
+        """Return the slice of :attr:`voxels` stored in chunk `idx`
+        """
+        chunk = self.header['chunk_voxels']
+        return slice(idx * chunk, min((idx + 1) * chunk, self.voxels.size))
+
+    def chunk_file(self, idx, generation=None):
+        """Return the file of chunk `idx` in a generation (default: the
+        current one)
+        """
+        if generation is None:
+            generation = self.header.get('generation', 0)
+        if not generation:
+            return os.path.join(self.store_dir, 'chunk%05d.dat' % idx)
+        return os.path.join(self.store_dir,
+                            'chunk%05d.g%d.dat' % (idx, generation))
+
+    def create(self, ref_img, mask=None, chunk_voxels=16384):
+        """Create an empty store with the geometry of `ref_img`
+
+        Only the voxels where `mask` is nonzero are stored when it is given.
+        """
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        shape = tuple(int(size) for size in ref_img.shape[:3])
+        if mask is None:
+            voxels = np.arange(int(np.prod(shape)))
+        else:
+            voxels = np.flatnonzero(np.ravel(np.asarray(mask) > 0,
+                                             order='F'))
+        np.save(os.path.join(self.store_dir, 'voxels.npy'), voxels)
+        self._voxels = voxels
+        self._write_header(dict(shape=list(shape),
+                                affine=np.asarray(ref_img.affine).tolist(),
+                                zooms=[float(zoom) for zoom in
+                                       ref_img.header.get_zooms()[:3]],
+                                chunk_voxels=int(chunk_voxels),
+                                subjects=[]))
+        for idx in range(self.nchunks):
+            open(self.chunk_file(idx), 'ab').close()
+
+    def _write_header(self, header):
+        tmpname = os.path.join(self.store_dir, '.store.json.%d' % os.getpid())
+        fp = open(tmpname, 'wt')
+        json.dump(header, fp, indent=1)
+        fp.close()
+        os.rename(tmpname, os.path.join(self.store_dir, 'store.json'))
+        self._header = header
+
+    def lock(self):
+        """Acquire the exclusive write lock of the store
+        """
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        fp = open(os.path.join(self.store_dir, '.lock'), 'a')
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        # another writer may have changed the store meanwhile
+        self._header = None
+        return fp
+
+    def unlock(self, fp):
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+        fp.close()
+
+    def _load_voxels(self, image):
+        if callable(image):
+            image = image()
+        if isinstance(image, str):
+            data = load_image(image)[1]
+        else:
+            data = np.asarray(image)
+        if data.shape[:3] != self.shape:
+            raise ValueError('Image of shape %s does not match the store '
+                             'grid %s' % (data.shape, self.shape))
+        while data.ndim > 3:
+            data = data[..., 0]
+        return np.ravel(np.asarray(data, dtype=np.float32),
+                        order='F')[self.voxels]
+
+    def _write_rows(self, rows, values, num_threads=4, generation=None):
+        """Write `values` (subjects x voxels) to the given rows of every
+        chunk
+        """
+        def write_chunk(idx):
+            block = np.ascontiguousarray(values[:, self.chunk_slice(idx)])
+            rowsize = block.shape[1] * block.itemsize
+            fp = open(self.chunk_file(idx, generation), 'r+b')
+            try:
+                for row, data in zip(rows, block):
+                    fp.seek(row * rowsize)
+                    fp.write(data.tobytes())
+            finally:
+                fp.close()
+        pool = ThreadPoolExecutor(max(1, num_threads))
+        try:
+            list(pool.map(write_chunk, range(self.nchunks)))
+        finally:
+            pool.shutdown()
+
+    def _copy_rows(self, rows, num_threads=4):
+        """Write the given rows of the current chunks, in order, to a new
+        generation of chunk files; returns the new generation
+
+        The current chunks are not modified, so readers of the current
+        header are not affected.
+        """
+        generation = self.header.get('generation', 0) + 1
+
+        def copy_chunk(idx):
+            data = self.read_chunk(idx)[rows]
+            fp = open(self.chunk_file(idx, generation), 'wb')
+            try:
+                fp.write(np.ascontiguousarray(data).tobytes())
+            finally:
+                fp.close()
+        pool = ThreadPoolExecutor(max(1, num_threads))
+        try:
+            list(pool.map(copy_chunk, range(self.nchunks)))
+        finally:
+            pool.shutdown()
+        return generation
+
+    def _commit(self, header, mean, m2):
+        """Save the statistics and then the header of a write
+
+        A new header version ties the statistics to the header; if the
+        write is interrupted before the header is replaced, the saved
+        statistics no longer match it and are recomputed. Chunk files two
+        generations old, which no reader of the current or previous header
+        uses, are removed.
+        """
+        header['version'] = header.get('version', 0) + 1
+        self._save_stats(header['subjects'], header['version'], mean, m2)
+        self._write_header(header)
+        old = header.get('generation', 0) - 2
+        if old >= 0:
+            for idx in range(self.nchunks):
+                if os.path.exists(self.chunk_file(idx, old)):
+                    os.remove(self.chunk_file(idx, old))
+
+    def running_stats(self):
+        """Return the count, mean and M2 of the stored subjects at every
+        stored voxel
+
+        The statistics are recomputed from the chunks when they are missing
+        or do not match the stored subjects (e.g. after an interrupted
+        write).
+        """
+        stats = self._load_stats()
+        if stats is not None:
+            return stats
+        mean = np.zeros(self.voxels.size)
+        m2 = np.zeros(self.voxels.size)
+        for idx in range(self.nchunks):
+            chunk = self.chunk_slice(idx)
+            _, mean[chunk], m2[chunk] = welford_add(0, 0., 0.,
+                                                    self.read_chunk(idx))
+        return len(self.subjects), mean, m2
+
+    def _load_stats(self):
+        """Return the saved statistics if they belong to the current header
+        """
+        subjects = self.subjects
+        fname = os.path.join(self.store_dir, 'onesample.npz')
+        if os.path.exists(fname):
+            stats = np.load(fname)
+            if ('version' in stats and
+                int(stats['version']) == self.header.get('version', 0) and
+                [str(subject) for subject in stats['subjects']] == subjects):
+                return len(subjects), stats['mean'], stats['m2']
+        return None
+
+    def saved_stats(self):
+        """Return the running statistics like :meth:`running_stats`, and
+        save them when they had to be recomputed, so that later reads and
+        updates of the store are incremental again
+        """
+        stats = self._load_stats()
+        if stats is not None:
+            return stats
+        lock = self.lock()
+        try:
+            count, mean, m2 = self.running_stats()
+            self._save_stats(self.subjects, self.header.get('version', 0),
+                             mean, m2)
+        finally:
+            self.unlock(lock)
+        return count, mean, m2
+
+    def _save_stats(self, subjects, version, mean, m2):
+        tmpname = os.path.join(self.store_dir,
+                               '.onesample.%d.npz' % os.getpid())
+        np.savez(tmpname, subjects=np.array(subjects, dtype=str),
+                 version=version, mean=mean, m2=m2)
+        os.rename(tmpname, os.path.join(self.store_dir, 'onesample.npz'))
+
+    def add(self, subject_images, mask=None, chunk_voxels=16384,
+            num_threads=4, batch_size=64, ref_img=None):
+        """Add or replace subjects given as ``(subject, image)`` pairs
+
+        Images are files, 3D arrays or functions returning one. New subjects
+        are appended, in order, after the stored ones. Subjects stored from
+        the same image (see :func:`image_signature`) are skipped, so adding
+        a study's subjects again only reads the new or changed images. A
+        third element, ``(subject, image, signature)``, gives the signature
+        instead; it is required for functions, which are only called for
+        subjects that have to be stored. The store is created from
+        `ref_img`, or the first image file, if it does not exist yet.
+        """
+        lock = self.lock()
+        try:
+            if not self.exists():
+                if ref_img is None:
+                    ref_img = nb.load(subject_images[0][1])
+                self.create(ref_img, mask, chunk_voxels)
+            header = dict(self.header)
+            subjects = list(header['subjects'])
+            sources = dict(header.get('sources', {}))
+            changed = []
+            for entry in subject_images:
+                subject, image = entry[:2]
+                if len(entry) > 2:
+                    signature = entry[2]
+                else:
+                    signature = image_signature(image)
+                if subject in subjects and sources.get(subject) == signature:
+                    continue
+                sources[subject] = signature
+                changed.append((subject, image))
+            subject_images = changed
+            if not subject_images:
+                return
+            count, mean, m2 = self.running_stats()
+            generation = None
+            if [subject for subject, _ in subject_images
+                if subject in subjects]:
+                # rewrite replaced subjects in a copy of the chunks
+                generation = self._copy_rows(list(range(len(subjects))),
+                                             num_threads)
+                header['generation'] = generation
+            for start in range(0, len(subject_images), batch_size):
+                batch = subject_images[start:start + batch_size]
+                rows = []
+                replaced = []
+                for subject, _ in batch:
+                    if subject in subjects:
+                        replaced.append(subjects.index(subject))
+                    else:
+                        subjects.append(subject)
+                    rows.append(subjects.index(subject))
+                if replaced:
+                    count, mean, m2 = welford_remove(
+                        count, mean, m2,
+                        np.array([self.read_row(row) for row in replaced]))
+                pool = ThreadPoolExecutor(max(1, num_threads))
+                try:
+                    values = np.array(list(pool.map(self._load_voxels,
+                                                    [image for _, image
+                                                     in batch])))
+                finally:
+                    pool.shutdown()
+                self._write_rows(rows, values, num_threads, generation)
+                count, mean, m2 = welford_add(count, mean, m2, values)
+            header['subjects'] = subjects
+            header['sources'] = sources
+            self._commit(header, mean, m2)
+        finally:
+            self.unlock(lock)
+
+    def remove(self, subjects, num_threads=4):
+        """Remove subjects; the other subjects keep their order
+        """
+        lock = self.lock()
+        try:
+            header = dict(self.header)
+            stored = list(header['subjects'])
+            removed = [row for row, subject in enumerate(stored)
+                       if subject in subjects]
+            if not removed:
+                return
+            count, mean, m2 = self.running_stats()
+            count, mean, m2 = welford_remove(
+                count, mean, m2, np.array([self.read_row(row)
+                                           for row in removed]))
+            kept = [row for row in range(len(stored)) if row not in removed]
+            header['generation'] = self._copy_rows(kept, num_threads)
+            header['subjects'] = [stored[row] for row in kept]
+            sources = dict(header.get('sources', {}))
+            for row in removed:
+                sources.pop(stored[row], None)
+            header['sources'] = sources
+            self._commit(header, mean, m2)
+        finally:
+            self.unlock(lock)
+
+    def rows(self, subjects=None):
+        """Return the rows of `subjects` (default: all stored subjects)
+        """
+        stored = self.subjects
+        if subjects is None:
+            return list(range(len(stored)))
+        missing = [subject for subject in subjects if subject not in stored]
+        if missing:
+            raise KeyError('Subjects %s are not in the group store %s' %
+                           (', '.join(missing), self.store_dir))
+        return [stored.index(subject) for subject in subjects]
+
+    def read_chunk(self, idx, subjects=None):
+        """Return chunk `idx` as a (subjects x voxels) float32 array
+        """
+        chunk = self.chunk_slice(idx)
+        nsubjects = len(self.header['subjects'])
+        if not nsubjects:
+            return np.zeros((0, chunk.stop - chunk.start), dtype=np.float32)
+        data = np.memmap(self.chunk_file(idx), dtype=np.float32, mode='r',
+                         shape=(nsubjects, chunk.stop - chunk.start))
+        if subjects is None:
+            return np.array(data)
+        return np.array(data[self.rows(subjects)])
+
+    def read_row(self, row):
+        """Return the stored voxels of one row (subject)
+        """
+        values = []
+        for idx in range(self.nchunks):
+            chunk = self.chunk_slice(idx)
+            size = chunk.stop - chunk.start
+            values.append(np.fromfile(self.chunk_file(idx), dtype=np.float32,
+                                      count=size, offset=row * size * 4))
+        return np.concatenate(values)
+
+    def volume(self, values, dtype=np.float32):
+        """Scatter values of the stored voxels into a volume
+
+        `values` has the stored voxels along its first axis.
+        """
+        values = np.asarray(values)
+        out = np.zeros((int(np.prod(self.shape)),) + values.shape[1:],
+                       dtype=dtype)
+        out[self.voxels] = values
+        return out.reshape(self.shape + values.shape[1:], order='F')
+
+    def save(self, values, basename):
+        """Save values of the stored voxels as a float32 image named
+        `basename` plus the extension FSL nodes write
+
+        Surface stores, whose vertex counts exceed the NIFTI-1 dimension
+        limit, are saved as MGH.
+        """
+        volume = self.volume(values)
+        if max(self.shape) > 32767:
+            nb.MGHImage(volume, self.affine).to_filename(basename + '.mgh')
+            return basename + '.mgh'
+        return save_image(volume, self.reference(), basename + output_ext(),
+                          np.float32)
+
+    def reference(self):
+        """Return an image with the geometry of the store
+        """
+        img = nb.Nifti1Image(np.zeros(self.shape, dtype=np.uint8),
+                             self.affine)
+        img.header.set_zooms(self.header['zooms'])
+        return img
+
+    def export(self, fname, subjects=None):
+        """Write the stack of `subjects` as an uncompressed 4D image, one
+        chunk at a time
+        """
+        rows = self.rows(subjects)
+        nvoxels = int(np.prod(self.shape))
+        hdr = self.reference().header.copy()
+        hdr.set_data_shape(self.shape + (len(rows),))
+        hdr.set_zooms(tuple(self.header['zooms']) + (1.,))
+        hdr.set_data_dtype(np.float32)
+        hdr.set_data_offset(352)
+        fp = open(fname, 'wb')
+        try:
+            hdr.write_to(fp)
+            fp.truncate(352 + nvoxels * len(rows) * 4)
+        finally:
+            fp.close()
+        out = np.memmap(fname, dtype=np.float32, mode='r+', offset=352,
+                        shape=(nvoxels, len(rows)), order='F')
+        for idx in range(self.nchunks):
+            out[self.voxels[self.chunk_slice(idx)]] = \
+                self.read_chunk(idx)[rows].T
+        out.flush()
+        del out
+        return fname
+
+
+class GroupStackInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='image of each subject, or a single 4D '
+                              'image with one frame per subject')
+    subjects = traits.List(traits.Str,
+                           desc='subject of each image (default: the image '
+                           'positions)')
+    store_dir = Directory(desc='group store to add the subjects to '
+                          '(default: a new store in the node directory)')
+    mask_file = File(exists=True,
+                     desc='voxels to store when the store is created')
+    chunk_voxels = traits.Int(16384, usedefault=True,
+                              desc='voxels per chunk of a new store')
+    prune = traits.Bool(False, usedefault=True,
+                        desc='remove stored subjects missing from subjects')
+    export_file = traits.Bool(False, usedefault=True,
+                              desc='also write the stack of the subjects as '
+                              'a 4D image')
+    num_threads = traits.Int(4, usedefault=True, nohash=True,
+                             desc='number of images read concurrently')
+
+
+class GroupStackOutputSpec(TraitedSpec):
+    store_dir = Directory(exists=True, desc='group store')
+    store_file = File(exists=True, desc='header of the group store; it '
+                      'changes whenever the store does')
+    subjects = traits.List(traits.Str, desc='subjects in the order of '
+                           'in_files')
+    merged_file = File(exists=True, desc='4D stack of the subjects')
+
+
+class GroupStack(BaseInterface):
+    """Add subjects' images to a chunked group store
+
+    Replaces ``fsl.Merge(dimension='t')`` for group analyses; set
+    `export_file` for estimators that still need a 4D image, which is
+    written uncompressed so that it can be memory-mapped.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.groupstore import GroupStack
+    >>> copestack = GroupStack(store_dir='/data/group/cope1')
+    >>> copestack.inputs.in_files = ['s1/cope1.nii.gz', 's2/cope1.nii.gz']
+    >>> copestack.inputs.subjects = ['s1', 's2']
+    >>> copestack.run() # doctest: +SKIP
+    """
+
+    input_spec = GroupStackInputSpec
+    output_spec = GroupStackOutputSpec
+
+    def _run_interface(self, runtime):
+        subjects = self.inputs.subjects
+        in_files = self.inputs.in_files
+        ref_img = None
+        if len(in_files) == 1 and len(nb.load(in_files[0]).shape) > 3:
+            # one frame per subject, e.g. from mris_preproc
+            ref_img, data = load_image(in_files[0])
+            while data.ndim > 4:
+                data = data[..., 0]
+            images = [data[..., frame] for frame in range(data.shape[3])]
+        else:
+            images = list(in_files)
+        if not isdefined(subjects):
+            subjects = ['%04d' % idx for idx in range(len(images))]
+        if len(subjects) != len(images):
+            raise ValueError('GroupStack needs one subject per image')
+        store_dir = self.inputs.store_dir
+        if not isdefined(store_dir):
+            store_dir = os.path.join(runtime.cwd, 'groupstore')
+        mask = None
+        if isdefined(self.inputs.mask_file):
+            mask = load_image(self.inputs.mask_file)[1]
+        store = GroupStore(store_dir)
+        store.add(list(zip(subjects, images)), mask, self.inputs.chunk_voxels,
+                  self.inputs.num_threads, ref_img=ref_img)
+        if self.inputs.prune:
+            store.remove([subject for subject in store.subjects
+                          if subject not in subjects],
+                         self.inputs.num_threads)
+        self._results = dict(store_dir=store.store_dir,
+                             store_file=os.path.join(store.store_dir,
+                                                     'store.json'),
+                             subjects=list(subjects))
+        if self.inputs.export_file:
+            self._results['merged_file'] = store.export(
+                os.path.join(runtime.cwd, 'merged.nii'), subjects)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
+
+
+class GroupOneSampleInputSpec(BaseInterfaceInputSpec):
+    store_file = File(exists=True, mandatory=True,
+                      desc='header (store.json) of a group store')
+
+
+class GroupOneSampleOutputSpec(TraitedSpec):
+    cope_file = File(exists=True, desc='group mean')
+    varcope_file = File(exists=True, desc='variance of the group mean')
+    tstat_file = File(exists=True, desc='t statistic')
+    zstat_file = File(exists=True, desc='z statistic')
+    dof = traits.Int(desc='degrees of freedom')
+
+
+class GroupOneSample(BaseInterface):
+    """One-sample t-test from the running statistics of a group store
+
+    Replaces ``fs.OneSampleTTest`` on a merged stack: the statistics are
+    kept up to date as subjects are added, so this only writes the maps.
+    The level-2 flows keep their stores (and statistics) under
+    ``store_root`` across reruns, so only the subjects added or removed
+    since the last run are read.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.groupstore import GroupOneSample
+    >>> onesample = GroupOneSample()
+    >>> onesample.inputs.store_file = '/data/group/cope1/store.json'
+    >>> onesample.run() # doctest: +SKIP
+    """
+
+    input_spec = GroupOneSampleInputSpec
+    output_spec = GroupOneSampleOutputSpec
+
+    def _run_interface(self, runtime):
+        store = GroupStore(os.path.dirname(self.inputs.store_file))
+        count, mean, m2 = store.saved_stats()
+        if count < 2:
+            raise ValueError('A one-sample t-test needs at least 2 subjects, '
+                             '%s has %d' % (store.store_dir, count))
+        varcope = m2 / (count - 1) / count
+        tstat = np.zeros(mean.shape)
+        valid = varcope > 0
+        tstat[valid] = mean[valid] / np.sqrt(varcope[valid])
+        zstat = t_to_z(tstat, count - 1)
+        self._results = dict(dof=count - 1)
+        for name, values in [('cope', mean), ('varcope', varcope),
+                             ('tstat', tstat), ('zstat', zstat)]:
+            self._results[name + '_file'] = store.save(
+                values, os.path.join(runtime.cwd, name))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
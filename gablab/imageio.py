@@ -0,0 +1,292 @@
+"""
+Image i/o helpers
+-----------------
+
+Small helpers shared by the in-process (numpy) interfaces in this package.
+Outputs are written in the image format FSL nodes of the same workflow are
+configured to write, so that numpy and FSL nodes can be mixed freely.
+
+Storage policy
+--------------
+
+Workflows keep their data in two tiers. Files passed between nodes are
+written as uncompressed NIFTI, which the next node can memory-map instead of
+decompressing. Files leaving a workflow through a :class:`CompressingDataSink`
+are gzip-compressed, several files at a time.
+
+Partial reads
+-------------
+
+:class:`ExtractVolume` reads a single volume of a 4D image without touching
+the rest of the file: uncompressed images are sliced through their array
+proxy, and compressed images are read through a gzip seek index (kept in the
+node directory unless ``index_dir`` is given) when
+`indexed_gzip <https://github.com/pauldmccarthy/indexed_gzip>`_ is
+installed.
+"""
+
+import gzip
+import hashlib
+import os                                    # system functions
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import nibabel as nb
+import nipype.interfaces.fsl as fsl          # fsl
+import nipype.interfaces.io as nio           # i/o routines
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, Directory, traits,
+                                    isdefined)
+from nipype.utils.filemanip import split_filename
+
+try:
+    import indexed_gzip as igzip
+except ImportError:
+    igzip = None
+
+
+def set_storage_policy(compress_intermediates=False):
+    """Set the image type FSL nodes write between workflow nodes
+
+    By default intermediate images are uncompressed so that they can be
+    memory-mapped; compression is left to :class:`CompressingDataSink`.
+    """
+    if compress_intermediates:
+        fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+    else:
+        fsl.FSLCommand.set_default_output_type('NIFTI')
+
+
+def output_ext():
+    """Return the extension of the image type FSL nodes are writing
+    """
+    output_type = fsl.FSLCommand._output_type or fsl.Info.output_type()
+    return fsl.Info.output_type_to_ext(output_type)
+
+
+def output_name(in_file, suffix, newpath=None, ext=None):
+    """Generate an output filename from an input filename
+
+    >>> output_name('/data/f3.nii.gz', '_mask', newpath='/tmp', ext='.nii')
+    '/tmp/f3_mask.nii'
+    """
+    _, base, _ = split_filename(in_file)
+    if newpath is None:
+        newpath = os.getcwd()
+    if ext is None:
+        ext = output_ext()
+    return os.path.join(newpath, base + suffix + ext)
+
+
+def load_image(fname):
+    """Load an image and return it together with its data array
+
+    Uncompressed images are memory-mapped, so slicing the returned array
+    only reads the bytes that are accessed.
+    """
+    img = nb.load(fname)
+    return img, np.asanyarray(img.dataobj)
+
+
+def save_image(data, ref_img, fname, dtype=None):
+    """Save an array using the geometry of a reference image
+    """
+    hdr = ref_img.header.copy()
+    if dtype is None:
+        dtype = data.dtype
+    hdr.set_data_dtype(dtype)
+    hdr.set_slope_inter(1, 0)
+    img = nb.Nifti1Image(np.asarray(data, dtype=dtype), ref_img.affine, hdr)
+    img.to_filename(fname)
+    return fname
+
+
+def iter_slabs(shape, block_size):
+    """Generate slices of z-slabs holding about `block_size` voxels each
+
+    Slabs are contiguous within every volume of an image on disk, so
+    iterating over them streams through a memory-mapped 4D image once.
+
+    >>> list(iter_slabs((4, 4, 5, 10), 32))
+    [slice(0, 2, None), slice(2, 4, None), slice(4, 5, None)]
+    """
+    nslices = max(1, block_size // (shape[0] * shape[1]))
+    for start in range(0, shape[2], nslices):
+        yield slice(start, min(start + nslices, shape[2]))
+
+
+def gzip_file(fname, compresslevel=6):
+    """Compress a file in place, replacing ``fname`` with ``fname.gz``
+
+    zlib releases the GIL while compressing, so several files can be
+    compressed concurrently from threads.
+    """
+    with open(fname, 'rb') as fin:
+        with gzip.open(fname + '.gz', 'wb', compresslevel) as fout:
+            shutil.copyfileobj(fin, fout, 1024 * 1024)
+    os.remove(fname)
+    return fname + '.gz'
+
+
+class CompressingDataSinkInputSpec(nio.DataSinkInputSpec):
+    compress = traits.Bool(True, usedefault=True,
+                           desc='gzip uncompressed NIFTI outputs')
+    compress_level = traits.Range(low=1, high=9, value=6, usedefault=True,
+                                  desc='gzip compression level')
+    num_threads = traits.Int(4, usedefault=True, nohash=True,
+                             desc='number of files compressed concurrently')
+
+
+class CompressingDataSink(nio.DataSink):
+    """DataSink that gzips uncompressed NIFTI files as it stores them
+
+    Intermediate images stay uncompressed inside the workflow and are
+    compressed only once, in parallel threads, at the workflow boundary.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.imageio import CompressingDataSink
+    >>> datasink = CompressingDataSink()
+    >>> datasink.inputs.base_directory = 'l1out'
+    >>> datasink.inputs.num_threads = 8
+    """
+
+    input_spec = CompressingDataSinkInputSpec
+
+    def _list_outputs(self):
+        outputs = super(CompressingDataSink, self)._list_outputs()
+        if not self.inputs.compress:
+            return outputs
+        out_files = outputs['out_file']
+        toconvert = [idx for idx, fname in enumerate(out_files)
+                     if fname.endswith('.nii') and os.path.isfile(fname)]
+        pool = ThreadPoolExecutor(max(1, self.inputs.num_threads))
+        try:
+            compressed = list(pool.map(gzip_file,
+                                       [out_files[idx] for idx in toconvert],
+                                       [self.inputs.compress_level] *
+                                       len(toconvert)))
+        finally:
+            pool.shutdown()
+        for idx, fname in zip(toconvert, compressed):
+            out_files[idx] = fname
+        return outputs
+
+
+def gzip_index_name(fname, index_dir=None):
+    """Return the name of the persisted gzip seek index of a file
+
+    The index is kept in `index_dir` (default: the current directory), so
+    nothing is written next to the input. The name is keyed on the absolute
+    path, size and modification time of the file: files of other subjects
+    with the same name, or the file once rewritten, get a different index
+    instead of reusing one that points at the wrong bytes.
+    """
+    if index_dir is None:
+        index_dir = os.getcwd()
+    fname = os.path.abspath(fname)
+    info = os.stat(fname)
+    key = hashlib.sha1(('%s:%d:%d' % (fname, info.st_size,
+                                      info.st_mtime_ns)).encode()).hexdigest()
+    return os.path.join(index_dir, '.%s.%s.gzidx' % (os.path.basename(fname),
+                                                    key[:16]))
+
+
+def read_volume(fname, index=0, index_file=None):
+    """Read a single volume of a 4D image
+
+    Returns the image (whose data is not read) and the scaled volume. Only
+    the header and the bytes of the volume are read: uncompressed images are
+    sliced through their array proxy (so scaled images are not read whole)
+    and compressed images are decompressed up to the volume. If
+    `index_file` is given and indexed_gzip is available, compressed images
+    are read through a seek index reused from `index_file`, or built and
+    saved to it if it does not exist yet.
+    """
+    img = nb.load(fname)
+    if len(img.shape) < 4:
+        return img, np.asarray(img.dataobj, dtype=np.float64)
+    if not fname.endswith('.gz') or igzip is None or index_file is None:
+        return img, np.asarray(img.dataobj[..., index], dtype=np.float64)
+    shape = img.shape[:3]
+    dtype = img.header.get_data_dtype()
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    kwargs = {}
+    newindex = not os.path.exists(index_file)
+    if not newindex:
+        kwargs['index_file'] = index_file
+    fobj = igzip.IndexedGzipFile(fname, spacing=4 * 1024 * 1024, **kwargs)
+    try:
+        fobj.seek(img.dataobj.offset + index * nbytes)
+        data = np.frombuffer(fobj.read(nbytes), dtype)
+        if newindex:
+            tmpname = '%s.%d' % (index_file, os.getpid())
+            fobj.export_index(tmpname)
+            os.rename(tmpname, index_file)
+    finally:
+        fobj.close()
+    data = np.asarray(data.reshape(shape, order='F'), dtype=np.float64)
+    return img, data * img.dataobj.slope + img.dataobj.inter
+
+
+class ExtractVolumeInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc='4D image to extract a volume from')
+    t_min = traits.Int(0, usedefault=True,
+                       desc='index of the volume to extract')
+    out_data_type = traits.Enum('float', 'input', usedefault=True,
+                                desc='data type of the extracted volume')
+    index_dir = Directory(exists=True,
+                          desc='where to keep gzip seek indices (default: '
+                          'the node directory)')
+
+
+class ExtractVolumeOutputSpec(TraitedSpec):
+    roi_file = File(exists=True, desc='extracted volume')
+
+
+class ExtractVolume(BaseInterface):
+    """Extract a single volume reading only its bytes
+
+    In-process replacement for ``fsl.ExtractROI(t_size=1)``, which
+    decompresses and rewrites the whole run. The volume is converted to
+    float by default, so it can be extracted straight from the original
+    (integer) run instead of waiting for its float conversion.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.imageio import ExtractVolume
+    >>> extract_ref = ExtractVolume()
+    >>> extract_ref.inputs.in_file = 'f3.nii.gz'
+    >>> extract_ref.inputs.t_min = 0
+    >>> extract_ref.run() # doctest: +SKIP
+    """
+
+    input_spec = ExtractVolumeInputSpec
+    output_spec = ExtractVolumeOutputSpec
+
+    def _run_interface(self, runtime):
+        index_dir = runtime.cwd
+        if isdefined(self.inputs.index_dir):
+            index_dir = self.inputs.index_dir
+        index_file = gzip_index_name(self.inputs.in_file, index_dir)
+        img, data = read_volume(self.inputs.in_file, self.inputs.t_min,
+                                index_file)
+        dtype = np.float32
+        if self.inputs.out_data_type == 'input':
+            dtype = img.get_data_dtype()
+        self._roi_file = save_image(data, img,
+                                    output_name(self.inputs.in_file, '_roi',
+                                                runtime.cwd),
+                                    dtype)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['roi_file'] = self._roi_file
+        return outputs
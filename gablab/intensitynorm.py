@@ -0,0 +1,285 @@
+"""
+Fused intensity normalization
+-----------------------------
+
+The FEAT preprocessing chain masks, thresholds and summarizes every run with
+a series of ``fslmaths``/``fslstats`` calls (``maskfunc -> getthreshold ->
+threshold -> medianval -> dilatemask -> maskfunc2 -> meanfunc2``), each of
+which reads and rewrites a full 4D run. The interfaces in this module perform
+the same computations with numpy in a single block-wise pass over each run:
+
+:class:`TemporalStats` computes the temporal mean images, robust intensity
+range, median intensity and dilated intensity mask of the runs.
+
+:class:`IntensityNorm` additionally writes the runs masked with the dilated
+mask, replacing the whole chain.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits)
+
+from mindflows.gablab.imageio import (load_image, save_image, output_name,
+                                      iter_slabs)
+
+
+def fsl_percentiles(values, percentiles, nzeros=0):
+    """Return percentiles of the values as ``fslstats -p`` does
+
+    ``-p`` ranks every voxel of the image (or of the ``-k`` mask), zeros
+    included; only ``-P`` ranks the nonzero voxels alone. fslstats sorts
+    the voxels and picks the element at index ``int(n * p / 100)``, computed
+    in single precision, instead of interpolating between elements.
+    `nzeros` is a number of zero voxels ranked along with `values` without
+    being passed in, e.g. the background of a masked run.
+
+    >>> fsl_percentiles(np.array([0, 4, 1, 3, 2]), [0, 50, 100])
+    [0.0, 2.0, 4.0]
+    >>> fsl_percentiles(np.array([4, 1, 3, 2]), [0, 50, 100], nzeros=1)
+    [0.0, 2.0, 4.0]
+    >>> fsl_percentiles(np.array([-1, 5]), [2, 98], nzeros=98)
+    [0.0, 5.0]
+    """
+    values = np.asarray(values).ravel()
+    total = values.size + nzeros
+    if not total:
+        return [0.] * len(percentiles)
+    pvals = np.float32(np.asarray(percentiles, dtype=np.float64) / 100.)
+    idx = np.minimum((np.float32(total) * pvals).astype(np.int64), total - 1)
+    # rank the negative and positive values separately so that the zeros
+    # never have to be materialized
+    negative = values[values < 0]
+    positive = values[values > 0]
+    zeros = total - negative.size - positive.size
+    result = np.zeros(len(idx))
+    low = idx < negative.size
+    if np.any(low):
+        result[low] = np.partition(negative, idx[low])[idx[low]]
+    high = idx >= negative.size + zeros
+    if np.any(high):
+        kth = idx[high] - negative.size - zeros
+        result[high] = np.partition(positive, kth)[kth]
+    return [float(val) for val in result]
+
+
+def scan_run(data, brain, intensitymask=None, dilated=None, out=None,
+             block_size=32768):
+    """Compute the temporal statistics of a 4D run in one pass
+
+    The run is streamed in z-slabs of about `block_size` voxels. Returns a
+    dictionary with the temporal mean (``tmean``), the temporal minimum
+    inside `brain` (``tmin``), the values inside `brain` of every slab
+    (``brain``, voxels x timepoints) and, if `intensitymask` is given, the
+    values inside the intensity mask (``mask``). If `dilated` is given, the
+    sum of each volume inside it (``gsum``) is accumulated and, if `out` is
+    given, the run masked with `dilated` is written to it during the same
+    pass.
+    """
+    shape = data.shape[:3]
+    stats = dict(tmean=np.zeros(shape, dtype=np.float32),
+                 tmin=np.zeros(shape, dtype=np.float32),
+                 gsum=np.zeros(data.shape[3]),
+                 slabs=[], brain=[], mask=[])
+    for slab in iter_slabs(data.shape, block_size):
+        block = np.asarray(data[:, :, slab], dtype=np.float32)
+        inbrain = block[brain[:, :, slab]]
+        stats['tmean'][:, :, slab] = block.mean(axis=-1, dtype=np.float64)
+        if inbrain.size:
+            stats['tmin'][:, :, slab][brain[:, :, slab]] = inbrain.min(axis=1)
+        stats['slabs'].append(slab)
+        stats['brain'].append(inbrain)
+        if intensitymask is not None:
+            stats['mask'].append(block[intensitymask[:, :, slab] > 0].ravel())
+        if dilated is not None:
+            stats['gsum'] += block[dilated[:, :, slab] > 0].sum(axis=0)
+        if out is not None:
+            out[:, :, slab] = block * (dilated[:, :, slab] > 0)[..., None]
+    return stats
+
+
+def intensity_stats(in_files, mask_file, percentiles=(2, 98),
+                    thresh_fraction=0.1, mask_runs=False, newpath=None,
+                    block_size=32768):
+    """Compute the FEAT intensity statistics of functional runs
+
+    Reproduces the FEAT intensity chain:
+
+    1. robust range (``-p 2 -p 98``) of each run masked with the brain
+       mask, ranking the zero background as fslstats does
+    2. intensity mask from the first run: voxels that stay above
+       `thresh_fraction` of the upper robust intensity at every timepoint
+    3. median of each run inside the intensity mask (``-k mask -p 50``)
+    4. dilation of the intensity mask (``-dilF``)
+    5. temporal mean of each run inside the dilated mask and, if
+       `mask_runs` is True, each run masked with the dilated mask
+
+    The mean of every volume inside the dilated mask (the global signal used
+    for artifact detection) is computed as well. Each run is read once; only
+    the first run is revisited to apply the dilated mask, which is not known
+    until the first run has been scanned.
+    Returns a dictionary with the output filenames and statistics.
+    """
+    _, brain = load_image(mask_file)
+    brain = np.asarray(brain) > 0
+    outside = brain.size - int(np.sum(brain))
+    result = dict(out_files=[], mean_files=[], percentiles=[],
+                  median_values=[], global_values=[])
+    for idx, fname in enumerate(in_files):
+        img, data = load_image(fname)
+        out = None
+        if mask_runs:
+            out = np.zeros(data.shape, dtype=np.float32)
+        if idx == 0:
+            stats = scan_run(data, brain, block_size=block_size)
+            values = np.concatenate([vals.ravel() for vals in stats['brain']])
+            result['percentiles'].append(fsl_percentiles(values, percentiles,
+                                                         outside *
+                                                         data.shape[3]))
+            del values
+            thresh = thresh_fraction * result['percentiles'][0][-1]
+            tmin = stats['tmin']
+            intensitymask = (brain & (tmin >= thresh) &
+                             (tmin > 0)).astype(np.uint8)
+            dilated = ndimage.maximum_filter(intensitymask, size=3,
+                                             mode='constant')
+            result['mask_file'] = save_image(dilated, img,
+                                             output_name(fname,
+                                                         '_bet_thresh_dil',
+                                                         newpath),
+                                             np.uint8)
+            maskvals = [vals[intensitymask[:, :, slab][brain[:, :, slab]] > 0]
+                        for slab, vals in zip(stats['slabs'], stats['brain'])]
+            for slab in iter_slabs(data.shape, block_size):
+                block = np.asarray(data[:, :, slab], dtype=np.float32)
+                inmask = dilated[:, :, slab] > 0
+                stats['gsum'] += block[inmask].sum(axis=0)
+                if mask_runs:
+                    out[:, :, slab] = block * inmask[..., None]
+        else:
+            stats = scan_run(data, brain, intensitymask, dilated, out,
+                             block_size)
+            values = np.concatenate([vals.ravel() for vals in stats['brain']])
+            result['percentiles'].append(fsl_percentiles(values, percentiles,
+                                                         outside *
+                                                         data.shape[3]))
+            del values
+            maskvals = stats['mask']
+        values = np.concatenate([vals.ravel() for vals in maskvals])
+        result['median_values'].append(fsl_percentiles(values, [50])[0])
+        result['global_values'].append((stats['gsum'] /
+                                        max(1, np.sum(dilated > 0))).tolist())
+        result['mean_files'].append(save_image(stats['tmean'] * (dilated > 0),
+                                               img,
+                                               output_name(fname,
+                                                           '_mask_mean',
+                                                           newpath),
+                                               np.float32))
+        del stats, maskvals, values
+        if mask_runs:
+            result['out_files'].append(save_image(out, img,
+                                                  output_name(fname, '_mask',
+                                                              newpath),
+                                                  np.float32))
+    return result
+
+
+class TemporalStatsInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='motion corrected functional runs')
+    mask_file = File(exists=True, mandatory=True,
+                     desc='brain mask of the mean functional (from BET)')
+    percentiles = traits.List(traits.Float, [2., 98.], usedefault=True,
+                              minlen=1,
+                              desc='robust range percentiles; the last one '
+                              'sets the intensity threshold')
+    thresh_fraction = traits.Float(0.1, usedefault=True,
+                                   desc='fraction of the upper robust '
+                                   'intensity of the first run below which '
+                                   'voxels are excluded')
+    block_size = traits.Int(32768, usedefault=True,
+                            desc='number of voxels read at a time')
+
+
+class TemporalStatsOutputSpec(TraitedSpec):
+    mean_files = OutputMultiPath(File(exists=True),
+                                 desc='temporal mean of each run inside '
+                                 'the dilated mask')
+    mask_file = File(exists=True, desc='dilated intensity mask')
+    percentiles = traits.List(traits.List(traits.Float),
+                              desc='robust range of each run masked with '
+                              'the brain mask, zeros included (fslstats -p)')
+    median_values = traits.List(traits.Float,
+                                desc='median intensity of each run within '
+                                'the intensity mask')
+    global_values = traits.List(traits.List(traits.Float),
+                                desc='mean of each volume of each run within '
+                                'the dilated mask')
+
+
+class TemporalStats(BaseInterface):
+    """Single-pass numpy replacement for the FEAT intensity statistics
+
+    Outputs match those of the FSL nodes they replace: ``mean_files`` for
+    ``meanfunc2``, ``mask_file`` for ``dilatemask``, ``percentiles`` for
+    ``getthreshold`` (and thus ``getthreshop``) and ``median_values`` for
+    ``medianval`` (and thus ``getbtthresh``, ``getmeanscale`` and the SUSAN
+    ``usans``). ``global_values`` can be passed to
+    :class:`~mindflows.gablab.artifact.ArtifactDetect` instead of the runs.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.intensitynorm import TemporalStats
+    >>> stats = TemporalStats()
+    >>> stats.inputs.in_files = ['f3_mcf.nii', 'f5_mcf.nii']
+    >>> stats.inputs.mask_file = 'f3_mcf_mean_brain_mask.nii'
+    >>> stats.run() # doctest: +SKIP
+    """
+
+    input_spec = TemporalStatsInputSpec
+    output_spec = TemporalStatsOutputSpec
+    _mask_runs = False
+
+    def _run_interface(self, runtime):
+        self._results = intensity_stats(self.inputs.in_files,
+                                        self.inputs.mask_file,
+                                        self.inputs.percentiles,
+                                        self.inputs.thresh_fraction,
+                                        self._mask_runs,
+                                        runtime.cwd,
+                                        self.inputs.block_size)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for key in outputs:
+            outputs[key] = self._results[key]
+        return outputs
+
+
+class IntensityNormOutputSpec(TemporalStatsOutputSpec):
+    out_files = OutputMultiPath(File(exists=True),
+                                desc='runs masked with the dilated mask')
+
+
+class IntensityNorm(TemporalStats):
+    """Fused numpy replacement for the FEAT intensity masking chain
+
+    In addition to the outputs of :class:`TemporalStats`, writes the runs
+    masked with the dilated mask (``out_files``, replacing ``maskfunc2``).
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.intensitynorm import IntensityNorm
+    >>> norm = IntensityNorm()
+    >>> norm.inputs.in_files = ['f3_mcf.nii', 'f5_mcf.nii']
+    >>> norm.inputs.mask_file = 'f3_mcf_mean_brain_mask.nii'
+    >>> norm.run() # doctest: +SKIP
+    """
+
+    output_spec = IntensityNormOutputSpec
+    _mask_runs = True
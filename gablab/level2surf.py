@@ -1,10 +1,12 @@
-import os                                    # operating system functions
-
-import nipype.interfaces.io as nio           # Data i/o 
-import nipype.interfaces.freesurfer as fs    # freesurfer
 import nipype.pipeline.engine as pe          # pypeline engine
 import nipype.interfaces.utility as util     # misc. modules
 
+from mindflows.gablab.catalog import CatalogGrabber
+from mindflows.gablab.groupstore import GroupOneSample, contrast_store_dir
+from mindflows.gablab.permute import GroupPermute
+from mindflows.gablab.surfglm import SurfaceGroupGLM
+from mindflows.gablab.surfproj import SurfaceProject
+
 """
 Level2 surface-based pipeline
 -----------------------------
@@ -21,79 +23,118 @@ Setup a dummy node to iterate over contrasts and hemispheres
 l2inputnode = pe.Node(interface=util.IdentityInterface(fields=['contrasts',
                                                                'hemi',
                                                                'subjects',
-                                                               'base_directory',
-                                                               'field_template']),
+                                                               'catalog_file',
+                                                               'store_root']),
                       name='inputnode')
 
 """
-Use a datagrabber node to collect contrast images and registration files
+Look up contrast images and registration files of all subjects in the
+output catalog written by the datasink of the first-level flow (volsurf)
 """
 
-l2source = pe.Node(interface=nio.DataGrabber(infields=['con_id'],
-                                             outfields=['con','reg']),
+l2source = pe.Node(interface=CatalogGrabber(kinds=['contrasts.copes',
+                                                     'surfreg.reg']),
                    name='l2source')
-l2source.inputs.template = '*'
-l2source.inputs.template_args = dict(con=[['con_id']],reg=[[]])
 
-l2flow.connect(l2inputnode, 'contrasts', l2source, 'con_id')
-l2flow.connect(l2inputnode, 'base_directory', l2source, 'base_directory')
-l2flow.connect(l2inputnode, 'field_template', l2source, 'field_template')
+l2flow.connect(l2inputnode, 'contrasts', l2source, 'contrast')
+l2flow.connect(l2inputnode, 'subjects', l2source, 'subjects')
+l2flow.connect(l2inputnode, 'catalog_file', l2source, 'catalog_file')
 
 
 """
-Merge contrast images and registration files
+Project the contrast images to fsaverage with cached projection operators,
+straight into the group store of the contrast and hemisphere, which keeps
+their running one-sample statistics. The stores live under store_root,
+outside the working directory; subjects already stored from the same images
+are skipped before projection, so a rerun with more subjects only reads and
+projects the new ones
 """
 
-mergesubjnode = pe.Node(interface=util.Merge(3),
-                    name='mergesubjects')
+l2store = pe.Node(util.Function(input_names=['store_root', 'contrast',
+                                             'name'],
+                                output_names=['store_dir'],
+                                function=contrast_store_dir),
+                  name='store')
+l2flow.connect(l2inputnode, 'store_root', l2store, 'store_root')
+l2flow.connect(l2inputnode, 'contrasts', l2store, 'contrast')
+l2flow.connect(l2inputnode, 'hemi', l2store, 'name')
 
-def orderfiles(files, subj_list):
-    outlist = []
-    for s in subj_list:
-        for f in files:
-            if '%s/'%s in f:
-                outlist.append(f)
-                continue
-    return outlist
+l2concat = pe.Node(interface=SurfaceProject(prune=True), name='concat')
+l2concat.inputs.proj_frac = 0.5
+l2concat.inputs.target = 'fsaverage'
+l2concat.inputs.fwhm = 5
 
-def ordersubjects(data):
-    files = []
-    subj_list = []
-    con_list = []
-    reg_list = []
-    for f in data:
-        if os.path.exists(f):
-            if f.endswith('dat'):
-                reg_list.append(f)
-            else:
-                con_list.append(f)
-        else:
-            subj_list.append(f)
-    ordered_subj = orderfiles(con_list, subj_list)
-    ordered_reg = orderfiles(reg_list, subj_list)
-    filelist= [(v,ordered_reg[i]) for i,v in enumerate(ordered_subj)]
-    return filelist
+l2flow.connect(l2inputnode, 'hemi', l2concat, 'hemi')
+l2flow.connect(l2inputnode, 'subjects', l2concat, 'subjects')
+l2flow.connect(l2source, 'copes', l2concat, 'in_files')
+l2flow.connect(l2source, 'reg', l2concat, 'reg_files')
+l2flow.connect(l2store, 'store_dir', l2concat, 'store_dir')
 
-l2flow.connect(l2source,'con', mergesubjnode, 'in1')
-l2flow.connect(l2source,'reg', mergesubjnode, 'in2')
-l2flow.connect(l2inputnode, 'subjects', mergesubjnode, 'in3')
+"""
+Perform a one sample t-test
+"""
+
+l2ttest = pe.Node(interface=GroupOneSample(), name='onesample')
+l2flow.connect(l2concat, 'store_file', l2ttest, 'store_file')
 
 """
-Concatenate contrast images projected to fsaverage
+Correct the one sample t-test by sign flipping the subjects, with clusters
+formed on the fsaverage surface
 """
 
-l2concat = pe.Node(interface=fs.MRISPreproc(), name='concat')
-l2concat.inputs.proj_frac = 0.5
-l2concat.inputs.target = 'fsaverage'
-l2concat.inputs.fwhm = 5
+l2permute = pe.Node(interface=GroupPermute(), name='permute', n_procs=4)
+l2permute.inputs.target = 'fsaverage'
 
-l2flow.connect(l2inputnode, 'hemi', l2concat, 'hemi')
-l2flow.connect(mergesubjnode, ('out', ordersubjects), l2concat, 'vol_measure_file')
+l2flow.connect(l2concat, 'store_file', l2permute, 'store_file')
+l2flow.connect(l2concat, 'subjects', l2permute, 'subjects')
+l2flow.connect(l2inputnode, 'hemi', l2permute, 'hemi')
 
 """
-Perform a one sample t-test
+Batched surface group analysis
+------------------------------
+
+Analyse all contrasts on both hemispheres with a single node, which reads
+and projects the contrast images of every subject once
+"""
+
+l2glmflow = pe.Workflow(name='l2surfglm')
+
+l2glminputnode = pe.Node(interface=util.IdentityInterface(fields=['contrasts',
+                                                                  'subjects',
+                                                                  'catalog_file']),
+                         name='inputnode')
+
+"""
+Look up the images of all contrasts and the registration files. The grabber
+nests its outputs by contrast only when given a list, so a single contrast
+is wrapped in one
+"""
+
+def contrastlist(contrasts):
+    if isinstance(contrasts, list):
+        return contrasts
+    return [contrasts]
+
+l2glmsource = pe.Node(interface=CatalogGrabber(kinds=['contrasts.copes',
+                                                      'surfreg.reg']),
+                      name='l2source')
+
+l2glmflow.connect(l2glminputnode, ('contrasts', contrastlist),
+                  l2glmsource, 'contrast')
+l2glmflow.connect(l2glminputnode, 'subjects', l2glmsource, 'subjects')
+l2glmflow.connect(l2glminputnode, 'catalog_file', l2glmsource, 'catalog_file')
+
 """
+Fit a one sample t-test to every contrast on both hemispheres of fsaverage
+"""
+
+def firstcontrast(files):
+    return files[0]
+
+l2glm = pe.Node(interface=SurfaceGroupGLM(), name='surfglm')
+l2glm.inputs.proj_frac = 0.5
+l2glm.inputs.target = 'fsaverage'
+l2glm.inputs.fwhm = 5
 
-l2ttest = pe.Node(interface=fs.OneSampleTTest(), name='onesample')
-l2flow.connect(l2inputnode, ('hemi', lambda x: (l2concat.inputs.target, x, 'white')), l2ttest, 'surf')
-l2flow.connect(l2concat, 'out_file', l2ttest, 'in_file')
+l2glmflow.connect(l2glmsource, 'copes', l2glm, 'in_files')
+l2glmflow.connect(l2glmsource, ('reg', firstcontrast), l2glm, 'reg_files')
@@ -1,11 +1,15 @@
-import os                                    # operating system functions
-
-import nipype.interfaces.io as nio           # Data i/o 
-import nipype.interfaces.freesurfer as fs    # freesurfer
 import nipype.interfaces.fsl as fsl          # fsl
 import nipype.pipeline.engine as pe          # pypeline engine
 import nipype.interfaces.utility as util     # misc. modules
 
+from mindflows.gablab.catalog import CatalogGrabber
+from mindflows.gablab.flame import FLAME1
+from mindflows.gablab.groupstore import (GroupOneSample, GroupStack,
+                                         contrast_store_dir)
+from mindflows.gablab.permute import GroupPermute
+from mindflows.gablab.report import StatReport
+from mindflows.gablab.templates import TemplateBundle
+
 """
 Level2 surface-based pipeline
 -----------------------------
@@ -13,15 +17,6 @@ Level2 surface-based pipeline
 Create a level2 workflow
 """
 
-def orderfiles(files, subj_list):
-    outlist = []
-    for s in subj_list:
-        for f in files:
-            if '%s/'%s in f:
-                outlist.append(f)
-                continue
-    return outlist
-
 def L2FLAME(name='flame'):
     flameflow = pe.Workflow(name=name)
     '''
@@ -34,25 +29,20 @@ def L2FLAME(name='flame'):
                                                                  'stat_thresh']),
                         name='inputnode')
     '''
-    mni152 = fsl.Info.standard_image("avg152T1_brain.nii.gz")
-    flamemask = pe.Node(fs.Binarize(min=10, in_file=mni152), name="flamemask")
-    flame = pe.Node(fsl.FLAMEO(run_mode="flame1"), name="flame")
-    mni_brain = fsl.Info.standard_image("avg152T1.nii.gz")
-    overlayflame = pe.MapNode(interface=fsl.Overlay(stat_thresh=(2.5, 5),
-                                                 auto_thresh_bg=True,
-                                                 show_negative_stats=True,
-                                                 background_image=mni_brain),
-                              iterfield=['stat_image'],
-                              name='overlayflame')
-
-    sliceflame = pe.MapNode(interface=fsl.Slicer(all_axial=True,
-                                              image_width=750),
-                            iterfield=['in_file'],
-                            name='sliceflame')
+    # the binarized MNI brain comes from the cached template bundle
+    templates = pe.Node(TemplateBundle(), name="templates")
+    # mixed-effects estimate by voxel chunks of the group stores
+    flame = pe.Node(FLAME1(num_processes=4), name="flame", n_procs=4)
+    # overlay all the t statistics on the template in a single report
+    reportflame = pe.Node(interface=StatReport(stat_thresh=(2.5, 5),
+                                               auto_thresh_bg=True,
+                                               show_negative_stats=True,
+                                               image_width=750,
+                                               title='Group statistics'),
+                          name='reportflame', n_procs=4, mem_gb=1)
     
-    flameflow.connect([(flamemask,flame, [("binary_file", "mask_file")]),
-                       (flame,overlayflame,[('tstats','stat_image')]),
-                       (overlayflame,sliceflame,[('out_file', 'in_file')]),
+    flameflow.connect([(templates,reportflame,[('head','background_image')]),
+                       (flame,reportflame,[('tstats','stat_images')]),
                        ])
 
     return flameflow
@@ -66,66 +56,62 @@ def create_l2fsflow():
 
     l2inputnode = pe.Node(interface=util.IdentityInterface(fields=['contrasts',
                                                                    'subjects',
-                                                                   'base_directory',
-                                                                   'field_template']),
+                                                                   'catalog_file',
+                                                                   'store_root']),
                           name='inputnode')
 
     """
-    Use a datagrabber node to collect contrast images and registration files
+    Look up the contrast images of all subjects in the output catalog
+    written by the datasink of the first-level flow (fsl_flow)
     """
 
-    l2source = pe.Node(interface=nio.DataGrabber(infields=['con_id'],
-                                                 outfields=['con']),
+    l2source = pe.Node(interface=CatalogGrabber(kinds=['modelfit.copes']),
                        name='l2source')
-    l2source.inputs.template = '*'
-    l2source.inputs.template_args = dict(con=[['con_id']],reg=[[]])
-
-    l2fsflow.connect(l2inputnode, 'contrasts', l2source, 'con_id')
-    l2fsflow.connect(l2inputnode, 'base_directory', l2source, 'base_directory')
-    l2fsflow.connect(l2inputnode, 'field_template', l2source, 'field_template')
 
+    l2fsflow.connect(l2inputnode, 'contrasts', l2source, 'contrast')
+    l2fsflow.connect(l2inputnode, 'subjects', l2source, 'subjects')
+    l2fsflow.connect(l2inputnode, 'catalog_file', l2source, 'catalog_file')
 
     """
-    Merge contrast images and registration files
+    Concatenate contrast images projected to fsaverage
     """
 
-    mergesubjnode = pe.Node(interface=util.Merge(2),
-                        name='mergesubjects')
-
-    def ordersubjects(data):
-        files = []
-        subj_list = []
-        con_list = []
-        for f in data:
-            if os.path.exists(f):
-                con_list.append(f)
-            else:
-                subj_list.append(f)
-        ordered_subj = orderfiles(con_list, subj_list)
-        return ordered_subj
+    # stack the subjects in the chunked group store of the contrast, which
+    # keeps their running one-sample statistics. The store lives under
+    # store_root, outside the working directory, so that a rerun with more
+    # subjects only reads the new ones
+    copestore = pe.Node(util.Function(input_names=['store_root', 'contrast',
+                                                   'name'],
+                                      output_names=['store_dir'],
+                                      function=contrast_store_dir),
+                        name='copestore')
+    copestore.inputs.name = 'copes'
+    l2fsflow.connect(l2inputnode, 'store_root', copestore, 'store_root')
+    l2fsflow.connect(l2inputnode, 'contrasts', copestore, 'contrast')
 
-    l2fsflow.connect(l2source,'con', mergesubjnode, 'in1')
-    l2fsflow.connect(l2inputnode, 'subjects', mergesubjnode, 'in2')
+    copemerge = pe.Node(GroupStack(prune=True), name="copemerge")
+    l2fsflow.connect(l2source, 'copes', copemerge, 'in_files')
+    l2fsflow.connect(l2inputnode, 'subjects', copemerge, 'subjects')
+    l2fsflow.connect(copestore, 'store_dir', copemerge, 'store_dir')
 
     """
-    Concatenate contrast images projected to fsaverage
+    Perform a one sample t-test
     """
 
-    copemerge = pe.Node(fsl.Merge(dimension="t"), name="copemerge")
-    l2fsflow.connect(mergesubjnode, ('out', ordersubjects), copemerge, 'in_files')
+    l2ttest = pe.Node(interface=GroupOneSample(), name='onesample')
+    l2fsflow.connect(copemerge, 'store_file', l2ttest, 'store_file')
 
     """
-    Perform a one sample t-test
+    Correct the one sample t-test by sign flipping the subjects
     """
 
-    l2ttest = pe.Node(interface=fs.OneSampleTTest(), name='onesample')
-    l2fsflow.connect(copemerge, 'merged_file', l2ttest, 'in_file')
+    l2permute = pe.Node(interface=GroupPermute(), name='permute', n_procs=4)
+    l2fsflow.connect(copemerge, 'store_file', l2permute, 'store_file')
+    l2fsflow.connect(copemerge, 'subjects', l2permute, 'subjects')
 
-    mni152 = fsl.Info.standard_image("avg152T1_brain.nii.gz")
+    templates = pe.Node(TemplateBundle(), name="templates")
 
-    flamemask = pe.Node(fs.Binarize(min=10, in_file=mni152), name="flamemask")
-
-    l2fsflow.connect(flamemask, 'binary_file', l2ttest, "mask_file")
+    l2fsflow.connect(templates, 'brain_mask', copemerge, "mask_file")
 
     return l2fsflow
 
@@ -140,60 +126,55 @@ def create_l2fslflow():
 
     l2inputnode = pe.Node(interface=util.IdentityInterface(fields=['contrasts',
                                                                    'subjects',
-                                                                   'base_directory',
-                                                                   'field_template']),
+                                                                   'catalog_file',
+                                                                   'store_root']),
                           name='inputnode')
 
     """
-    Use a datagrabber node to collect contrast images and registration files
+    Look up the copes and varcopes of all subjects in the output catalog
+    written by the datasink of the first-level flow (fsl_flow)
     """
 
-    l2source = pe.Node(interface=nio.DataGrabber(infields=['con_id'],
-                                                 outfields=['cope','varcope']),
+    l2source = pe.Node(interface=CatalogGrabber(kinds=['modelfit.copes',
+                                                       'modelfit.varcopes']),
                        name='l2source')
-    l2source.inputs.template = '*'
-    l2source.inputs.template_args = dict(cope=[['con_id']],varcope=[['con_id']])
-
-    l2fslflow.connect(l2inputnode, 'contrasts', l2source, 'con_id')
-    l2fslflow.connect(l2inputnode, 'base_directory', l2source, 'base_directory')
-    l2fslflow.connect(l2inputnode, 'field_template', l2source, 'field_template')
-
 
-    def ordersubjects(data):
-        files = []
-        subj_list = []
-        file_list = []
-        for f in data:
-            if os.path.exists(f):
-                file_list.append(f)
-            else:
-                subj_list.append(f)
-        ordered_files = orderfiles(file_list, subj_list)
-        return ordered_files
+    l2fslflow.connect(l2inputnode, 'contrasts', l2source, 'contrast')
+    l2fslflow.connect(l2inputnode, 'subjects', l2source, 'subjects')
+    l2fslflow.connect(l2inputnode, 'catalog_file', l2source, 'catalog_file')
 
-    """
-    Merge contrast images and registration files
-    """
-
-    mergecopesubj = pe.Node(interface=util.Merge(2),
-                            name='mergecopesubj')
-    mergevarcopesubj =  pe.Node(interface=util.Merge(2),
-                            name='mergevarcopesubj')
-    
-    l2fslflow.connect(l2source,'cope', mergecopesubj, 'in1')
-    l2fslflow.connect(l2inputnode, 'subjects', mergecopesubj, 'in2')
-
-    l2fslflow.connect(l2source,'varcope', mergevarcopesubj, 'in1')
-    l2fslflow.connect(l2inputnode, 'subjects', mergevarcopesubj, 'in2')
-    
     """
     Concatenate contrast images projected to fsaverage
     """
 
-    copemerge = pe.Node(fsl.Merge(dimension="t"), name="copemerge")
-    l2fslflow.connect(mergecopesubj, ('out', ordersubjects), copemerge, 'in_files')
-    varcopemerge = pe.Node(fsl.Merge(dimension="t"), name="varcopemerge")
-    l2fslflow.connect(mergevarcopesubj, ('out', ordersubjects), varcopemerge, 'in_files')
+    # stack the subjects in the chunked group stores of the contrast under
+    # store_root, which FLAME1 reads directly; a rerun with more subjects
+    # only reads the new ones
+    copestore = pe.Node(util.Function(input_names=['store_root', 'contrast',
+                                                   'name'],
+                                      output_names=['store_dir'],
+                                      function=contrast_store_dir),
+                        name='copestore')
+    copestore.inputs.name = 'copes'
+    varcopestore = copestore.clone(name='varcopestore')
+    varcopestore.inputs.name = 'varcopes'
+    for store in [copestore, varcopestore]:
+        l2fslflow.connect(l2inputnode, 'store_root', store, 'store_root')
+        l2fslflow.connect(l2inputnode, 'contrasts', store, 'contrast')
+
+    copemerge = pe.Node(GroupStack(prune=True), name="copemerge")
+    l2fslflow.connect(l2source, 'copes', copemerge, 'in_files')
+    l2fslflow.connect(l2inputnode, 'subjects', copemerge, 'subjects')
+    l2fslflow.connect(copestore, 'store_dir', copemerge, 'store_dir')
+    varcopemerge = pe.Node(GroupStack(prune=True), name="varcopemerge")
+    l2fslflow.connect(l2source, 'varcopes', varcopemerge, 'in_files')
+    l2fslflow.connect(l2inputnode, 'subjects', varcopemerge, 'subjects')
+    l2fslflow.connect(varcopestore, 'store_dir', varcopemerge, 'store_dir')
+
+    # both stores hold the voxels of the template brain
+    templates = pe.Node(TemplateBundle(), name="templates")
+    l2fslflow.connect(templates, 'brain_mask', copemerge, "mask_file")
+    l2fslflow.connect(templates, 'brain_mask', varcopemerge, "mask_file")
 
     
     """
@@ -202,11 +183,22 @@ def create_l2fslflow():
     design = pe.Node(fsl.L2Model(), name="design")
     l2flame = L2FLAME(name='onesample')
     l2fslflow.connect([(l2inputnode, design, [(("subjects", lambda x: len(x)), "num_copes")]),
-                       (copemerge,l2flame,[('merged_file','flame.cope_file')]),
-                       (varcopemerge,l2flame,[('merged_file','flame.var_cope_file')]),
+                       (copemerge,l2flame,[('store_file','flame.cope_store'),
+                                           ('subjects','flame.subjects')]),
+                       (varcopemerge,l2flame,[('store_file','flame.var_cope_store')]),
                        (design,l2flame, [('design_mat','flame.design_file'),
-                                       ('design_con','flame.t_con_file'),
-                                       ('design_grp','flame.cov_split_file')]),
+                                       ('design_con','flame.t_con_file')]),
+                       ])
+
+    """
+    Correct the t statistics of the design by permutation
+    """
+
+    l2permute = pe.Node(interface=GroupPermute(), name='permute', n_procs=4)
+    l2fslflow.connect([(copemerge,l2permute,[('store_file','store_file'),
+                                             ('subjects','subjects')]),
+                       (design,l2permute,[('design_mat','design_file'),
+                                          ('design_con','t_con_file')]),
                        ])
 
     return l2fslflow
@@ -0,0 +1,162 @@
+"""
+Motion parameter summaries
+--------------------------
+
+``fsl.PlotMotionParams`` starts one ``fsl_tsplot`` process per run and plot
+type, and workflows used ``iterables`` over the plot type to get rotations
+and translations, expanding the graph for every subject. :class:`MotionPlots`
+reads the motion parameters of all runs once and renders both plots of
+every run in-process with matplotlib. It also writes the framewise
+displacement of each run and a one-line-per-run numeric summary.
+"""
+
+import os                                    # system functions
+
+import numpy as np
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits)
+from nipype.utils.filemanip import split_filename
+
+
+"""
+Column indices of the rotations and translations in the parameter files
+written by each package, and the name of the estimating program
+"""
+
+_param_columns = {'fsl': (slice(0, 3), slice(3, 6), 'MCFLIRT'),
+                  'spm': (slice(3, 6), slice(0, 3), 'Realign')}
+
+
+def load_motion_params(fname, source='fsl'):
+    """Return rotations (radians) and translations (mm) from a parameter file
+    """
+    params = np.atleast_2d(np.loadtxt(fname))
+    rot, trans, _ = _param_columns[source]
+    return params[:, rot], params[:, trans]
+
+
+def framewise_displacement(rotations, translations, radius=50.):
+    """Return the framewise displacement of each volume in mm
+
+    Sum of the absolute volume-to-volume changes of the translations and of
+    the rotations converted to displacements on a sphere of `radius` mm
+    (Power et al., 2012). The displacement of the first volume is 0.
+
+    >>> framewise_displacement(np.array([[0, 0, 0], [0.01, 0, 0]]),
+    ...                        np.array([[0, 0, 0], [0.2, -0.3, 0]]))
+    array([0., 1.])
+    """
+    delta = np.abs(np.diff(np.hstack((rotations * radius, translations)),
+                           axis=0))
+    return np.hstack(([0.], delta.sum(axis=1)))
+
+
+def plot_params(values, title, ylabel, out_file, size=(640, 144)):
+    """Plot motion parameter timeseries in the style of fsl_tsplot
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    dpi = 72.
+    fig = Figure(figsize=(size[0] / dpi, size[1] / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0.08, 0.18, 0.9, 0.68])
+    for idx, label in enumerate(['x', 'y', 'z']):
+        ax.plot(values[:, idx], label=label, linewidth=1)
+    ax.set_xlim(0, max(1, values.shape[0] - 1))
+    ax.set_title(title, fontsize=9)
+    ax.set_ylabel(ylabel, fontsize=8)
+    ax.tick_params(labelsize=7)
+    ax.legend(loc='upper left', ncol=3, fontsize=7, frameon=False)
+    fig.savefig(out_file, dpi=dpi)
+    return out_file
+
+
+class MotionPlotsInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='motion parameter files of all runs')
+    in_source = traits.Enum('fsl', 'spm', mandatory=True,
+                            desc='package that estimated the parameters')
+    fd_radius = traits.Float(50., usedefault=True,
+                             desc='head radius (mm) used to convert '
+                             'rotations to displacements')
+    fd_threshold = traits.Float(0.5, usedefault=True,
+                                desc='displacement (mm) above which a volume '
+                                'is counted in the summary')
+    plot_size = traits.Tuple((640, 144), traits.Int, traits.Int,
+                             usedefault=True,
+                             desc='plot width and height in pixels')
+
+
+class MotionPlotsOutputSpec(TraitedSpec):
+    out_file = OutputMultiPath(File(exists=True),
+                               desc='rotation and translation plots of '
+                               'each run')
+    fd_files = OutputMultiPath(File(exists=True),
+                               desc='framewise displacement of each run')
+    summary_file = File(exists=True,
+                        desc='mean and maximum framewise displacement and '
+                        'number of volumes above threshold of each run')
+
+
+class MotionPlots(BaseInterface):
+    """Plot motion parameters and compute framewise displacement
+
+    Replaces a ``fsl.PlotMotionParams`` MapNode with ``iterables`` over the
+    plot type: ``out_file`` holds the rotation and translation plots of
+    every run.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.motion import MotionPlots
+    >>> plot_motion = MotionPlots(in_source='fsl')
+    >>> plot_motion.inputs.in_files = ['f3_mcf.par', 'f5_mcf.par']
+    >>> plot_motion.run() # doctest: +SKIP
+    """
+
+    input_spec = MotionPlotsInputSpec
+    output_spec = MotionPlotsOutputSpec
+
+    def _run_interface(self, runtime):
+        _, _, program = _param_columns[self.inputs.in_source]
+        self._results = dict(out_file=[], fd_files=[])
+        summary = []
+        for idx, fname in enumerate(self.inputs.in_files):
+            _, base, _ = split_filename(fname)
+            # runs may share a base name (e.g. several mcf.par)
+            prefix = '%03d_%s' % (idx, base)
+            rotations, translations = load_motion_params(fname,
+                                                         self.inputs.in_source)
+            for values, kind, suffix, unit in [(rotations, 'rotations',
+                                                '_rot', 'radians'),
+                                               (translations, 'translations',
+                                                '_trans', 'mm')]:
+                out_file = os.path.join(runtime.cwd, prefix + suffix + '.png')
+                title = '%s estimated %s (%s)' % (program, kind, unit)
+                plot_params(values, title, unit, out_file,
+                            self.inputs.plot_size)
+                self._results['out_file'].append(out_file)
+            fd = framewise_displacement(rotations, translations,
+                                        self.inputs.fd_radius)
+            fd_file = os.path.join(runtime.cwd, prefix + '_fd.txt')
+            np.savetxt(fd_file, fd, fmt='%.6f')
+            self._results['fd_files'].append(fd_file)
+            summary.append('%s\t%.6f\t%.6f\t%d' %
+                           (prefix, fd.mean(), fd.max(),
+                            np.sum(fd > self.inputs.fd_threshold)))
+        summary_file = os.path.join(runtime.cwd, 'motion_summary.txt')
+        fp = open(summary_file, 'wt')
+        fp.write('run\tmean_fd\tmax_fd\tn_above_%g\n' %
+                 self.inputs.fd_threshold)
+        fp.write('\n'.join(summary) + '\n')
+        fp.close()
+        self._results['summary_file'] = summary_file
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for key in outputs:
+            outputs[key] = self._results[key]
+        return outputs
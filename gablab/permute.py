@@ -0,0 +1,298 @@
+"""
+Batched permutation inference
+-----------------------------
+
+The level-2 flows only produce parametric t statistics; permutation tests
+run outside the flows refit the whole GLM for every relabelling.
+
+:class:`GroupPermute` reads the subjects from a group store
+(:mod:`mindflows.gablab.groupstore`) and evaluates a batch of relabellings
+with a single matrix product per voxel chunk: every sign flip or
+permutation ``P`` of the subjects only changes the estimator ``pinv(X) P``,
+so the estimators of the batch are stacked into one (permutations x
+regressors, subjects) matrix applied to the (subjects x voxels) chunk. As
+``P`` is orthogonal, the residual sum of squares follows from the
+estimates and the (unchanged) sum of squares of the data. Batches run in a
+pool of processes; each returns the maximum t and the maximum cluster mass
+of its permutations, which form the null distributions of the
+family-wise corrected p values, and the per-voxel exceedance counts of the
+uncorrected p values.
+
+Designs whose only regressor is constant (one-sample tests) are tested
+with sign flips, other designs by permuting the subjects (Manly), which is
+exact for designs without nuisance regressors. As with ``randomise``, the
+contrasts are tested one-sided and the p maps hold ``1 - p``.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os                                    # system functions
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse.csgraph import connected_components
+
+from nibabel import freesurfer as nbfs
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, Directory,
+                                    OutputMultiPath, traits, isdefined)
+
+from mindflows.gablab.blockglm import read_vest
+from mindflows.gablab.groupstore import GroupStore
+from mindflows.gablab.surfproj import adjacency_matrix
+
+
+def batch_estimator(X, relabellings, sign_flip):
+    """Stack ``pinv(X) P`` of every relabelling into a (relabellings x
+    regressors, subjects) matrix
+
+    `relabellings` holds one row of signs (`sign_flip`) or one permutation
+    of the subjects per relabelling.
+    """
+    pinv = np.linalg.pinv(X)
+    nperms = len(relabellings)
+    estimator = np.zeros((nperms,) + pinv.shape)
+    for idx, relabel in enumerate(relabellings):
+        if sign_flip:
+            estimator[idx] = pinv * relabel[None, :]
+        else:
+            # (P Y)_i = Y_relabel[i], so column relabel[i] gets column i
+            estimator[idx][:, relabel] = pinv
+    return estimator.reshape(-1, X.shape[0])
+
+
+def batch_tstats(Y, X, C, estimator):
+    """t statistics (relabellings x contrasts x voxels) of the columns of
+    `Y` under every relabelling stacked in `estimator`
+    """
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+    nregressors = X.shape[1]
+    beta = np.dot(estimator, Y).reshape(-1, nregressors, Y.shape[1])
+    # X'PY = X'X b, and P leaves the sum of squares unchanged
+    rss = np.sum(Y ** 2, axis=0)[None, :] - \
+        np.einsum('bpv,pq,bqv->bv', beta, np.dot(X.T, X), beta)
+    sigmasq = np.maximum(rss, 0) / dof
+    conv = np.einsum('cp,pq,cq->c', C, np.linalg.pinv(np.dot(X.T, X)), C)
+    copes = np.einsum('cp,bpv->bcv', C, beta)
+    varcopes = conv[None, :, None] * sigmasq[:, None, :]
+    tstats = np.zeros(copes.shape)
+    valid = varcopes > 0
+    tstats[valid] = copes[valid] / np.sqrt(varcopes[valid])
+    return tstats
+
+
+def cluster_masses(store, values, thresh, adjacency=None):
+    """Label the clusters of stored voxels above `thresh`
+
+    Clusters are 26-connected on the volume grid, or connected on the
+    surface `adjacency` of a surface store. Returns the cluster label of
+    every stored voxel (0 outside clusters) and the mass (sum of values) of
+    every cluster.
+    """
+    supra = values > thresh
+    labels = np.zeros(values.size, dtype=np.int64)
+    if not supra.any():
+        return labels, np.zeros(0)
+    if adjacency is None:
+        volume, nclusters = ndimage.label(store.volume(supra, dtype=bool),
+                                          structure=np.ones((3, 3, 3)))
+        labels = volume.reshape(-1, order='F')[store.voxels]
+    else:
+        idx = np.flatnonzero(supra)
+        vertices = store.voxels[idx]
+        nclusters, components = connected_components(
+            adjacency[vertices][:, vertices], directed=False)
+        labels[idx] = components + 1
+    masses = np.bincount(labels, weights=values, minlength=nclusters + 1)
+    return labels, masses[1:]
+
+
+def store_tstats(store, subjects, X, C, relabellings, sign_flip):
+    """t statistics of a whole store under every relabelling, computed
+    chunk by chunk
+    """
+    estimator = batch_estimator(X, relabellings, sign_flip)
+    tstats = np.zeros((len(relabellings), C.shape[0], store.voxels.size),
+                      dtype=np.float32)
+    for idx in range(store.nchunks):
+        Y = store.read_chunk(idx, subjects).astype(np.float64)
+        tstats[..., store.chunk_slice(idx)] = batch_tstats(Y, X, C,
+                                                           estimator)
+    return tstats
+
+
+def permutation_batch(store_dir, subjects, X, C, relabellings, sign_flip,
+                      tstat, cluster_thresh, adjacency=None):
+    """Null statistics of a batch of relabellings
+
+    Returns the maximum t and maximum cluster mass of every relabelling and
+    contrast (relabellings x contrasts), and the number of relabellings
+    reaching the observed `tstat` at every voxel (contrasts x voxels).
+    """
+    store = GroupStore(store_dir)
+    tstats = store_tstats(store, subjects, X, C, relabellings, sign_flip)
+    max_tstats = tstats.max(axis=2)
+    counts = np.sum(tstats >= tstat[None], axis=0)
+    max_masses = np.zeros(max_tstats.shape)
+    for perm in range(tstats.shape[0]):
+        for con in range(tstats.shape[1]):
+            masses = cluster_masses(store, tstats[perm, con], cluster_thresh,
+                                    adjacency)[1]
+            if masses.size:
+                max_masses[perm, con] = masses.max()
+    return max_tstats, max_masses, counts
+
+
+class GroupPermuteInputSpec(BaseInterfaceInputSpec):
+    store_file = File(exists=True, mandatory=True,
+                      desc='header (store.json) of a group store')
+    subjects = traits.List(traits.Str,
+                           desc='subjects, in the order of the design rows '
+                           '(default: all stored subjects)')
+    design_file = File(exists=True, desc='design matrix (design.mat; '
+                       'default: a one-sample test)')
+    t_con_file = File(exists=True, requires=['design_file'],
+                      desc='t contrasts (design.con; default: the first '
+                      'regressor)')
+    num_perm = traits.Int(5000, usedefault=True,
+                          desc='number of relabellings, including the '
+                          'observed labelling')
+    cluster_thresh = traits.Float(2.3, usedefault=True,
+                                  desc='t threshold forming the clusters')
+    hemi = traits.Enum('lh', 'rh',
+                       desc='form the clusters on this hemisphere of the '
+                       'target (surface stores)')
+    target = traits.Str('fsaverage', usedefault=True,
+                        desc='subject whose surface is stored')
+    subjects_dir = Directory(exists=True, desc='subjects directory')
+    seed = traits.Int(0, usedefault=True,
+                      desc='seed of the random relabellings')
+    batch_size = traits.Int(100, usedefault=True, nohash=True,
+                            desc='relabellings evaluated by each job')
+    num_processes = traits.Int(4, usedefault=True, nohash=True,
+                               desc='number of batches evaluated '
+                               'concurrently')
+
+
+class GroupPermuteOutputSpec(TraitedSpec):
+    tstat_files = OutputMultiPath(File(exists=True), desc='t statistics')
+    t_p_files = OutputMultiPath(File(exists=True),
+                                desc='1 - uncorrected p values')
+    t_corrected_p_files = OutputMultiPath(File(exists=True),
+                                          desc='1 - p values corrected by '
+                                          'the maximum t')
+    t_clustermass_corrected_p_files = OutputMultiPath(
+        File(exists=True), desc='1 - p values of the clusters, corrected by '
+        'the maximum cluster mass')
+
+
+class GroupPermute(BaseInterface):
+    """Permutation inference on the subjects of a group store
+
+    Replaces running ``randomise`` on a merged stack, with voxelwise
+    maximum-t and cluster-mass (``-C``) correction. Outputs of contrast
+    ``k`` are named ``tstat<k>``, ``vox_p_tstat<k>``, ``vox_corrp_tstat<k>``
+    and ``clusterm_corrp_tstat<k>``, as those of ``randomise``.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.permute import GroupPermute
+    >>> permute = GroupPermute(num_perm=10000, num_processes=64)
+    >>> permute.inputs.store_file = '/data/group/cope1/store.json'
+    >>> permute.run() # doctest: +SKIP
+    """
+
+    input_spec = GroupPermuteInputSpec
+    output_spec = GroupPermuteOutputSpec
+
+    def _adjacency(self):
+        if not isdefined(self.inputs.hemi):
+            return None
+        subjects_dir = os.environ.get('SUBJECTS_DIR')
+        if isdefined(self.inputs.subjects_dir):
+            subjects_dir = self.inputs.subjects_dir
+        coords, faces = nbfs.read_geometry(
+            os.path.join(subjects_dir, self.inputs.target, 'surf',
+                         self.inputs.hemi + '.white'))
+        return adjacency_matrix(faces, coords.shape[0])
+
+    def _run_interface(self, runtime):
+        store = GroupStore(os.path.dirname(self.inputs.store_file))
+        subjects = None
+        if isdefined(self.inputs.subjects):
+            subjects = self.inputs.subjects
+        nsubjects = len(store.rows(subjects))
+        X = np.ones((nsubjects, 1))
+        if isdefined(self.inputs.design_file):
+            X = read_vest(self.inputs.design_file)[0]
+        C = np.eye(1, X.shape[1])
+        if isdefined(self.inputs.t_con_file):
+            C = read_vest(self.inputs.t_con_file)[0]
+        if X.shape[0] != nsubjects:
+            raise ValueError('The design has %d rows for %d subjects' %
+                             (X.shape[0], nsubjects))
+        sign_flip = X.shape[1] == 1 and np.all(X == X[0, 0])
+        adjacency = self._adjacency()
+        thresh = self.inputs.cluster_thresh
+        # the observed labelling is the first member of every null
+        # distribution
+        identity = [np.ones(nsubjects) if sign_flip else np.arange(nsubjects)]
+        tstat = store_tstats(store, subjects, X, C, identity, sign_flip)[0]
+        observed = [cluster_masses(store, values, thresh, adjacency)
+                    for values in tstat]
+        max_tstats = [tstat.max(axis=1)]
+        max_masses = [np.array([masses.max() if masses.size else 0.
+                                for _, masses in observed])]
+        counts = np.ones(tstat.shape)
+        rng = np.random.RandomState(self.inputs.seed)
+        nperms = self.inputs.num_perm - 1
+        pool = ProcessPoolExecutor(max(1, self.inputs.num_processes))
+        try:
+            jobs = []
+            for start in range(0, nperms, self.inputs.batch_size):
+                size = min(self.inputs.batch_size, nperms - start)
+                if sign_flip:
+                    relabellings = rng.choice([-1., 1.],
+                                              size=(size, nsubjects))
+                else:
+                    relabellings = np.array([rng.permutation(nsubjects)
+                                             for _ in range(size)])
+                jobs.append(pool.submit(permutation_batch, store.store_dir,
+                                        subjects, X, C, relabellings,
+                                        sign_flip, tstat, thresh, adjacency))
+            for job in jobs:
+                perm_tstats, perm_masses, perm_counts = job.result()
+                max_tstats.append(perm_tstats)
+                max_masses.append(perm_masses)
+                counts += perm_counts
+        finally:
+            pool.shutdown()
+        max_tstats = np.vstack(max_tstats)
+        max_masses = np.vstack(max_masses)
+        total = float(max_tstats.shape[0])
+        self._results = dict(tstat_files=[], t_p_files=[],
+                             t_corrected_p_files=[],
+                             t_clustermass_corrected_p_files=[])
+        for con in range(C.shape[0]):
+            null = np.sort(max_tstats[:, con])
+            corrp = np.searchsorted(null, tstat[con], side='left') / total
+            labels, masses = observed[con]
+            null = np.sort(max_masses[:, con])
+            clusterp = np.concatenate([
+                [0.], np.searchsorted(null, masses, side='left') / total])
+            for key, name, values in [
+                    ('tstat_files', 'tstat', tstat[con]),
+                    ('t_p_files', 'vox_p_tstat', 1 - counts[con] / total),
+                    ('t_corrected_p_files', 'vox_corrp_tstat', corrp),
+                    ('t_clustermass_corrected_p_files',
+                     'clusterm_corrp_tstat', clusterp[labels])]:
+                self._results[key].append(store.save(
+                    values, os.path.join(runtime.cwd,
+                                         '%s%d' % (name, con + 1))))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
@@ -12,16 +12,15 @@ import nipype.pipeline.engine as pe          # pypeline engine
 
 from nibabel import load
 
+from mindflows.gablab.branching import add_branch_select, resolve_branches
+from mindflows.gablab.imageio import (CompressingDataSink, ExtractVolume,
+                                      set_storage_policy)
+from mindflows.gablab.intensitynorm import IntensityNorm, TemporalStats
+from mindflows.gablab.motion import MotionPlots
+from mindflows.gablab.tempfilt import TemporalFilter
 
-warn('WORK IN PROGRESS. USE WITH CAUTION')
-
-
-"""
-Setup any package specific configuration. The output file format for FSL
-routines is being set to compressed NIFTI.
-"""
 
-fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+warn('WORK IN PROGRESS. USE WITH CAUTION')
 
 
 """
@@ -41,7 +40,7 @@ motion correction and smoothing operations.
 
 """
 
-def create_featpreproc(name='featpreproc'):
+def create_featpreproc(name='featpreproc', fused=False, fwhm=None):
     """Create a FEAT preprocessing workflow
     
     Parameters
@@ -54,14 +53,37 @@ def create_featpreproc(name='featpreproc'):
     subjectid : subjectid (used for storing output under subject's name
     subs : paths substitutions for datasink
 
+    The intensity statistics of the runs are computed in a single pass by
+    :class:`~mindflows.gablab.intensitynorm.TemporalStats`. If `fused` is
+    True, the runs are also masked in the same in-process node
+    (:class:`~mindflows.gablab.intensitynorm.IntensityNorm`) instead of by
+    ``fslmaths``.
+
+    If `fwhm` is given, it is set as the fwhm input and the branch of the
+    smoothed or unsmoothed data that is not selected is removed with
+    :func:`~mindflows.gablab.branching.resolve_branches`. Otherwise both
+    branches run unless the caller sets ``inputspec.fwhm`` and calls
+    ``resolve_branches`` on the workflow (or the workflow containing it)
+    before running it.
+
+    Nodes declare the cores (``n_procs``) and memory (``mem_gb``) they need
+    for a typical run; run the workflow with
+    :class:`~mindflows.gablab.scheduling.ThreadLimitedMultiProcPlugin` to
+    pack jobs onto cores without oversubscribing them.
+
+    Creating the workflow sets the default FSL output type to uncompressed
+    NIFTI (:func:`~mindflows.gablab.imageio.set_storage_policy`), which the
+    nodes can memory-map; the datasink compresses what it stores. The
+    default applies to every FSL interface created afterwards in the
+    process.
+
     Example
     -------
 
     >>> from mindflows.gablab.preproc_schemes import create_featpreproc
     >>> import os
-    >>> preproc = create_featpreproc()
+    >>> preproc = create_featpreproc(fwhm=5)
     >>> preproc.inputs.inputspec.func = 'f3.nii'
-    >>> preproc.inputs.inputspec.fwhm = 5
     >>> preproc.inputs.inputspec.highpass = 128./(2*2.5)
     >>> preproc.inputs.inputspec.outdir = os.path.abspath('l1out')
     >>> preproc.inputs.inputspec.subjectid = 's1'
@@ -71,6 +93,7 @@ def create_featpreproc(name='featpreproc'):
     
     """
     
+    set_storage_policy()
     featpreproc = pe.Workflow(name=name)
 
     """
@@ -90,7 +113,7 @@ def create_featpreproc(name='featpreproc'):
     Create a datasink 
     """
     
-    datasink = pe.Node(interface=nio.DataSink(),
+    datasink = pe.Node(interface=CompressingDataSink(),
                        name='datasink')
     featpreproc.connect(inputnode, 'outdir', datasink, 'base_directory')
     featpreproc.connect(inputnode, 'subjectid', datasink, 'container')
@@ -110,12 +133,13 @@ def create_featpreproc(name='featpreproc'):
     featpreproc.connect(inputnode, 'func', img2float, 'in_file')
 
     """
-    Extract the first volume of the first run as the reference
+    Extract the first volume of the first run as the reference. Only the
+    bytes of that volume are read, straight from the original run, so this does
+    not wait for the float conversion.
     """
 
-    extract_ref = pe.Node(interface=fsl.ExtractROI(t_size=1,
-                                                   t_min=0),
-                          name = 'extractref')
+    extract_ref = pe.Node(interface=ExtractVolume(t_min=0),
+                          name='extractref')
 
     """
     Define a function to pick the first file from a list of files
@@ -127,7 +151,7 @@ def create_featpreproc(name='featpreproc'):
         else:
             return files
 
-    featpreproc.connect(img2float, ('out_file', pickfirst), extract_ref, 'in_file')
+    featpreproc.connect(inputnode, ('func', pickfirst), extract_ref, 'in_file')
     featpreproc.connect(extract_ref, 'roi_file', datasink, 'reference')
 
     """
@@ -137,22 +161,24 @@ def create_featpreproc(name='featpreproc'):
     motion_correct = pe.MapNode(interface=fsl.MCFLIRT(save_mats = True,
                                                       save_plots = True),
                                 name='realign',
-                                iterfield = ['in_file'])
+                                iterfield = ['in_file'],
+                                n_procs=1, mem_gb=1.5)
     featpreproc.connect(img2float, 'out_file', motion_correct, 'in_file')
     featpreproc.connect(extract_ref, 'roi_file', motion_correct, 'ref_file')
     featpreproc.connect(motion_correct, 'par_file', datasink, 'motion.parameters')
     featpreproc.connect(motion_correct, 'out_file', datasink, 'motion.realigned')
 
     """
-    Plot the estimated motion parameters
+    Plot the estimated motion parameters and compute the framewise displacement
+    of all runs in a single node
     """
 
-    plot_motion = pe.MapNode(interface=fsl.PlotMotionParams(in_source='fsl'),
-                            name='plot_motion',
-                            iterfield=['in_file'])
-    plot_motion.iterables = ('plot_type', ['rotations', 'translations'])
-    featpreproc.connect(motion_correct, 'par_file', plot_motion, 'in_file')
+    plot_motion = pe.Node(interface=MotionPlots(in_source='fsl'),
+                          name='plot_motion')
+    featpreproc.connect(motion_correct, 'par_file', plot_motion, 'in_files')
     featpreproc.connect(plot_motion, 'out_file', datasink, 'motion.plots')
+    featpreproc.connect(plot_motion, 'fd_files', datasink, 'motion.displacement')
+    featpreproc.connect(plot_motion, 'summary_file', datasink, 'motion.displacement.@summary')
 
     """
     Extract the mean volume of the first functional run
@@ -173,85 +199,48 @@ def create_featpreproc(name='featpreproc'):
                            name = 'meanfuncmask')
     featpreproc.connect(meanfunc, 'out_file', meanfuncmask, 'in_file')
 
-    """
-    Mask the functional runs with the extracted mask
-    """
-
-    maskfunc = pe.MapNode(interface=fsl.ImageMaths(suffix='_bet',
-                                                   op_string='-mas'),
-                          iterfield=['in_file'],
-                          name = 'maskfunc')
-    featpreproc.connect(motion_correct, 'out_file', maskfunc, 'in_file')
-    featpreproc.connect(meanfuncmask, 'mask_file', maskfunc, 'in_file2')
-
-
-    """
-    Determine the 2nd and 98th percentile intensities of each functional run
-    """
-
-    getthresh = pe.MapNode(interface=fsl.ImageStats(op_string='-p 2 -p 98'),
-                           iterfield = ['in_file'],
-                           name='getthreshold')
-    featpreproc.connect(maskfunc, 'out_file', getthresh, 'in_file')
-
-
-    """
-    Threshold the first run of the functional data at 10% of the 98th percentile
-    """
-
-    threshold = pe.Node(interface=fsl.ImageMaths(out_data_type='char',
-                                                 suffix='_thresh'),
-                           name='threshold')
-    featpreproc.connect(maskfunc, ('out_file', pickfirst), threshold, 'in_file')
-
-    """
-    Define a function to get 10% of the intensity
-    """
-
-    def getthreshop(thresh):
-        return '-thr %.10f -Tmin -bin'%(0.1*thresh[0][1])
-    featpreproc.connect(getthresh, ('out_stat', getthreshop), threshold, 'op_string')
-
-    """
-    Determine the median value of the functional runs using the mask
-    """
-
-    medianval = pe.MapNode(interface=fsl.ImageStats(op_string='-k %s -p 50'),
-                           iterfield = ['in_file'],
-                           name='medianval')
-    featpreproc.connect(motion_correct, 'out_file', medianval, 'in_file')
-    featpreproc.connect(threshold, 'out_file', medianval, 'mask_file')
-
-    """
-    Dilate the mask
-    """
-
-    dilatemask = pe.Node(interface=fsl.ImageMaths(suffix='_dil',
-                                                  op_string='-dilF'),
-                           name='dilatemask')
-    featpreproc.connect(threshold, 'out_file', dilatemask, 'in_file')
-    featpreproc.connect(dilatemask, 'out_file', datasink, 'mask')
-
-    """
-    Mask the motion corrected functional runs with the dilated mask
-    """
-
-    maskfunc2 = pe.MapNode(interface=fsl.ImageMaths(suffix='_mask',
-                                                    op_string='-mas'),
-                          iterfield=['in_file'],
-                          name='maskfunc2')
-    featpreproc.connect(motion_correct, 'out_file', maskfunc2, 'in_file')
-    featpreproc.connect(dilatemask, 'out_file', maskfunc2, 'in_file2')
-
-    """
-    Determine the mean image from each functional run
-    """
-
-    meanfunc2 = pe.MapNode(interface=fsl.ImageMaths(op_string='-Tmean',
-                                                    suffix='_mean'),
-                           iterfield=['in_file'],
-                           name='meanfunc2')
-    featpreproc.connect(maskfunc2, 'out_file', meanfunc2, 'in_file')
+    if fused:
+        """
+        Mask the runs, determine their robust intensity range and median
+        intensity, and create the dilated intensity mask in a single
+        in-process node that reads each run once
+        """
+
+        intensitynorm = pe.Node(interface=IntensityNorm(),
+                                name='intensitynorm', mem_gb=3)
+        featpreproc.connect(motion_correct, 'out_file', intensitynorm, 'in_files')
+        featpreproc.connect(meanfuncmask, 'mask_file', intensitynorm, 'mask_file')
+        maskedfunc = (intensitynorm, 'out_files')
+        dilatedmask = (intensitynorm, 'mask_file')
+        maskedmean = (intensitynorm, 'mean_files')
+        medianvals = (intensitynorm, 'median_values')
+    else:
+        """
+        Determine the robust intensity range and median intensity of each
+        run, the dilated intensity mask and the mean image of each run in a
+        single pass over each run
+        """
+
+        tempstats = pe.Node(interface=TemporalStats(), name='tempstats',
+                            mem_gb=2)
+        featpreproc.connect(motion_correct, 'out_file', tempstats, 'in_files')
+        featpreproc.connect(meanfuncmask, 'mask_file', tempstats, 'mask_file')
+
+        """
+        Mask the motion corrected functional runs with the dilated mask
+        """
+
+        maskfunc2 = pe.MapNode(interface=fsl.ImageMaths(suffix='_mask',
+                                                        op_string='-mas'),
+                              iterfield=['in_file'],
+                              name='maskfunc2')
+        featpreproc.connect(motion_correct, 'out_file', maskfunc2, 'in_file')
+        featpreproc.connect(tempstats, 'mask_file', maskfunc2, 'in_file2')
+        maskedfunc = (maskfunc2, 'out_file')
+        dilatedmask = (tempstats, 'mask_file')
+        maskedmean = (tempstats, 'mean_files')
+        medianvals = (tempstats, 'median_values')
+    featpreproc.connect(dilatedmask[0], dilatedmask[1], datasink, 'mask')
 
     """
     Merge the median values with the mean functional images into a coupled list
@@ -259,8 +248,8 @@ def create_featpreproc(name='featpreproc'):
 
     mergenode = pe.Node(interface=util.Merge(2, axis='hstack'),
                         name='merge')
-    featpreproc.connect(meanfunc2,'out_file', mergenode, 'in1')
-    featpreproc.connect(medianval,'out_stat', mergenode, 'in2')
+    featpreproc.connect(maskedmean[0], maskedmean[1], mergenode, 'in1')
+    featpreproc.connect(medianvals[0], medianvals[1], mergenode, 'in2')
 
 
     """
@@ -271,7 +260,7 @@ def create_featpreproc(name='featpreproc'):
 
     smooth = pe.MapNode(interface=fsl.SUSAN(),
                         iterfield=['in_file', 'brightness_threshold','usans'],
-                        name='smooth')
+                        name='smooth', n_procs=1, mem_gb=1.5)
 
     """
     Define a function to get the brightness threshold for SUSAN
@@ -280,8 +269,8 @@ def create_featpreproc(name='featpreproc'):
     def getbtthresh(medianvals):
         return [0.75*val for val in medianvals]
     featpreproc.connect(inputnode, 'fwhm', smooth, 'fwhm')
-    featpreproc.connect(maskfunc2, 'out_file', smooth, 'in_file')
-    featpreproc.connect(medianval, ('out_stat', getbtthresh), smooth, 'brightness_threshold')
+    featpreproc.connect(maskedfunc[0], maskedfunc[1], smooth, 'in_file')
+    featpreproc.connect(medianvals[0], (medianvals[1], getbtthresh), smooth, 'brightness_threshold')
     featpreproc.connect(mergenode, ('out', lambda x: [[tuple([val[0],0.75*val[1]])] for val in x]), smooth, 'usans')
 
     """
@@ -293,23 +282,16 @@ def create_featpreproc(name='featpreproc'):
                           iterfield=['in_file'],
                           name='maskfunc3')
     featpreproc.connect(smooth, 'smoothed_file', maskfunc3, 'in_file')
-    featpreproc.connect(dilatemask, 'out_file', maskfunc3, 'in_file2')
-
+    featpreproc.connect(dilatedmask[0], dilatedmask[1], maskfunc3, 'in_file2')
 
-    concatnode = pe.Node(interface=util.Merge(2),
-                         name='concat')
-    featpreproc.connect(maskfunc2,('out_file', lambda x:[x]), concatnode, 'in1')
-    featpreproc.connect(maskfunc3,('out_file', lambda x:[x]), concatnode, 'in2')
 
     """
     The following nodes select smooth or unsmoothed data depending on the
     fwhm. This is because SUSAN defaults to smoothing the data with about the
     voxel size of the input data if the fwhm parameter is less than 1/3 of the
-    voxel size.
+    voxel size. When `fwhm` is given, `resolve_branches` removes the
+    unselected branch from the workflow at the end of this function.
     """
-    selectnode = pe.Node(interface=util.Select(),name='select')
-
-    featpreproc.connect(concatnode, 'out', selectnode, 'inlist')
 
     def chooseindex(fwhm):
         if fwhm<1:
@@ -317,49 +299,29 @@ def create_featpreproc(name='featpreproc'):
         else:
             return [1]
 
-    featpreproc.connect(inputnode, ('fwhm', chooseindex), selectnode, 'index')
+    selectnode = add_branch_select(featpreproc,
+                                   [maskedfunc, (maskfunc3, 'out_file')],
+                                   (inputnode, 'fwhm'), chooseindex)
     featpreproc.connect(selectnode, 'out', datasink, 'smoothed')
 
 
     """
-    Scale the median value of the run is set to 10000
-    """
-
-    meanscale = pe.MapNode(interface=fsl.ImageMaths(suffix='_gms'),
-                          iterfield=['in_file','op_string'],
-                          name='meanscale')
-    featpreproc.connect(selectnode, 'out', meanscale, 'in_file')
-
-    """
-    Define a function to get the scaling factor for intensity normalization
+    Scale the runs so that their median value is 10000, perform temporal
+    highpass filtering on the data and generate a mean functional image from
+    the first run, all in a single multi-threaded pass
     """
 
-    def getmeanscale(medianvals):
-        return ['-mul %.10f'%(10000./val) for val in medianvals]
-    featpreproc.connect(medianval, ('out_stat', getmeanscale), meanscale, 'op_string')
-
-    """
-    Perform temporal highpass filtering on the data
-    """
-
-    highpass = pe.MapNode(interface=fsl.ImageMaths(suffix='_tempfilt'),
-                          iterfield=['in_file'],
-                          name='highpass')
-    featpreproc.connect(inputnode, ('highpass', lambda x:'-bptf %.10f -1'%x), highpass, 'op_string')
-    featpreproc.connect(meanscale, 'out_file', highpass, 'in_file')
+    highpass = pe.Node(interface=TemporalFilter(), name='highpass',
+                       n_procs=4, mem_gb=3)
+    featpreproc.connect(inputnode, 'highpass', highpass, 'highpass_sigma')
+    featpreproc.connect(selectnode, 'out', highpass, 'in_files')
+    featpreproc.connect(medianvals[0], medianvals[1], highpass, 'median_values')
     featpreproc.connect(highpass, 'out_file', datasink, 'highpassed')
+    featpreproc.connect(highpass, 'mean_file', datasink, 'mean')
 
-    """
-    Generate a mean functional image from the first run
-    """
-
-    meanfunc3 = pe.MapNode(interface=fsl.ImageMaths(op_string='-Tmean',
-                                                    suffix='_mean'),
-                           iterfield=['in_file'],
-                          name='meanfunc3')
-    featpreproc.connect(highpass, ('out_file', pickfirst), meanfunc3, 'in_file')
-    featpreproc.connect(meanfunc3, 'out_file', datasink, 'mean')
-
+    if fwhm is not None:
+        inputnode.inputs.fwhm = fwhm
+        resolve_branches(featpreproc)
     
     return featpreproc
 
@@ -385,7 +347,7 @@ def create_spmpreproc1(name='spmpreproc'):
     Create a datasink 
     """
     
-    datasink = pe.Node(interface=nio.DataSink(),
+    datasink = pe.Node(interface=CompressingDataSink(),
                        name='datasink')
     preproc.connect(inputnode, 'outdir', datasink, 'base_directory')
     preproc.connect(inputnode, 'subjectid', datasink, 'container')
@@ -403,15 +365,16 @@ def create_spmpreproc1(name='spmpreproc'):
     preproc.connect(realign, 'realignment_parameters', datasink, 'motion.parameters')
 
     """
-    Plot the estimated motion parameters
+    Plot the estimated motion parameters and compute the framewise displacement
+    of all runs in a single node
     """
 
-    plot_motion = pe.MapNode(interface=fsl.PlotMotionParams(in_source='spm'),
-                            name='plot_motion',
-                            iterfield=['in_file'])
-    plot_motion.iterables = ('plot_type', ['rotations', 'translations'])
-    preproc.connect(realign, 'realignment_parameters', plot_motion, 'in_file')
+    plot_motion = pe.Node(interface=MotionPlots(in_source='spm'),
+                          name='plot_motion')
+    preproc.connect(realign, 'realignment_parameters', plot_motion, 'in_files')
     preproc.connect(plot_motion, 'out_file', datasink, 'motion.plots')
+    preproc.connect(plot_motion, 'fd_files', datasink, 'motion.displacement')
+    preproc.connect(plot_motion, 'summary_file', datasink, 'motion.displacement.@summary')
     
     """
     Smooth the functional data using :class:`nipype.interfaces.spm.Smooth`.
@@ -445,7 +408,7 @@ def create_spmpreproc2(name='spmpreproc'):
     Create a datasink 
     """
     
-    datasink = pe.Node(interface=nio.DataSink(),
+    datasink = pe.Node(interface=CompressingDataSink(),
                        name='datasink')
     preproc.connect(inputnode, 'outdir', datasink, 'base_directory')
     preproc.connect(inputnode, 'subjectid', datasink, 'container')
@@ -462,15 +425,16 @@ def create_spmpreproc2(name='spmpreproc'):
     preproc.connect(realign, 'realignment_parameters', datasink, 'motion.parameters')
 
     """
-    Plot the estimated motion parameters
+    Plot the estimated motion parameters and compute the framewise displacement
+    of all runs in a single node
     """
 
-    plot_motion = pe.MapNode(interface=fsl.PlotMotionParams(in_source='spm'),
-                            name='plot_motion',
-                            iterfield=['in_file'])
-    plot_motion.iterables = ('plot_type', ['rotations', 'translations'])
-    preproc.connect(realign, 'realignment_parameters', plot_motion, 'in_file')
+    plot_motion = pe.Node(interface=MotionPlots(in_source='spm'),
+                          name='plot_motion')
+    preproc.connect(realign, 'realignment_parameters', plot_motion, 'in_files')
     preproc.connect(plot_motion, 'out_file', datasink, 'motion.plots')
+    preproc.connect(plot_motion, 'fd_files', datasink, 'motion.displacement')
+    preproc.connect(plot_motion, 'summary_file', datasink, 'motion.displacement.@summary')
     
     """
     Use :class:`nipype.interfaces.spm.Coregister` to perform a rigid body
@@ -535,7 +499,7 @@ def create_spmpreproc3(name='spmpreproc'):
     Create a datasink 
     """
     
-    datasink = pe.Node(interface=nio.DataSink(),
+    datasink = pe.Node(interface=CompressingDataSink(),
                        name='datasink')
     preproc.connect(inputnode, 'outdir', datasink, 'base_directory')
     preproc.connect(inputnode, 'subjectid', datasink, 'container')
@@ -0,0 +1,201 @@
+"""
+Statistics reports
+------------------
+
+Report images were made by ``fsl.Overlay`` followed by ``fsl.Slicer``, two
+processes (and an intermediate image) for every statistic image of every
+subject. :class:`StatReport` composites the thresholded statistics onto the
+background in-process, draws an axial mosaic of each statistic image from a
+pool of threads, and writes all of them into a single HTML page.
+
+The rendering follows ``overlay`` and ``slicer``: the background is shown in
+grey between robust intensity limits, positive statistics from red to
+yellow and negative ones from blue to light blue between the two statistic
+thresholds. Statistic images on another grid than the background are
+resampled to it through their affines.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os                                    # system functions
+
+import numpy as np
+from scipy import ndimage
+
+import nibabel as nb
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits)
+from nipype.utils.filemanip import split_filename
+
+
+def resample_to(img, ref_img):
+    """Return the data of `img` sampled (trilinear) on the grid of `ref_img`
+    """
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    while data.ndim > 3:
+        data = data[..., 0]
+    if data.shape == ref_img.shape[:3] and np.allclose(img.affine,
+                                                        ref_img.affine):
+        return data
+    vox2vox = np.dot(np.linalg.inv(img.affine), ref_img.affine)
+    return ndimage.affine_transform(data, vox2vox[:3, :3], vox2vox[:3, 3],
+                                    output_shape=ref_img.shape[:3], order=1,
+                                    mode='constant', cval=0.)
+
+
+def overlay_rgb(background, stat, stat_thresh=(2.3, 5.), show_negative=True,
+                auto_thresh_bg=True):
+    """Return an RGB volume of thresholded statistics over a background
+    """
+    background = np.asarray(background, dtype=np.float64)
+    if auto_thresh_bg and np.any(background > 0):
+        low, high = np.percentile(background[background > 0], [2, 98])
+    else:
+        low, high = background.min(), background.max()
+    grey = np.clip((background - low) / max(high - low, 1e-12), 0, 1)
+    rgb = np.repeat(grey[..., None], 3, axis=-1)
+    tmin, tmax = stat_thresh
+    scale = max(tmax - tmin, 1e-12)
+    signs = [(1, [1., None, 0.])]
+    if show_negative:
+        signs.append((-1, [0., None, 1.]))
+    for sign, color in signs:
+        values = sign * stat
+        shown = values >= tmin
+        frac = np.clip((values[shown] - tmin) / scale, 0, 1)
+        rgb[shown] = np.column_stack([frac if val is None else
+                                      np.repeat(val, frac.size)
+                                      for val in color])
+    return rgb
+
+
+def axial_mosaic(rgb, mask=None, width=750):
+    """Tile the axial slices of an RGB volume into one image
+
+    Slices without any voxel in `mask` are skipped; the mosaic is enlarged
+    by an integer factor to approach `width` pixels.
+    """
+    slices = range(rgb.shape[2])
+    if mask is not None:
+        slices = [idx for idx in slices if np.any(mask[:, :, idx])] or \
+            list(range(rgb.shape[2]))
+    tiles = [np.rot90(rgb[:, :, idx]) for idx in slices]
+    height, tilewidth = tiles[0].shape[:2]
+    ncols = max(1, min(len(tiles), width // max(tilewidth, 1)))
+    nrows = int(np.ceil(len(tiles) / float(ncols)))
+    mosaic = np.zeros((nrows * height, ncols * tilewidth, 3))
+    for idx, tile in enumerate(tiles):
+        row, col = divmod(idx, ncols)
+        mosaic[row * height:(row + 1) * height,
+               col * tilewidth:(col + 1) * tilewidth] = tile
+    factor = max(1, width // mosaic.shape[1])
+    if factor > 1:
+        mosaic = np.repeat(np.repeat(mosaic, factor, axis=0), factor, axis=1)
+    return mosaic
+
+
+def render_stat(stat_file, bg_img, background, out_file, stat_thresh=(2.3, 5.),
+                show_negative=True, auto_thresh_bg=True, width=750):
+    """Write the report image of one statistic image
+    """
+    from matplotlib.image import imsave
+    stat = resample_to(nb.load(stat_file), bg_img)
+    rgb = overlay_rgb(background, stat, stat_thresh, show_negative,
+                      auto_thresh_bg)
+    imsave(out_file, axial_mosaic(rgb, background > 0, width))
+    return out_file
+
+
+def write_html(out_file, title, entries):
+    """Write an HTML page showing images with their captions
+    """
+    fp = open(out_file, 'wt')
+    fp.write('<html>\n<head><title>%s</title></head>\n<body>\n'
+             '<h1>%s</h1>\n' % (title, title))
+    for caption, image in entries:
+        fp.write('<h2>%s</h2>\n<img src="%s" alt="%s"/>\n' %
+                 (caption, os.path.basename(image), caption))
+    fp.write('</body>\n</html>\n')
+    fp.close()
+    return out_file
+
+
+class StatReportInputSpec(BaseInterfaceInputSpec):
+    stat_images = InputMultiPath(File(exists=True), mandatory=True,
+                                 desc='statistic images to show')
+    background_image = File(exists=True, mandatory=True,
+                            desc='image shown behind the statistics')
+    stat_thresh = traits.Tuple((2.3, 5.), traits.Float, traits.Float,
+                               usedefault=True,
+                               desc='statistic values shown with the lowest '
+                               'and highest colors')
+    show_negative_stats = traits.Bool(True, usedefault=True,
+                                      desc='show negative statistics')
+    auto_thresh_bg = traits.Bool(True, usedefault=True,
+                                 desc='use robust background limits')
+    image_width = traits.Int(750, usedefault=True,
+                             desc='approximate width of the mosaics (pixels)')
+    title = traits.Str('Statistics', usedefault=True,
+                       desc='title of the report')
+    num_threads = traits.Int(4, usedefault=True, nohash=True,
+                             desc='number of images rendered concurrently')
+
+
+class StatReportOutputSpec(TraitedSpec):
+    out_files = OutputMultiPath(File(exists=True),
+                                desc='mosaic of each statistic image')
+    report_file = File(exists=True, desc='HTML page with all the mosaics')
+
+
+class StatReport(BaseInterface):
+    """Render thresholded statistics over a background into one report
+
+    Replaces ``fsl.Overlay`` and ``fsl.Slicer`` MapNodes.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.report import StatReport
+    >>> report = StatReport(stat_thresh=(2.5, 5))
+    >>> report.inputs.background_image = 'T1.nii'
+    >>> report.inputs.stat_images = ['zstat1.nii', 'zstat2.nii']
+    >>> report.run() # doctest: +SKIP
+    """
+
+    input_spec = StatReportInputSpec
+    output_spec = StatReportOutputSpec
+
+    def _run_interface(self, runtime):
+        bg_img = nb.load(self.inputs.background_image)
+        background = resample_to(bg_img, bg_img)
+        names = []
+        out_files = []
+        for idx, fname in enumerate(self.inputs.stat_images):
+            _, base, _ = split_filename(fname)
+            names.append(base)
+            out_files.append(os.path.join(runtime.cwd,
+                                          '%03d_%s.png' % (idx, base)))
+        pool = ThreadPoolExecutor(max(1, self.inputs.num_threads))
+        try:
+            jobs = [pool.submit(render_stat, fname, bg_img, background,
+                                out_file, self.inputs.stat_thresh,
+                                self.inputs.show_negative_stats,
+                                self.inputs.auto_thresh_bg,
+                                self.inputs.image_width)
+                    for fname, out_file in zip(self.inputs.stat_images,
+                                               out_files)]
+            self._out_files = [job.result() for job in jobs]
+        finally:
+            pool.shutdown()
+        self._report_file = write_html(os.path.join(runtime.cwd,
+                                                    'report.html'),
+                                       self.inputs.title,
+                                       list(zip(names, self._out_files)))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_files'] = self._out_files
+        outputs['report_file'] = self._report_file
+        return outputs
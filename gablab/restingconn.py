@@ -1,9 +1,12 @@
 # Import processing relevant modules
-import nipype.algorithms.rapidart as ra      # artifact detection
 import nipype.interfaces.spm as spm          # spm
 import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
 
+from mindflows.gablab.artifact import ArtifactDetect
+from mindflows.gablab.connectivity import ROIConnectivity
+from mindflows.gablab.resultstore import share_results
+
 #import nipype.interfaces.fsl as fsl          # fsl
 
 
@@ -32,12 +35,12 @@ and register all images to the mean image.
 realign = pe.Node(interface=spm.Realign(), name="realign")
 realign.inputs.register_to_mean = True
 
-"""Use :class:`nipype.algorithms.rapidart` to determine which of the
-images in the functional series are outliers based on deviations in
+"""Use :class:`mindflows.gablab.artifact.ArtifactDetect` to determine which
+of the images in the functional series are outliers based on deviations in
 intensity or movement.
 """
 
-art = pe.Node(interface=ra.ArtifactDetect(), name="art")
+art = pe.Node(interface=ArtifactDetect(), name="art")
 art.inputs.use_differences      = [False,True]
 art.inputs.use_norm             = True
 art.inputs.norm_threshold       = 0.5
@@ -61,6 +64,7 @@ segment = pe.Node(interface=spm.Segment(), name='segment')
 segment.inputs.gm_output_type = [True, True, True]
 segment.inputs.wm_output_type = [True, True, False]
 segment.inputs.csf_output_type = [True, True, False]
+share_results(segment)
 
 """Warp functional and structural data to SPM's T1 template using
 :class:`nipype.interfaces.spm.Normalize`.  The tutorial data set
@@ -82,6 +86,13 @@ roinormalize.inputs.write_interp = 0 # do nearest neighbor interpolation
 """
 
 smooth = pe.Node(interface=spm.Smooth(), name = "smooth")
+
+"""Use :class:`mindflows.gablab.connectivity.ROIConnectivity` to average
+the smoothed data within each ROI of the normalized atlas, drop the
+outliers found by art and correlate the ROI time series.
+"""
+
+connectivity = pe.Node(interface=ROIConnectivity(), name = "connectivity")
                  
 restpreproc.connect([(slicetimecorrect, realign,[('timecorrected_files','in_files')]),
                  (realign,coregister,[('mean_image', 'source'),
@@ -93,6 +104,9 @@ restpreproc.connect([(slicetimecorrect, realign,[('timecorrected_files','in_file
                  (normalize, smooth, [('normalized_files', 'in_files')]),
                  (realign,art,[('realignment_parameters','realignment_parameters')]),
                  (normalize,art,[('normalized_files','realigned_files')]),
+                 (smooth,connectivity,[('smoothed_files','in_files')]),
+                 (roinormalize,connectivity,[('normalized_files','label_file')]),
+                 (art,connectivity,[('outlier_files','outlier_files')]),
                  ])
 
 coregister2 = pe.Node(interface=spm.Coregister(), name="coregister")
@@ -0,0 +1,277 @@
+"""
+Shared result store
+-------------------
+
+Registration and segmentation nodes (``fnirt``, ``regstruct``,
+``surfregister``, SPM ``segment``) depend only on the subject's images, but
+every analysis that imports the workflows recomputes them in its own working
+directory: nipype's cache is keyed on input paths.
+
+:func:`share_results` makes a node look up its outputs in a store shared by
+all analyses before running. Results are keyed on the interface and the
+*content* of its input files, so the same anatomy reaches the same entry
+from any working directory. On a hit the stored files are copied into the
+node's directory under the names the interface would have written; on a
+miss the interface runs and its outputs are added to the store. Writers
+hold an exclusive lock on the entry while they compute it, so concurrent
+runs of the same node compute it once, and entries are published with an
+atomic rename, so readers never see a partial entry.
+
+Example
+-------
+
+>>> from mindflows.gablab.resultstore import share_results
+>>> share_results(fnirt, '/shared/results') # doctest: +SKIP
+"""
+
+import copyreg
+import hashlib
+import json
+import os                                    # system functions
+import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from nipype import logging
+from nipype.interfaces.base import isdefined
+
+iflogger = logging.getLogger('nipype.interface')
+
+
+default_store_dir = os.path.join('~', '.mindflows', 'results')
+
+_file_marker = '__file__'
+
+
+def _file_sha1(fname, blocksize=1024 * 1024):
+    sha = hashlib.sha1()
+    fp = open(fname, 'rb')
+    try:
+        block = fp.read(blocksize)
+        while block:
+            sha.update(block)
+            block = fp.read(blocksize)
+    finally:
+        fp.close()
+    return sha.hexdigest()
+
+
+def _content_value(value):
+    """Replace the absolute paths of existing files in `value` by the sha1
+    of their content
+
+    Directories, such as a FreeSurfer subjects directory, are keyed on their
+    path.
+    """
+    if isinstance(value, (list, tuple)):
+        return [_content_value(val) for val in value]
+    if isinstance(value, dict):
+        return dict([(key, _content_value(val))
+                     for key, val in value.items()])
+    if isinstance(value, str) and os.path.isabs(value) and \
+            os.path.isfile(value):
+        return {_file_marker: _file_sha1(value)}
+    return value
+
+
+def content_key(interface):
+    """Return the key of an interface's results in the store
+
+    Derived from the interface class and its hashed inputs, with input files
+    identified by their content instead of their path.
+    """
+    inputs = {}
+    for name, value in interface.inputs.get_traitsfree().items():
+        if interface.inputs.trait(name).nohash:
+            continue
+        inputs[name] = _content_value(value)
+    base = getattr(interface, '_stored_base', interface.__class__)
+    desc = json.dumps(['%s.%s' % (base.__module__, base.__name__), inputs],
+                      sort_keys=True, default=str)
+    return hashlib.sha1(desc.encode()).hexdigest()
+
+
+class ResultStore(object):
+    """Directory of interface results keyed by :func:`content_key`
+
+    Each entry is a directory with the output files and a ``manifest.json``
+    recording the outputs.
+    """
+
+    def __init__(self, store_dir=None):
+        if store_dir is None:
+            store_dir = os.environ.get('MINDFLOWS_RESULT_STORE',
+                                       default_store_dir)
+        self.store_dir = os.path.abspath(os.path.expanduser(store_dir))
+
+    def entry(self, key):
+        return os.path.join(self.store_dir, key[:2], key)
+
+    def manifest(self, key):
+        """Return the stored outputs of `key` or None
+        """
+        fname = os.path.join(self.entry(key), 'manifest.json')
+        if not os.path.exists(fname):
+            return None
+        fp = open(fname)
+        manifest = json.load(fp)
+        fp.close()
+        return manifest
+
+    def lock(self, key):
+        """Acquire the exclusive lock of an entry; returns the lock file
+        """
+        lockdir = os.path.join(self.store_dir, key[:2])
+        if not os.path.exists(lockdir):
+            try:
+                os.makedirs(lockdir)
+            except OSError:
+                pass
+        fp = open(os.path.join(lockdir, key + '.lock'), 'a')
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        return fp
+
+    def unlock(self, fp):
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+        fp.close()
+
+    def store(self, key, outputs):
+        """Copy the output files into a new entry and record the outputs
+        """
+        tmpdir = tempfile.mkdtemp(prefix='.' + key, dir=os.path.dirname(
+            self.entry(key)))
+        counter = [0]
+
+        def encode(value):
+            if isinstance(value, (list, tuple)):
+                return [encode(val) for val in value]
+            if isinstance(value, str) and os.path.isfile(value):
+                counter[0] += 1
+                relpath = os.path.join('%04d' % counter[0],
+                                       os.path.basename(value))
+                os.makedirs(os.path.join(tmpdir, os.path.dirname(relpath)))
+                shutil.copy2(value, os.path.join(tmpdir, relpath))
+                return {_file_marker: relpath}
+            return value
+        try:
+            manifest = dict([(name, encode(value))
+                             for name, value in outputs.items()
+                             if isdefined(value)])
+            fp = open(os.path.join(tmpdir, 'manifest.json'), 'wt')
+            json.dump(manifest, fp, indent=1, sort_keys=True)
+            fp.close()
+            os.rename(tmpdir, self.entry(key))
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+
+    def retrieve(self, key, manifest, expected, cwd):
+        """Copy the files of an entry to the paths in `expected`
+
+        `expected` holds the outputs the interface lists for its current
+        inputs; files it does not name are copied into `cwd`.
+        """
+        entry = self.entry(key)
+
+        def decode(value, target):
+            if isinstance(value, list):
+                if not isinstance(target, (list, tuple)):
+                    target = [None] * len(value)
+                return [decode(val, tgt) for val, tgt in zip(value, target)]
+            if isinstance(value, dict) and _file_marker in value:
+                src = os.path.join(entry, value[_file_marker])
+                if not isinstance(target, str):
+                    target = os.path.join(cwd, os.path.basename(src))
+                if not os.path.exists(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                shutil.copy2(src, target)
+                return target
+            return value
+        for name, value in manifest.items():
+            decode(value, expected.get(name))
+
+
+class StoredResultsMixin(object):
+    """Run an interface through a :class:`ResultStore`
+
+    Mixed into the class of a node's interface by :func:`share_results`.
+    """
+
+    def run(self, *args, **kwargs):
+        store = ResultStore(self._result_store)
+        self._stored_key = content_key(self)
+        self._stored_hit = False
+        lock = store.lock(self._stored_key)
+        try:
+            return super(StoredResultsMixin, self).run(*args, **kwargs)
+        finally:
+            store.unlock(lock)
+
+    def _run_interface(self, runtime, *args, **kwargs):
+        store = ResultStore(self._result_store)
+        manifest = store.manifest(self._stored_key)
+        if manifest is None:
+            return super(StoredResultsMixin, self)._run_interface(runtime,
+                                                                  *args,
+                                                                  **kwargs)
+        store.retrieve(self._stored_key, manifest, self._list_outputs(),
+                       runtime.cwd)
+        self._stored_hit = True
+        runtime.returncode = 0
+        return runtime
+
+    def aggregate_outputs(self, runtime=None, needed_outputs=None):
+        outputs = super(StoredResultsMixin, self).aggregate_outputs(
+            runtime, needed_outputs)
+        if not self._stored_hit:
+            store = ResultStore(self._result_store)
+            if store.manifest(self._stored_key) is None:
+                try:
+                    store.store(self._stored_key, outputs.get())
+                except (OSError, TypeError, ValueError) as err:
+                    iflogger.warning('Could not store the results of %s: %s'
+                                     % (self.__class__.__name__, err))
+        return outputs
+
+
+class _StoredType(type):
+    """Type of the classes made by :func:`stored_class`; they are pickled
+    as a call to :func:`stored_class` with their base class
+    """
+
+
+def _reduce_stored_class(cls):
+    return (stored_class, (cls._stored_base,))
+
+copyreg.pickle(_StoredType, _reduce_stored_class)
+
+_stored_classes = {}
+
+
+def stored_class(cls):
+    """Return the subclass of `cls` that runs through the result store
+    """
+    if cls not in _stored_classes:
+        _stored_classes[cls] = _StoredType('Stored' + cls.__name__,
+                                           (StoredResultsMixin, cls),
+                                           {'_stored_base': cls})
+    return _stored_classes[cls]
+
+
+def share_results(node, store_dir=None):
+    """Make a node reuse results from a shared store
+
+    `store_dir` defaults to ``$MINDFLOWS_RESULT_STORE`` or
+    ``~/.mindflows/results``. Returns the node.
+    """
+    interface = node.interface
+    base = getattr(interface, '_stored_base', interface.__class__)
+    interface.__class__ = stored_class(base)
+    interface._result_store = store_dir
+    return node
@@ -0,0 +1,98 @@
+"""
+Core-aware scheduling
+---------------------
+
+Many of the tools run by the workflows (FSL, ANTs, numpy through its BLAS)
+start as many threads as there are cores. When ``MultiProc`` runs several
+of them at once, the machine is oversubscribed and throughput collapses.
+
+The workflow factories declare how many cores (``n_procs``) and how much
+memory (``mem_gb``) each node needs. :class:`ThreadLimitedMultiProcPlugin`
+packs jobs onto the available cores using these requirements, largest jobs
+first, and limits every job to the number of threads it was allocated: the
+thread-count environment variables of command-line tools are set, the
+``num_threads`` input of in-process interfaces is set and, if
+`threadpoolctl <https://github.com/joblib/threadpoolctl>`_ is installed, the
+BLAS thread pools of in-process jobs are limited as well.
+
+Example
+-------
+
+>>> from mindflows.gablab.scheduling import ThreadLimitedMultiProcPlugin
+>>> plugin = ThreadLimitedMultiProcPlugin(plugin_args={'n_procs': 32,
+...                                                    'memory_gb': 64})
+>>> l1pipeline.run(plugin=plugin) # doctest: +SKIP
+"""
+
+from nipype.interfaces.base import CommandLine
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin, run_node
+
+
+"""
+Environment variables read by the threaded libraries used by the tools
+"""
+
+thread_variables = ['OMP_NUM_THREADS',
+                    'MKL_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS',
+                    'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
+
+
+def limit_threads(node, nthreads=None):
+    """Limit the number of threads a node uses
+
+    Sets the thread-count environment variables of command-line interfaces
+    and the ``num_threads`` input of interfaces that have one. Defaults to
+    the number of cores the node requested (``n_procs``).
+    """
+    if nthreads is None:
+        nthreads = node.n_procs
+    nthreads = max(1, int(nthreads))
+    interface = node.interface
+    if isinstance(interface, CommandLine):
+        environ = dict(interface.inputs.environ)
+        environ.update(dict([(name, str(nthreads))
+                             for name in thread_variables]))
+        interface.inputs.environ = environ
+    if 'num_threads' in interface.inputs.copyable_trait_names():
+        interface.inputs.num_threads = nthreads
+    return node
+
+
+def run_node_limited(node, updatehash, taskid):
+    """Run a node in a worker with its BLAS thread pools limited
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return run_node(node, updatehash, taskid)
+    with threadpool_limits(limits=max(1, int(node.n_procs))):
+        return run_node(node, updatehash, taskid)
+
+
+class ThreadLimitedMultiProcPlugin(MultiProcPlugin):
+    """MultiProc plugin that packs jobs by their declared cores and memory
+    and limits each job to the threads it was allocated
+    """
+
+    def _sort_jobs(self, jobids, scheduler='tsort'):
+        """Submit the jobs that need the most cores and memory first, so
+        that smaller jobs fill the remaining cores
+        """
+        return sorted(jobids,
+                      key=lambda jobid: (self.procs[jobid].n_procs,
+                                         self.procs[jobid].mem_gb),
+                      reverse=True)
+
+    def _submit_job(self, node, updatehash=False):
+        limit_threads(node)
+        self._taskid += 1
+        if getattr(node.interface, 'terminal_output', '') == 'stream':
+            node.interface.terminal_output = 'allatonce'
+        result_future = self.pool.submit(run_node_limited, node, updatehash,
+                                         self._taskid)
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+        return self._taskid
@@ -0,0 +1,245 @@
+"""
+Batched surface group GLM
+-------------------------
+
+The surface level-2 flow runs one ``concat -> onesample`` chain per
+contrast and hemisphere, and each chain reads and projects the images of
+every subject again.
+
+:class:`SurfaceGroupGLM` analyses all contrasts and both hemispheres of a
+study in one node. Every contrast image of a subject is read once and
+projected to both hemispheres of the target with the cached operators of
+:mod:`mindflows.gablab.surfproj`; the projected data are appended to one
+group store (:mod:`mindflows.gablab.groupstore`) per contrast and
+hemisphere, so that they never have to fit in memory. The GLM is then
+solved chunk by chunk, with the vertices of all contrasts of a chunk
+stacked into one subjects-by-columns array, so that every t contrast of
+every first-level contrast costs a single matrix product per chunk.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os                                    # system functions
+
+import numpy as np
+
+import nibabel as nb
+from nibabel import freesurfer as nbfs
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, Directory,
+                                    InputMultiPath, OutputMultiPath, traits,
+                                    isdefined)
+
+from mindflows.gablab.blockglm import t_to_z
+from mindflows.gablab.groupstore import GroupStore
+from mindflows.gablab.imageio import load_image
+from mindflows.gablab.surfproj import (adjacency_matrix, fwhm_to_niters,
+                                       project_image, projection_fractions,
+                                       projection_operator, smooth_surface)
+
+
+def fit_group(Y, X, C):
+    """Fit an OLS GLM to the columns of `Y` (subjects x columns)
+
+    Returns the copes, t statistics and z statistics of the t contrasts `C`
+    (contrasts x regressors), each of shape (contrasts x columns).
+    """
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+    beta = np.dot(np.linalg.pinv(X), Y)
+    resid = Y - np.dot(X, beta)
+    sigmasq = np.sum(resid ** 2, axis=0) / dof
+    conv = np.einsum('cp,pq,cq->c', C, np.linalg.pinv(np.dot(X.T, X)), C)
+    copes = np.dot(C, beta)
+    varcopes = conv[:, None] * sigmasq[None, :]
+    tstats = np.zeros(copes.shape)
+    valid = varcopes > 0
+    tstats[valid] = copes[valid] / np.sqrt(varcopes[valid])
+    return copes, tstats, t_to_z(tstats, dof)
+
+
+class SurfaceGroupGLMInputSpec(BaseInterfaceInputSpec):
+    in_files = traits.List(InputMultiPath(File(exists=True)), mandatory=True,
+                           desc='contrast images of each first-level '
+                           'contrast (outer list) and subject (inner list)')
+    reg_files = InputMultiPath(File(exists=True), mandatory=True,
+                               desc='tkregister registration of each subject')
+    hemis = traits.List(traits.Enum('lh', 'rh'), ['lh', 'rh'],
+                        usedefault=True, desc='hemispheres to analyse')
+    target = traits.Str('fsaverage', usedefault=True,
+                        desc='subject whose surface is the target')
+    proj_frac = traits.Float(0.5, usedefault=True,
+                             desc='fraction of the thickness along the '
+                             'normal')
+    proj_frac_avg = traits.Tuple(traits.Float, traits.Float, traits.Float,
+                                 desc='average the fractions min max delta '
+                                 '(overrides proj_frac)')
+    fwhm = traits.Float(0., usedefault=True,
+                        desc='smoothing on the target surface (mm)')
+    design = traits.List(traits.List(traits.Float),
+                         desc='design matrix, one row per subject (default: '
+                         'a one-sample test)')
+    tcontrasts = traits.List(traits.List(traits.Float),
+                             desc='t contrasts of the design (default: the '
+                             'mean)')
+    subjects_dir = Directory(exists=True, desc='subjects directory')
+    cache_dir = Directory(nohash=True,
+                          desc='operator cache (default: '
+                          '~/.mindflows/projections)')
+    batch_size = traits.Int(32, usedefault=True, nohash=True,
+                            desc='subjects projected between store writes')
+    num_threads = traits.Int(4, usedefault=True, nohash=True,
+                             desc='number of chunks fitted concurrently')
+
+
+class SurfaceGroupGLMOutputSpec(TraitedSpec):
+    copes = OutputMultiPath(File(exists=True),
+                            desc='copes, by first-level contrast, hemisphere '
+                            'and t contrast')
+    tstats = OutputMultiPath(File(exists=True),
+                             desc='t statistics, ordered as copes')
+    zstats = OutputMultiPath(File(exists=True),
+                             desc='z statistics, ordered as copes')
+    dof = traits.Int(desc='degrees of freedom')
+
+
+class SurfaceGroupGLM(BaseInterface):
+    """Group GLM of all contrasts on both hemispheres of a target surface
+
+    Replaces one ``fs.MRISPreproc`` and ``fs.OneSampleTTest`` chain per
+    contrast and hemisphere. Outputs of first-level contrast ``c``, t
+    contrast ``k`` on ``lh`` are named ``con<c>_lh_tstat<k>.mgh`` etc.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.surfglm import SurfaceGroupGLM
+    >>> surfglm = SurfaceGroupGLM(fwhm=5)
+    >>> surfglm.inputs.in_files = [['s1/con_0001.img', 's2/con_0001.img'],
+    ...                            ['s1/con_0002.img', 's2/con_0002.img']]
+    >>> surfglm.inputs.reg_files = ['s1/register.dat', 's2/register.dat']
+    >>> surfglm.run() # doctest: +SKIP
+    """
+
+    input_spec = SurfaceGroupGLMInputSpec
+    output_spec = SurfaceGroupGLMOutputSpec
+
+    def _project(self, runtime, subjects_dir, cache_dir, fractions):
+        """Project all images into one group store per contrast and
+        hemisphere; returns the stores
+        """
+        nsubjects = len(self.inputs.reg_files)
+        hemis = self.inputs.hemis
+        surfaces = {}
+        for hemi in hemis:
+            coords, faces = nbfs.read_geometry(
+                os.path.join(subjects_dir, self.inputs.target, 'surf',
+                             hemi + '.white'))
+            surfaces[hemi] = (coords.shape[0],
+                              adjacency_matrix(faces, coords.shape[0]),
+                              fwhm_to_niters(self.inputs.fwhm, coords, faces)
+                              if self.inputs.fwhm > 0 else 0)
+        stores = {}
+        for con in range(len(self.inputs.in_files)):
+            for hemi in hemis:
+                stores[(con, hemi)] = GroupStore(
+                    os.path.join(runtime.cwd, 'stores',
+                                 'con%d_%s' % (con + 1, hemi)))
+        for start in range(0, nsubjects, self.inputs.batch_size):
+            batch = range(start, min(start + self.inputs.batch_size,
+                                     nsubjects))
+            projected = dict([(key, []) for key in stores])
+            for subj in batch:
+                reg_file = self.inputs.reg_files[subj]
+                operators = {}
+                for con, files in enumerate(self.inputs.in_files):
+                    # read (and decompress) each image once for both
+                    # hemispheres
+                    img, data = load_image(files[subj])
+                    data = np.asarray(data, dtype=np.float32)
+                    grid = (img.shape[:3], img.header.get_zooms()[:3])
+                    for hemi in hemis:
+                        if (grid, hemi) not in operators:
+                            operators[(grid, hemi)] = projection_operator(
+                                reg_file, img, hemi, subjects_dir, fractions,
+                                self.inputs.target, cache_dir)
+                        projected[(con, hemi)].append(
+                            project_image(operators[(grid, hemi)],
+                                          data)[:, 0])
+            for (con, hemi), values in projected.items():
+                nvertices, adjacency, niters = surfaces[hemi]
+                values = np.array(values).T
+                if niters:
+                    values = smooth_surface(values, adjacency, niters)
+                stores[(con, hemi)].add(
+                    [('%06d' % subj, values[:, idx, None, None])
+                     for idx, subj in enumerate(batch)],
+                    num_threads=self.inputs.num_threads,
+                    ref_img=nb.MGHImage(np.zeros((nvertices, 1, 1),
+                                                 dtype=np.float32),
+                                        np.eye(4)))
+        return stores
+
+    def _run_interface(self, runtime):
+        subjects_dir = os.environ.get('SUBJECTS_DIR')
+        if isdefined(self.inputs.subjects_dir):
+            subjects_dir = self.inputs.subjects_dir
+        cache_dir = None
+        if isdefined(self.inputs.cache_dir):
+            cache_dir = self.inputs.cache_dir
+        fractions = projection_fractions(self.inputs.proj_frac)
+        if isdefined(self.inputs.proj_frac_avg):
+            fractions = projection_fractions(
+                proj_frac_avg=self.inputs.proj_frac_avg)
+        nsubjects = len(self.inputs.reg_files)
+        for files in self.inputs.in_files:
+            if len(files) != nsubjects:
+                raise ValueError('SurfaceGroupGLM needs one image per '
+                                 'registration for every contrast')
+        X = np.ones((nsubjects, 1))
+        if isdefined(self.inputs.design):
+            X = np.array(self.inputs.design, dtype=np.float64)
+        C = np.eye(1, X.shape[1])
+        if isdefined(self.inputs.tcontrasts):
+            C = np.array(self.inputs.tcontrasts, dtype=np.float64)
+        stores = self._project(runtime, subjects_dir, cache_dir, fractions)
+        ncons = len(self.inputs.in_files)
+        results = {}
+
+        def fit_chunk(hemi, idx):
+            Y = np.hstack([stores[(con, hemi)].read_chunk(idx)
+                           for con in range(ncons)]).astype(np.float64)
+            return (hemi, idx), fit_group(Y, X, C)
+        pool = ThreadPoolExecutor(max(1, self.inputs.num_threads))
+        try:
+            jobs = [pool.submit(fit_chunk, hemi, idx)
+                    for hemi in self.inputs.hemis
+                    for idx in range(stores[(0, hemi)].nchunks)]
+            for job in jobs:
+                key, stats = job.result()
+                results[key] = stats
+        finally:
+            pool.shutdown()
+        self._results = dict(copes=[], tstats=[], zstats=[],
+                             dof=int(nsubjects - np.linalg.matrix_rank(X)))
+        for con in range(ncons):
+            for hemi in self.inputs.hemis:
+                store = stores[(con, hemi)]
+                for stat_idx, name in enumerate(['cope', 'tstat', 'zstat']):
+                    values = []
+                    for idx in range(store.nchunks):
+                        chunk = store.chunk_slice(idx)
+                        size = chunk.stop - chunk.start
+                        values.append(results[(hemi, idx)][stat_idx][
+                            :, con * size:(con + 1) * size])
+                    values = np.hstack(values)
+                    for k in range(C.shape[0]):
+                        self._results[name + 's'].append(store.save(
+                            values[k], os.path.join(
+                                runtime.cwd, 'con%d_%s_%s%d' %
+                                (con + 1, hemi, name, k + 1))))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
@@ -0,0 +1,523 @@
+"""
+Volume to surface projection operators
+--------------------------------------
+
+``fs.Smooth`` (``mris_volsmooth``) and ``fs.MRISPreproc`` (``mris_preproc``)
+sample the volume along the surface normals again for every run and every
+contrast, although the sampling only depends on the subject's surfaces, its
+registration and the projection fractions.
+
+:func:`projection_operator` builds the sampling once as a sparse matrix
+mapping the voxels of a functional volume to the vertices of a surface,
+with the samples at every projection fraction averaged in the operator, and
+composed with the nearest-neighbour mapping (``nnfr``) to a target subject
+such as ``fsaverage``. Operators are cached under a key derived from the
+content of the registration and surface files, the fractions and the
+volume grid, so that projecting any later 3D or 4D image is a single sparse
+product over all its volumes. :class:`SurfaceProject` replaces
+``fs.MRISPreproc``, or projects the subjects straight into a group store,
+and :class:`SurfaceSmooth` replaces ``fs.Smooth``.
+
+The sampling follows ``mri_vol2surf``: the point of a vertex at fraction
+``f`` is ``white + f * thickness * normal``, mapped through the
+``register.dat`` matrix to the functional volume and sampled at the nearest
+voxel. Surface smoothing iterates nearest-neighbour averages, with the
+number of iterations derived from the FWHM as in FreeSurfer.
+"""
+
+import hashlib
+import json
+import os                                    # system functions
+import tempfile
+
+import numpy as np
+from scipy import ndimage, sparse
+from scipy.spatial import cKDTree
+
+import nibabel as nb
+from nibabel import freesurfer as nbfs
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, Directory,
+                                    InputMultiPath, traits, isdefined)
+
+from mindflows.gablab.groupstore import GroupStore, image_signature
+from mindflows.gablab.imageio import load_image, save_image, output_name
+from mindflows.gablab.templates import file_checksum
+
+
+default_cache_dir = os.path.join('~', '.mindflows', 'projections')
+
+
+def read_register(reg_file):
+    """Return the subject and the matrix of a tkregister ``register.dat``
+    """
+    fp = open(reg_file)
+    lines = [line.strip() for line in fp if line.strip()]
+    fp.close()
+    matrix = np.array([[float(val) for val in line.split()]
+                       for line in lines[4:8]])
+    return lines[0], matrix
+
+
+def tkr_vox2ras(shape, zooms):
+    """Return FreeSurfer's tkregister voxel to RAS matrix of a volume
+    """
+    dx, dy, dz = zooms[:3]
+    nx, ny, nz = shape[:3]
+    return np.array([[-dx, 0, 0, dx * nx / 2.],
+                     [0, 0, dz, -dz * nz / 2.],
+                     [0, -dy, 0, dy * ny / 2.],
+                     [0, 0, 0, 1]])
+
+
+def vertex_normals(coords, faces):
+    """Return the unit normals of a surface (area-weighted face normals)
+    """
+    tris = coords[faces]
+    face_normals = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+    normals = np.zeros(coords.shape)
+    for idx in range(3):
+        np.add.at(normals, faces[:, idx], face_normals)
+    norms = np.sqrt(np.sum(normals ** 2, axis=1))
+    norms[norms == 0] = 1
+    return normals / norms[:, None]
+
+
+def adjacency_matrix(faces, nvertices):
+    """Return the sparse vertex adjacency matrix of a surface
+    """
+    rows = np.concatenate([faces[:, 0], faces[:, 1], faces[:, 2]])
+    cols = np.concatenate([faces[:, 1], faces[:, 2], faces[:, 0]])
+    adjacency = sparse.coo_matrix((np.ones(rows.size), (rows, cols)),
+                                  shape=(nvertices, nvertices)).tocsr()
+    adjacency = adjacency + adjacency.T
+    adjacency.data[:] = 1
+    return adjacency
+
+
+def fwhm_to_niters(fwhm, coords, faces):
+    """Return the nearest-neighbour smoothing iterations approximating a
+    gaussian of `fwhm` mm on a surface, as FreeSurfer's MRISfwhm2niters
+    """
+    tris = coords[faces]
+    area = 0.5 * np.sum(np.sqrt(np.sum(np.cross(tris[:, 1] - tris[:, 0],
+                                                tris[:, 2] - tris[:, 0]) ** 2,
+                                       axis=1)))
+    gstd = fwhm / np.sqrt(np.log(256.))
+    return int(np.floor(1.14 * 4 * np.pi * gstd ** 2 /
+                        (7 * area / coords.shape[0]) + 0.5))
+
+
+def smooth_surface(data, adjacency, niters):
+    """Average every vertex with its neighbours `niters` times
+
+    `data` has vertices along its first axis.
+    """
+    weights = 1. / (1. + np.asarray(adjacency.sum(axis=1)).ravel())
+    if data.ndim > 1:
+        weights = weights[:, None]
+    for _ in range(niters):
+        data = (data + adjacency.dot(data)) * weights
+    return data
+
+
+def sampling_matrix(points, matrix, shape, zooms):
+    """Return the sparse matrix sampling a volume at the nearest voxel of
+    each point
+
+    `points` are tkregister RAS coordinates of the anatomy and `matrix` the
+    registration from the anatomy to the volume. Columns are voxels in
+    NIFTI (Fortran) order; points outside the volume have empty rows.
+    """
+    ras2vox = np.dot(np.linalg.inv(tkr_vox2ras(shape, zooms)), matrix)
+    vox = np.dot(ras2vox[:3, :3], points.T) + ras2vox[:3, 3:]
+    vox = np.round(vox).astype(int)
+    inside = np.all((vox >= 0) &
+                    (vox < np.array(shape[:3])[:, None]), axis=0)
+    columns = np.ravel_multi_index(tuple(vox[:, inside]), shape[:3],
+                                   order='F')
+    return sparse.csr_matrix((np.ones(columns.size),
+                              (np.flatnonzero(inside), columns)),
+                             shape=(points.shape[0],
+                                    int(np.prod(shape[:3]))))
+
+
+def surface_mapping(source_sphere, target_sphere):
+    """Return the sparse matrix mapping source vertices to target vertices
+    with ``mri_surf2surf``'s ``nnfr`` method
+
+    Each target vertex averages its nearest source vertex and the source
+    vertices whose nearest target vertex it is.
+    """
+    nsource = source_sphere.shape[0]
+    ntarget = target_sphere.shape[0]
+    forward = cKDTree(source_sphere).query(target_sphere)[1]
+    reverse = cKDTree(target_sphere).query(source_sphere)[1]
+    unused = np.setdiff1d(np.arange(nsource), forward)
+    rows = np.concatenate([np.arange(ntarget), reverse[unused]])
+    cols = np.concatenate([forward, unused])
+    mapping = sparse.csr_matrix((np.ones(rows.size), (rows, cols)),
+                                shape=(ntarget, nsource))
+    counts = np.asarray(mapping.sum(axis=1)).ravel()
+    return sparse.diags(1. / np.maximum(counts, 1)).dot(mapping).tocsr()
+
+
+def projection_fractions(proj_frac=None, proj_frac_avg=None):
+    """Return the projection fractions of ``--projfrac`` or
+    ``--projfrac-avg min max delta``
+
+    >>> projection_fractions(proj_frac_avg=(0, 1, 0.25))
+    [0.0, 0.25, 0.5, 0.75, 1.0]
+    """
+    if proj_frac_avg is not None:
+        low, high, delta = proj_frac_avg
+        count = int(np.floor((high - low) / delta + 1e-6)) + 1
+        return [round(low + idx * delta, 6) for idx in range(count)]
+    if proj_frac is None:
+        return [0.]
+    return [float(proj_frac)]
+
+
+def _surface_files(subjects_dir, subject, hemi, target):
+    surfdir = os.path.join(subjects_dir, subject, 'surf')
+    files = dict(white=os.path.join(surfdir, hemi + '.white'),
+                 thickness=os.path.join(surfdir, hemi + '.thickness'))
+    if target != subject:
+        files['sphere'] = os.path.join(surfdir, hemi + '.sphere.reg')
+        files['target_sphere'] = os.path.join(subjects_dir, target, 'surf',
+                                              hemi + '.sphere.reg')
+    return files
+
+
+def _build_operator(reg_file, shape, zooms, subjects_dir, hemi, fractions,
+                    target):
+    subject, matrix = read_register(reg_file)
+    files = _surface_files(subjects_dir, subject, hemi, target)
+    coords, faces = nbfs.read_geometry(files['white'])
+    normals = vertex_normals(coords, faces)
+    thickness = nbfs.read_morph_data(files['thickness'])
+    operator = None
+    for frac in fractions:
+        points = coords + (frac * thickness)[:, None] * normals
+        sample = sampling_matrix(points, matrix, shape, zooms)
+        operator = sample if operator is None else operator + sample
+    # average the fractions that fall inside the volume
+    counts = np.asarray(operator.sum(axis=1)).ravel()
+    operator = sparse.diags(1. / np.maximum(counts, 1)).dot(operator)
+    if target != subject:
+        mapping = surface_mapping(nbfs.read_geometry(files['sphere'])[0],
+                                  nbfs.read_geometry(
+                                      files['target_sphere'])[0])
+        operator = mapping.dot(operator)
+    return operator.tocsr()
+
+
+def projection_operator(reg_file, ref_img, hemi, subjects_dir=None,
+                        fractions=(0.5,), target=None, cache_dir=None):
+    """Return the sparse (vertices x voxels) projection of the volume grid
+    of `ref_img` onto a hemisphere, building and caching it once
+
+    `target` is the subject whose surface the vertices belong to (default:
+    the registered subject). The operator is cached in `cache_dir` (default
+    ``~/.mindflows/projections``).
+    """
+    if subjects_dir is None:
+        subjects_dir = os.environ['SUBJECTS_DIR']
+    if cache_dir is None:
+        cache_dir = default_cache_dir
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    subject, _ = read_register(reg_file)
+    if target is None:
+        target = subject
+    shape = tuple(int(size) for size in ref_img.shape[:3])
+    zooms = tuple(float(zoom) for zoom in ref_img.header.get_zooms()[:3])
+    files = _surface_files(subjects_dir, subject, hemi, target)
+    desc = json.dumps([file_checksum(reg_file),
+                       dict([(key, file_checksum(fname))
+                             for key, fname in files.items()]),
+                       subject, target, hemi, list(fractions), shape, zooms],
+                      sort_keys=True)
+    fname = os.path.join(cache_dir,
+                         hashlib.sha1(desc.encode()).hexdigest() + '.npz')
+    if os.path.exists(fname):
+        return sparse.load_npz(fname).tocsr()
+    operator = _build_operator(reg_file, shape, zooms, subjects_dir, hemi,
+                               fractions, target)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmpname = tempfile.mkstemp(prefix='.build', suffix='.npz',
+                                   dir=cache_dir)
+    os.close(fd)
+    sparse.save_npz(tmpname, operator)
+    os.rename(tmpname, fname)
+    return operator
+
+
+def project_image(operator, image):
+    """Project every volume of an image, given as a file or as its data
+    array; returns (vertices x volumes)
+    """
+    data = image
+    if isinstance(image, str):
+        data = load_image(image)[1]
+    nvoxels = int(np.prod(data.shape[:3]))
+    values = np.asarray(data, dtype=np.float32).reshape((nvoxels, -1),
+                                                        order='F')
+    return np.asarray(operator.dot(values), dtype=np.float32)
+
+
+class SurfaceProjectInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='volumes to project (one per subject)')
+    reg_files = InputMultiPath(File(exists=True), mandatory=True,
+                               desc='tkregister registration of each volume')
+    hemi = traits.Enum('lh', 'rh', mandatory=True, desc='hemisphere')
+    target = traits.Str('fsaverage', usedefault=True,
+                        desc='subject whose surface is the target')
+    proj_frac = traits.Float(0.5, usedefault=True,
+                             desc='fraction of the thickness along the '
+                             'normal')
+    proj_frac_avg = traits.Tuple(traits.Float, traits.Float, traits.Float,
+                                 desc='average the fractions min max delta '
+                                 '(overrides proj_frac)')
+    fwhm = traits.Float(0., usedefault=True,
+                        desc='smoothing on the target surface (mm)')
+    subjects_dir = Directory(exists=True, desc='subjects directory')
+    cache_dir = Directory(nohash=True,
+                          desc='operator cache (default: '
+                          '~/.mindflows/projections)')
+    subjects = traits.List(traits.Str,
+                           desc='subject of each volume (default: the volume '
+                           'positions)')
+    store_dir = Directory(desc='group store to add the projections to '
+                          'instead of writing out_file')
+    prune = traits.Bool(False, usedefault=True,
+                        desc='remove stored subjects missing from subjects')
+
+
+class SurfaceProjectOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='projected volumes, one frame per input '
+                    'volume')
+    store_file = File(exists=True, desc='header of the group store')
+    subjects = traits.List(traits.Str, desc='subjects in the order of '
+                           'in_files')
+
+
+class SurfaceProject(BaseInterface):
+    """Project volumes of many subjects onto a target surface
+
+    Replaces ``fs.MRISPreproc`` with volume measures; the output has the
+    frames of all inputs, in order. With `store_dir`, each subject is
+    projected into a :class:`~mindflows.gablab.groupstore.GroupStore`
+    instead, and subjects stored from the same volume, registration and
+    projection settings are skipped without being read, so a rerun with
+    more subjects only projects the new ones.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.surfproj import SurfaceProject
+    >>> concat = SurfaceProject(hemi='lh', fwhm=5)
+    >>> concat.inputs.in_files = ['s1/con_0001.img', 's2/con_0001.img']
+    >>> concat.inputs.reg_files = ['s1/register.dat', 's2/register.dat']
+    >>> concat.run() # doctest: +SKIP
+    """
+
+    input_spec = SurfaceProjectInputSpec
+    output_spec = SurfaceProjectOutputSpec
+
+    def _run_interface(self, runtime):
+        if len(self.inputs.in_files) != len(self.inputs.reg_files):
+            raise ValueError('SurfaceProject needs one registration per '
+                             'volume')
+        subjects_dir = None
+        if isdefined(self.inputs.subjects_dir):
+            subjects_dir = self.inputs.subjects_dir
+        cache_dir = None
+        if isdefined(self.inputs.cache_dir):
+            cache_dir = self.inputs.cache_dir
+        fractions = projection_fractions(self.inputs.proj_frac)
+        if isdefined(self.inputs.proj_frac_avg):
+            fractions = projection_fractions(
+                proj_frac_avg=self.inputs.proj_frac_avg)
+        adjacency = None
+        if self.inputs.fwhm > 0:
+            if subjects_dir is None:
+                subjects_dir = os.environ['SUBJECTS_DIR']
+            coords, faces = nbfs.read_geometry(
+                os.path.join(subjects_dir, self.inputs.target, 'surf',
+                             self.inputs.hemi + '.white'))
+            adjacency = adjacency_matrix(faces, coords.shape[0])
+            niters = fwhm_to_niters(self.inputs.fwhm, coords, faces)
+
+        def operator(in_file, reg_file):
+            return projection_operator(reg_file, nb.load(in_file),
+                                       self.inputs.hemi, subjects_dir,
+                                       fractions, self.inputs.target,
+                                       cache_dir)
+
+        def project(in_file, reg_file):
+            values = project_image(operator(in_file, reg_file), in_file)
+            if adjacency is not None:
+                values = smooth_surface(values, adjacency, niters)
+            return values
+
+        if isdefined(self.inputs.store_dir):
+            self._store(operator, project, fractions)
+            return runtime
+        values = np.concatenate([project(in_file, reg_file)
+                                 for in_file, reg_file in
+                                 zip(self.inputs.in_files,
+                                     self.inputs.reg_files)], axis=1)
+        # vertex counts exceed the NIFTI-1 dimension limit
+        self._results = dict(out_file=os.path.join(
+            runtime.cwd, '%s.concat.mgh' % self.inputs.hemi))
+        nb.MGHImage(values.reshape((values.shape[0], 1, 1, -1)).astype(
+            np.float32), np.eye(4)).to_filename(self._results['out_file'])
+        return runtime
+
+    def _store(self, operator, project, fractions):
+        """Add the projection of every changed subject to the group store
+        """
+        subjects = self.inputs.subjects
+        if not isdefined(subjects):
+            subjects = ['%04d' % idx
+                        for idx in range(len(self.inputs.in_files))]
+        if len(subjects) != len(self.inputs.in_files):
+            raise ValueError('SurfaceProject needs one subject per volume')
+        settings = [self.inputs.hemi, self.inputs.target, list(fractions),
+                    self.inputs.fwhm]
+        entries = []
+        for subject, in_file, reg_file in zip(subjects, self.inputs.in_files,
+                                              self.inputs.reg_files):
+            signature = json.dumps([image_signature(in_file),
+                                    image_signature(reg_file)] + settings)
+            entries.append((subject,
+                            lambda in_file=in_file, reg_file=reg_file:
+                            project(in_file, reg_file)[:, :1, None],
+                            signature))
+        store = GroupStore(self.inputs.store_dir)
+        ref_img = None
+        if not store.exists():
+            nvertices = operator(self.inputs.in_files[0],
+                                 self.inputs.reg_files[0]).shape[0]
+            ref_img = nb.MGHImage(np.zeros((nvertices, 1, 1),
+                                           dtype=np.float32), np.eye(4))
+        store.add(entries, ref_img=ref_img)
+        if self.inputs.prune:
+            store.remove([subject for subject in store.subjects
+                          if subject not in subjects])
+        self._results = dict(store_file=os.path.join(store.store_dir,
+                                                     'store.json'),
+                             subjects=list(subjects))
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._results)
+        return outputs
+
+
+class SurfaceSmoothInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='volume to smooth')
+    reg_file = File(exists=True, mandatory=True,
+                    desc='tkregister registration of the volume')
+    surface_fwhm = traits.Float(mandatory=True, xor=['num_iters'],
+                                desc='surface FWHM in mm')
+    num_iters = traits.Int(mandatory=True, xor=['surface_fwhm'],
+                           desc='number of smoothing iterations instead of '
+                           'fwhm')
+    proj_frac = traits.Float(0.5, usedefault=True,
+                             desc='fraction of the thickness along the '
+                             'normal')
+    proj_frac_avg = traits.Tuple(traits.Float, traits.Float, traits.Float,
+                                 desc='average the fractions min max delta '
+                                 '(overrides proj_frac)')
+    vol_fwhm = traits.Float(0., usedefault=True,
+                            desc='volume smoothing outside of the surface')
+    subjects_dir = Directory(exists=True, desc='subjects directory')
+    cache_dir = Directory(nohash=True,
+                          desc='operator cache (default: '
+                          '~/.mindflows/projections)')
+
+
+class SurfaceSmoothOutputSpec(TraitedSpec):
+    smoothed_file = File(exists=True, desc='smoothed volume')
+
+
+class SurfaceSmooth(BaseInterface):
+    """Smooth the cortical ribbon of a volume on the surface
+
+    Replaces ``fs.Smooth`` (``mris_volsmooth``): the voxels sampled by the
+    surfaces of both hemispheres are projected, smoothed on the surface and
+    replaced by the average of the vertices sampling them; the other voxels
+    are smoothed in the volume with `vol_fwhm`.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.surfproj import SurfaceSmooth
+    >>> surfsmooth = SurfaceSmooth(proj_frac_avg=(0, 1, 0.1), surface_fwhm=5)
+    >>> surfsmooth.inputs.in_file = 'rf001.nii'
+    >>> surfsmooth.inputs.reg_file = 'register.dat'
+    >>> surfsmooth.run() # doctest: +SKIP
+    """
+
+    input_spec = SurfaceSmoothInputSpec
+    output_spec = SurfaceSmoothOutputSpec
+
+    def _run_interface(self, runtime):
+        subjects_dir = os.environ.get('SUBJECTS_DIR')
+        if isdefined(self.inputs.subjects_dir):
+            subjects_dir = self.inputs.subjects_dir
+        cache_dir = None
+        if isdefined(self.inputs.cache_dir):
+            cache_dir = self.inputs.cache_dir
+        fractions = projection_fractions(self.inputs.proj_frac)
+        if isdefined(self.inputs.proj_frac_avg):
+            fractions = projection_fractions(
+                proj_frac_avg=self.inputs.proj_frac_avg)
+        img, data = load_image(self.inputs.in_file)
+        shape = data.shape
+        nvoxels = int(np.prod(shape[:3]))
+        values = np.asarray(data, dtype=np.float32).reshape((nvoxels, -1),
+                                                            order='F')
+        subject, _ = read_register(self.inputs.reg_file)
+        total = np.zeros(values.shape)
+        weights = np.zeros(nvoxels)
+        for hemi in ['lh', 'rh']:
+            operator = projection_operator(self.inputs.reg_file, img, hemi,
+                                           subjects_dir, fractions, subject,
+                                           cache_dir)
+            niters = self.inputs.num_iters
+            coords, faces = nbfs.read_geometry(
+                os.path.join(subjects_dir, subject, 'surf', hemi + '.white'))
+            if isdefined(self.inputs.surface_fwhm):
+                niters = fwhm_to_niters(self.inputs.surface_fwhm, coords,
+                                        faces)
+            surface = smooth_surface(operator.dot(values),
+                                     adjacency_matrix(faces, coords.shape[0]),
+                                     niters)
+            total += operator.T.dot(surface)
+            weights += np.asarray(operator.sum(axis=0)).ravel()
+        ribbon = weights > 0
+        out = values.astype(np.float64)
+        if self.inputs.vol_fwhm > 0:
+            sigma = [self.inputs.vol_fwhm / np.sqrt(8 * np.log(2)) / zoom
+                     for zoom in img.header.get_zooms()[:3]]
+            volumes = out.reshape(shape[:3] + (-1,), order='F')
+            for idx in range(volumes.shape[3]):
+                volumes[..., idx] = ndimage.gaussian_filter(volumes[..., idx],
+                                                            sigma)
+            out = volumes.reshape((nvoxels, -1), order='F')
+        out[ribbon] = total[ribbon] / weights[ribbon, None]
+        self._smoothed_file = save_image(
+            out.reshape(shape, order='F'), img,
+            output_name(self.inputs.in_file, '_smooth', newpath=runtime.cwd),
+            np.float32)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['smoothed_file'] = self._smoothed_file
+        return outputs
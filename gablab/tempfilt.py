@@ -0,0 +1,193 @@
+"""
+Temporal filtering
+------------------
+
+The FEAT preprocessing chain scales every run to a grand median of 10000
+(``fslmaths -mul``), high-pass filters it (``fslmaths -bptf``) and takes the
+temporal mean of the first filtered run (``fslmaths -Tmean``), reading and
+writing the run three times on a single core.
+
+The ``-bptf`` high-pass filter fits a Gaussian-weighted running line to the
+timeseries of each voxel and subtracts it. For a given number of timepoints
+the fit is a fixed linear operator, so the whole filter (together with the
+intensity scaling) is a single ``T x T`` matrix. By default the intercept
+of the first timepoint is added back, as ``-bptf`` did before FSL 5.0.7:
+the flows have no step adding the temporal mean back (which FEAT does
+since 5.0.7, when ``-bptf`` started removing the mean), and the mean image
+of the filtered run is used for registration. :class:`TemporalFilter`
+builds that matrix once and applies it to blocks of voxels from a pool of
+threads; numpy releases the GIL during the matrix products, so the blocks
+are filtered concurrently.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits, isdefined)
+
+from mindflows.gablab.imageio import (load_image, save_image, output_name,
+                                      iter_slabs)
+
+
+def highpass_matrix(ntimepoints, sigma, add_intercept=True):
+    """Return the matrix applying the ``-bptf`` high-pass filter
+
+    ``sigma`` is the high-pass sigma in volumes, as passed to ``fslmaths
+    -bptf``. Each timepoint is replaced by its residual from a straight line
+    fitted to the timepoints within ``int(3 * sigma)`` volumes, weighted with
+    a Gaussian of width ``sigma``; timepoints for which the line is undefined
+    are kept unchanged. If `add_intercept` is True, the intercept of the fit
+    at the first timepoint is added back, as ``-bptf`` did before FSL 5.0.7,
+    so that the filtered run stays near its original intensity. Since 5.0.7
+    ``-bptf`` removes the mean and FEAT (like the nipype FEAT workflows)
+    adds the temporal mean of the run back in a separate step; pass False
+    to get that mean-free output. A `sigma` that is not positive returns
+    the identity.
+
+    Filtered timeseries (as rows) are ``np.dot(timeseries, matrix.T)``.
+    """
+    filt = np.eye(ntimepoints)
+    if sigma <= 0:
+        return filt
+    halfwidth = int(sigma * 3)
+    fit = np.zeros((ntimepoints, ntimepoints))
+    fitted = np.zeros(ntimepoints, dtype=bool)
+    for t in range(ntimepoints):
+        window = np.arange(max(t - halfwidth, 0),
+                           min(t + halfwidth, ntimepoints - 1) + 1)
+        dt = window - t
+        w = np.exp(-0.5 * dt ** 2 / sigma ** 2)
+        A = np.sum(w * dt)
+        C = np.sum(w * dt ** 2)
+        N = np.sum(w)
+        denom = C * N - A * A
+        if denom != 0:
+            fit[t, window] = w * (C - A * dt) / denom
+            fitted[t] = True
+    filt -= fit
+    if add_intercept and fitted[0]:
+        filt[fitted] += fit[0]
+    return filt
+
+
+def temporal_filter(in_file, out_file, sigma, scale=1., add_intercept=True,
+                    mean_file=None, num_threads=1, block_size=32768):
+    """Scale and high-pass filter a 4D run
+
+    The run is processed in z-slabs of about `block_size` voxels by
+    `num_threads` threads; voxels that are zero throughout are skipped. If
+    `mean_file` is given, the temporal mean of the filtered run is written
+    to it. Returns the filenames written.
+    """
+    img, data = load_image(in_file)
+    ntimepoints = data.shape[3]
+    filt = (scale * highpass_matrix(ntimepoints, sigma, add_intercept)).T
+    out = np.zeros(data.shape, dtype=np.float32)
+    tmean = np.zeros(data.shape[:3], dtype=np.float32)
+
+    def filter_slab(slab):
+        block = np.asarray(data[:, :, slab], dtype=np.float64)
+        shape = block.shape
+        block = block.reshape(-1, ntimepoints)
+        nonzero = np.any(block != 0, axis=1)
+        result = np.zeros(block.shape)
+        result[nonzero] = np.dot(block[nonzero], filt)
+        out[:, :, slab] = result.reshape(shape)
+        tmean[:, :, slab] = result.mean(axis=1).reshape(shape[:3])
+
+    pool = ThreadPoolExecutor(max(1, num_threads))
+    try:
+        list(pool.map(filter_slab, iter_slabs(data.shape, block_size)))
+    finally:
+        pool.shutdown()
+    outputs = [save_image(out, img, out_file, np.float32)]
+    del out
+    if mean_file:
+        outputs.append(save_image(tmean, img, mean_file, np.float32))
+    return outputs
+
+
+class TemporalFilterInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='functional runs to filter')
+    highpass_sigma = traits.Float(mandatory=True,
+                                  desc='high-pass sigma in volumes, as '
+                                  'passed to fslmaths -bptf (<=0 to skip)')
+    median_values = traits.List(traits.Float,
+                                desc='median intensity of each run; runs are '
+                                'scaled so that it becomes intensity_scale')
+    intensity_scale = traits.Float(10000., usedefault=True,
+                                   desc='target median intensity')
+    add_intercept = traits.Bool(True, usedefault=True,
+                                desc='add back the intercept of the fit at '
+                                'the first timepoint, as -bptf did before '
+                                'FSL 5.0.7 (False removes the mean, as '
+                                '-bptf does since 5.0.7)')
+    num_threads = traits.Int(4, usedefault=True, nohash=True,
+                             desc='number of threads filtering voxel blocks')
+    block_size = traits.Int(32768, usedefault=True,
+                            desc='number of voxels filtered at a time')
+
+
+class TemporalFilterOutputSpec(TraitedSpec):
+    out_file = OutputMultiPath(File(exists=True),
+                               desc='scaled and filtered runs')
+    mean_file = File(exists=True,
+                     desc='temporal mean of the first filtered run')
+
+
+class TemporalFilter(BaseInterface):
+    """Multi-threaded replacement for the FEAT scaling and high-pass nodes
+
+    Replaces ``meanscale`` (``-mul``), ``highpass`` (``-bptf``) and
+    ``meanfunc3`` (``-Tmean``). Outputs are named as those of
+    ``fslmaths``: ``out_file`` for the filtered runs and ``mean_file`` for
+    the mean of the first one.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.tempfilt import TemporalFilter
+    >>> filt = TemporalFilter()
+    >>> filt.inputs.in_files = ['f3_mcf_mask.nii', 'f5_mcf_mask.nii']
+    >>> filt.inputs.median_values = [734.0, 712.5]
+    >>> filt.inputs.highpass_sigma = 128./(2*2.5)
+    >>> filt.inputs.num_threads = 8
+    >>> filt.run() # doctest: +SKIP
+    """
+
+    input_spec = TemporalFilterInputSpec
+    output_spec = TemporalFilterOutputSpec
+
+    def _run_interface(self, runtime):
+        self._out_files = []
+        self._mean_file = None
+        for idx, fname in enumerate(self.inputs.in_files):
+            scale = 1.
+            if isdefined(self.inputs.median_values):
+                scale = (self.inputs.intensity_scale /
+                         self.inputs.median_values[idx])
+            mean_file = None
+            if idx == 0:
+                mean_file = output_name(fname, '_gms_tempfilt_mean',
+                                        runtime.cwd)
+            outputs = temporal_filter(fname,
+                                      output_name(fname, '_gms_tempfilt',
+                                                  runtime.cwd),
+                                      self.inputs.highpass_sigma, scale,
+                                      self.inputs.add_intercept, mean_file,
+                                      self.inputs.num_threads,
+                                      self.inputs.block_size)
+            self._out_files.append(outputs[0])
+            if idx == 0:
+                self._mean_file = outputs[1]
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._out_files
+        outputs['mean_file'] = self._mean_file
+        return outputs
@@ -0,0 +1,216 @@
+"""
+Standard-space template bundle
+------------------------------
+
+Group workflows binarized the MNI152 brain with a new ``fs.Binarize`` node in
+every run, and the first-level workflow looked up the standard images and
+the FNIRT configuration in ``$FSLDIR`` when it was imported.
+
+:func:`template_bundle` builds, once per FSL installation, a directory with
+the binarized brain mask and downsampled versions of the templates, and
+returns the paths of all standard-space assets. Bundles are keyed on the
+checksums of the templates and the build parameters, so a bundle is rebuilt
+only when FSL's templates change. :class:`TemplateBundle` exposes the bundle
+as a workflow node, so that nothing is looked up when workflows are built.
+"""
+
+import hashlib
+import json
+import os                                    # system functions
+import shutil
+import tempfile
+
+import numpy as np
+
+import nibabel as nb
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, Directory, traits,
+                                    isdefined)
+
+
+default_cache_dir = os.path.join('~', '.mindflows', 'templates')
+
+
+def file_checksum(fname, blocksize=1024 * 1024):
+    """Return the sha1 checksum of a file
+    """
+    sha = hashlib.sha1()
+    fp = open(fname, 'rb')
+    try:
+        block = fp.read(blocksize)
+        while block:
+            sha.update(block)
+            block = fp.read(blocksize)
+    finally:
+        fp.close()
+    return sha.hexdigest()
+
+
+def downsample_image(img, factor):
+    """Downsample an image by averaging blocks of `factor` voxels
+
+    The voxel grid is padded with zeros to a multiple of `factor`; the
+    affine is adjusted so that the new voxels are centered on the blocks.
+    """
+    data = np.asarray(img.dataobj, dtype=np.float64)
+    pad = [(0, (-size) % factor) for size in data.shape[:3]]
+    data = np.pad(data, pad, mode='constant')
+    shape = [size // factor for size in data.shape]
+    data = data.reshape(shape[0], factor, shape[1], factor,
+                        shape[2], factor).mean(axis=(1, 3, 5))
+    affine = img.affine.copy()
+    affine[:3, 3] = np.dot(img.affine, [(factor - 1) / 2.] * 3 + [1])[:3]
+    affine[:3, :3] = img.affine[:3, :3] * factor
+    return data, affine
+
+
+def _save(data, affine, fname, dtype):
+    img = nb.Nifti1Image(np.asarray(data, dtype=dtype), affine)
+    img.set_qform(affine, 1)
+    img.set_sform(affine, 1)
+    img.to_filename(fname)
+    return fname
+
+
+def _build_bundle(outdir, assets, mask_min, factor):
+    """Write the derived images of a bundle to `outdir`
+    """
+    bundle = dict(assets)
+    brain = nb.load(assets['brain'])
+    mask = np.asarray(brain.dataobj) >= mask_min
+    bundle['brain_mask'] = _save(mask, brain.affine,
+                                 os.path.join(outdir, 'brain_mask.nii.gz'),
+                                 np.uint8)
+    for key in ['brain', 'head']:
+        data, affine = downsample_image(nb.load(assets[key]), factor)
+        bundle['%s_low' % key] = _save(data, affine,
+                                       os.path.join(outdir,
+                                                    '%s_low.nii.gz' % key),
+                                       np.float32)
+    data, affine = downsample_image(nb.Nifti1Image(mask.astype(np.float32),
+                                                   brain.affine), factor)
+    bundle['brain_mask_low'] = _save(data >= 0.5, affine,
+                                     os.path.join(outdir,
+                                                  'brain_mask_low.nii.gz'),
+                                     np.uint8)
+    return bundle
+
+
+def template_bundle(cache_dir=None, fsldir=None,
+                    brain='avg152T1_brain.nii.gz', head='avg152T1.nii.gz',
+                    fnirt_config='T1_2_MNI152_2mm.cnf', mask_min=10.,
+                    downsample_factor=2):
+    """Return the paths of the standard-space assets, building them once
+
+    Returns a dictionary with the template brain and head (``brain``,
+    ``head``), the brain binarized at `mask_min` (``brain_mask``, as
+    ``fs.Binarize(min=mask_min)``), their versions downsampled by
+    `downsample_factor` (``brain_low``, ``head_low``, ``brain_mask_low``)
+    and the FNIRT configuration (``fnirt_config``). The bundle is stored in
+    `cache_dir` (default ``~/.mindflows/templates``) under a key derived
+    from the checksums of the templates and the build parameters.
+    """
+    if fsldir is None:
+        fsldir = os.environ.get('FSLDIR')
+    if not fsldir:
+        raise RuntimeError('FSLDIR is not set; cannot locate the templates')
+    if cache_dir is None:
+        cache_dir = default_cache_dir
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    assets = dict(brain=os.path.join(fsldir, 'data', 'standard', brain),
+                  head=os.path.join(fsldir, 'data', 'standard', head),
+                  fnirt_config=os.path.join(fsldir, 'etc', 'flirtsch',
+                                            fnirt_config))
+    sha = hashlib.sha1()
+    for key in sorted(assets):
+        if os.path.exists(assets[key]):
+            sha.update(file_checksum(assets[key]).encode())
+        else:
+            sha.update(assets[key].encode())
+    sha.update(('%g %d' % (mask_min, downsample_factor)).encode())
+    bundle_dir = os.path.join(cache_dir, sha.hexdigest())
+    manifest = os.path.join(bundle_dir, 'bundle.json')
+    if not os.path.exists(manifest):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmpdir = tempfile.mkdtemp(prefix='.build', dir=cache_dir)
+        try:
+            bundle = _build_bundle(tmpdir, assets, mask_min,
+                                   downsample_factor)
+            bundle = dict([(key, val.replace(tmpdir, bundle_dir))
+                           for key, val in bundle.items()])
+            fp = open(os.path.join(tmpdir, 'bundle.json'), 'wt')
+            json.dump(bundle, fp, indent=1, sort_keys=True)
+            fp.close()
+            try:
+                os.rename(tmpdir, bundle_dir)
+            except OSError:
+                # another process built the same bundle first
+                pass
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+    fp = open(manifest)
+    bundle = json.load(fp)
+    fp.close()
+    return bundle
+
+
+class TemplateBundleInputSpec(BaseInterfaceInputSpec):
+    cache_dir = Directory(desc='where bundles are stored (default: '
+                          '~/.mindflows/templates)')
+    brain_template = traits.Str('avg152T1_brain.nii.gz', usedefault=True,
+                                desc='brain template in $FSLDIR/data/standard')
+    head_template = traits.Str('avg152T1.nii.gz', usedefault=True,
+                               desc='head template in $FSLDIR/data/standard')
+    fnirt_config = traits.Str('T1_2_MNI152_2mm.cnf', usedefault=True,
+                              desc='FNIRT config in $FSLDIR/etc/flirtsch')
+    mask_min = traits.Float(10., usedefault=True,
+                            desc='lowest brain intensity inside the mask')
+    downsample_factor = traits.Int(2, usedefault=True,
+                                   desc='downsampling factor of the low '
+                                   'resolution variants')
+
+
+class TemplateBundleOutputSpec(TraitedSpec):
+    brain = File(exists=True, desc='template brain')
+    head = File(exists=True, desc='template head')
+    brain_mask = File(exists=True, desc='binarized template brain')
+    brain_low = File(exists=True, desc='downsampled template brain')
+    head_low = File(exists=True, desc='downsampled template head')
+    brain_mask_low = File(exists=True, desc='downsampled brain mask')
+    fnirt_config = File(desc='FNIRT configuration file')
+
+
+class TemplateBundle(BaseInterface):
+    """Provide the standard-space assets of the cached template bundle
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.templates import TemplateBundle
+    >>> templates = TemplateBundle()
+    >>> templates.run() # doctest: +SKIP
+    """
+
+    input_spec = TemplateBundleInputSpec
+    output_spec = TemplateBundleOutputSpec
+
+    def _run_interface(self, runtime):
+        cache_dir = None
+        if isdefined(self.inputs.cache_dir):
+            cache_dir = self.inputs.cache_dir
+        self._bundle = template_bundle(cache_dir,
+                                       brain=self.inputs.brain_template,
+                                       head=self.inputs.head_template,
+                                       fnirt_config=self.inputs.fnirt_config,
+                                       mask_min=self.inputs.mask_min,
+                                       downsample_factor=self.inputs.downsample_factor)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for key in outputs:
+            outputs[key] = self._bundle[key]
+        return outputs
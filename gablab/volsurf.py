@@ -7,6 +7,11 @@ import nipype.algorithms.modelgen as model   # model generation
 import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
 
+from mindflows.gablab.artifact import ArtifactDetect
+from mindflows.gablab.catalog import CatalogDataSink
+from mindflows.gablab.resultstore import share_results
+from mindflows.gablab.surfproj import SurfaceSmooth
+
 
 """
 Setup preprocessing workflow
@@ -26,23 +31,25 @@ and register all images to the mean image.
 realign = pe.Node(interface=spm.Realign(), name="realign")
 realign.inputs.register_to_mean = True
 
-"""Use :class:`nipype.algorithms.rapidart` to determine which of the
-images in the functional series are outliers based on deviations in
+"""Use :class:`mindflows.gablab.artifact.ArtifactDetect` to determine which
+of the images in the functional series are outliers based on deviations in
 intensity or movement.
 """
 
-art = pe.Node(interface=ra.ArtifactDetect(), name="art")
+art = pe.Node(interface=ArtifactDetect(), name="art")
 #art.inputs.use_differences      = [False,True]
 #art.inputs.use_norm             = True
 #art.inputs.norm_threshold       = 0.5
 #art.inputs.zintensity_threshold = 3
 art.inputs.mask_type            = 'file'
+art.inputs.parameter_source     = 'SPM'
 
 
 #run FreeSurfer's BBRegister
 surfregister = pe.Node(interface=fs.BBRegister(),name='surfregister')
 surfregister.inputs.init = 'fsl'
 surfregister.inputs.contrast_type = 't2'
+share_results(surfregister)
 
 # Get information from the FreeSurfer directories (brainmask, etc)
 FreeSurferSource = pe.Node(interface=nio.FreeSurferSource(), name='fssource')
@@ -60,11 +67,13 @@ Threshold.inputs.min = 10
 convert2nii = pe.Node(interface=fs.MRIConvert(out_type='nii'),name='convert2nii')
 
 """Smooth the functional data using
-:class:`nipype.interfaces.spm.Smooth`.
+:class:`nipype.interfaces.spm.Smooth` and, on the surface,
+:class:`mindflows.gablab.surfproj.SurfaceSmooth`.
 """
 
 volsmooth = pe.Node(interface=spm.Smooth(), name = "volsmooth")
-surfsmooth = pe.MapNode(interface=fs.Smooth(proj_frac_avg=(0,1,0.1)), name = "surfsmooth",
+# the volume to surface projection is built once per subject and cached
+surfsmooth = pe.MapNode(interface=SurfaceSmooth(proj_frac_avg=(0,1,0.1)), name = "surfsmooth",
                         iterfield=['in_file'])
 
 preproc.connect([(realign, surfregister,[('mean_image', 'source_file')]),
@@ -145,6 +154,7 @@ convert2 = pe.MapNode(interface=fs.MRIConvert(in_type='nifti1',out_type='nii'),
                       iterfield=['in_file'],
                       name='convertnifti12nii')
 segment = pe.Node(interface=spm.Segment(), name='segment')
+share_results(segment)
 normwreg = pe.MapNode(interface=fs.ApplyVolTransform(),
                       iterfield=['source_file'],
                       name='applyreg2con')
@@ -167,7 +177,8 @@ inputnode = pe.Node(interface=util.IdentityInterface(fields=['struct',
                                                              'func',
                                                              'subject_id',
                                                              'session_info',
-                                                             'contrasts']),
+                                                             'contrasts',
+                                                             'outdir']),
                     name='inputnode')
 
 """
@@ -231,3 +242,19 @@ l1pipeline.connect([(preproc, volnorm, [('fssource.orig','convert2nii.in_file'),
                     (mergefiles, volnorm, [('out',
                                             'convertnifti12nii.in_file')]),
                   ])
+
+"""
+Store the contrast images and the registration of the subject under outdir
+and record them in the output catalog (outdir/catalog.sqlite) read by the
+level-2 surface flows
+"""
+
+datasink = pe.Node(interface=CatalogDataSink(), name='datasink')
+
+l1pipeline.connect([(inputnode, datasink, [('outdir', 'base_directory'),
+                                           ('subject_id', 'container')]),
+                    (volanalysis, datasink, [('contrastestimate.con_images',
+                                              'contrasts.@copes')]),
+                    (preproc, datasink, [('surfregister.out_reg_file',
+                                          'surfreg.@reg')]),
+                    ])
@@ -0,0 +1,174 @@
+"""
+Batched resampling to standard space
+------------------------------------
+
+``applynorm`` ran ``fsl.ApplyWarp`` and ``fsl.FLIRT`` as MapNodes, so every
+cope, varcope and parameter estimate reloaded the FNIRT coefficients,
+recomputed the same warp and was resampled by its own process.
+
+The registration chain (functional to structural matrix, structural to
+standard affine and FNIRT coefficients) is combined once per subject into a
+single dense displacement field by ``convertwarp``. :class:`BatchResample`
+converts that field, or a FLIRT matrix, into the sampling coordinates of
+every reference voxel once and resamples all images with these coordinates,
+with a single interpolation each and no intermediate files.
+
+Coordinates follow FSL's convention: millimetres along the voxel axes, with
+the x axis flipped for images stored in neurological order.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+
+import nibabel as nb
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits, isdefined)
+
+from mindflows.gablab.imageio import load_image, save_image, output_name
+
+
+def fsl_voxel_to_mm(img):
+    """Return the matrix mapping voxel indices to FSL's scaled mm coordinates
+    """
+    scale = np.diag(list(img.header.get_zooms()[:3]) + [1.])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = img.shape[0] - 1
+        scale = np.dot(scale, flip)
+    return scale
+
+
+def sampling_coordinates(in_img, ref_img, matrix=None, field_img=None,
+                         relative=True):
+    """Return the voxel coordinates in `in_img` of every voxel of `ref_img`
+
+    The mapping is either a FLIRT `matrix` (from `in_img` to `ref_img`) or a
+    warp field `field_img` defined on the grid of `ref_img` that holds, in
+    mm, the position in `in_img` of each reference voxel (`relative` False)
+    or its displacement from the reference position (`relative` True). The
+    coordinates are returned as an array of shape ``(3,) + ref_img.shape``.
+    """
+    shape = ref_img.shape[:3]
+    ref_vox = np.indices(shape, dtype=np.float64).reshape(3, -1)
+    ref_mm = np.dot(fsl_voxel_to_mm(ref_img)[:3],
+                    np.vstack((ref_vox, np.ones((1, ref_vox.shape[1])))))
+    if field_img is not None:
+        field = np.asarray(field_img.dataobj, dtype=np.float64)
+        in_mm = field.reshape((-1, 3)).T
+        if relative:
+            in_mm = in_mm + ref_mm
+    else:
+        in_mm = np.dot(np.linalg.inv(matrix),
+                       np.vstack((ref_mm, np.ones((1, ref_mm.shape[1])))))[:3]
+    mm_to_vox = np.linalg.inv(fsl_voxel_to_mm(in_img))
+    coords = np.dot(mm_to_vox[:3, :3], in_mm) + mm_to_vox[:3, 3:]
+    return coords.reshape((3,) + shape)
+
+
+def resample_image(in_file, ref_img, coords, out_file, order=1):
+    """Resample every volume of an image at the given voxel coordinates
+    """
+    img, data = load_image(in_file)
+    if data.ndim == 3:
+        out = ndimage.map_coordinates(np.asarray(data, dtype=np.float32),
+                                      coords, order=order, mode='constant',
+                                      cval=0., prefilter=False)
+    else:
+        out = np.zeros(coords.shape[1:] + data.shape[3:], dtype=np.float32)
+        for idx in np.ndindex(*data.shape[3:]):
+            volume = np.asarray(data[(Ellipsis,) + idx], dtype=np.float32)
+            out[(Ellipsis,) + idx] = ndimage.map_coordinates(
+                volume, coords, order=order, mode='constant', cval=0.,
+                prefilter=False)
+    return save_image(out, ref_img, out_file, np.float32)
+
+
+class BatchResampleInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='images to resample; they must share '
+                              'one voxel grid')
+    reference = File(exists=True, mandatory=True,
+                     desc='image defining the output grid')
+    field_file = File(exists=True, xor=['in_matrix_file'],
+                      desc='dense warp field on the reference grid, e.g. '
+                      'from convertwarp')
+    relative_warp = traits.Bool(True, usedefault=True,
+                                desc='field holds displacements rather than '
+                                'positions')
+    in_matrix_file = File(exists=True, xor=['field_file'],
+                          desc='FLIRT matrix from the inputs to the reference')
+    interp = traits.Enum('trilinear', 'nn', usedefault=True,
+                         desc='interpolation method')
+    suffix = traits.Str('_warp', usedefault=True,
+                        desc='suffix of the output filenames')
+    num_threads = traits.Int(4, usedefault=True, nohash=True,
+                             desc='number of images resampled concurrently')
+
+
+class BatchResampleOutputSpec(TraitedSpec):
+    out_files = OutputMultiPath(File(exists=True), desc='resampled images')
+
+
+class BatchResample(BaseInterface):
+    """Resample a batch of images to a reference through one warp or matrix
+
+    Replaces ``fsl.ApplyWarp`` and ``fsl.FLIRT(apply_xfm=True)`` MapNodes:
+    the sampling coordinates are computed once for all images.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.warp import BatchResample
+    >>> warpfunc = BatchResample(field_file='T1_warp.nii.gz')
+    >>> warpfunc.inputs.reference = 'avg152T1.nii.gz'
+    >>> warpfunc.inputs.in_files = ['cope1.nii.gz', 'varcope1.nii.gz']
+    >>> warpfunc.run() # doctest: +SKIP
+    """
+
+    input_spec = BatchResampleInputSpec
+    output_spec = BatchResampleOutputSpec
+
+    def _run_interface(self, runtime):
+        ref_img = nb.load(self.inputs.reference)
+        in_img = nb.load(self.inputs.in_files[0])
+        if isdefined(self.inputs.field_file):
+            coords = sampling_coordinates(
+                in_img, ref_img, field_img=nb.load(self.inputs.field_file),
+                relative=self.inputs.relative_warp)
+        elif isdefined(self.inputs.in_matrix_file):
+            coords = sampling_coordinates(
+                in_img, ref_img, matrix=np.loadtxt(self.inputs.in_matrix_file))
+        else:
+            raise ValueError('BatchResample needs field_file or '
+                             'in_matrix_file')
+        order = {'trilinear': 1, 'nn': 0}[self.inputs.interp]
+        out_files = [output_name(fname, self.inputs.suffix,
+                                 newpath=runtime.cwd)
+                     for fname in self.inputs.in_files]
+        if len(set(out_files)) < len(out_files):
+            # inputs from different directories share names (e.g. the
+            # copes of each run): number the outputs
+            out_files = [output_name(fname, '%s%03d' % (self.inputs.suffix,
+                                                        idx),
+                                     newpath=runtime.cwd)
+                         for idx, fname in enumerate(self.inputs.in_files)]
+        pool = ThreadPoolExecutor(max(1, self.inputs.num_threads))
+        try:
+            jobs = [pool.submit(resample_image, in_file, ref_img, coords,
+                                out_file, order)
+                    for in_file, out_file in zip(self.inputs.in_files,
+                                                 out_files)]
+            self._out_files = [job.result() for job in jobs]
+        finally:
+            pool.shutdown()
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_files'] = self._out_files
+        return outputs
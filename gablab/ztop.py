@@ -0,0 +1,125 @@
+"""
+Z to p conversion
+-----------------
+
+``ztop`` MapNodes started one ``fslmaths -ztop`` process per z statistic
+image, which costs more in process startup and compression than in
+computation. :class:`ZtoP` converts a whole list of z statistic images to p
+values in-process with a vectorized normal survival function, reading each
+image through a memory map, and optionally writes masks of the voxels
+surviving an uncorrected p threshold or a false discovery rate threshold in
+the same pass.
+"""
+
+import numpy as np
+from scipy.special import ndtr
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, InputMultiPath,
+                                    OutputMultiPath, traits, isdefined)
+
+from mindflows.gablab.imageio import load_image, save_image, output_name
+
+
+def z_to_p(zstat):
+    """Return the one-sided (upper tail) p value of z statistics, as
+    ``fslmaths -ztop``
+    """
+    return ndtr(-np.asarray(zstat, dtype=np.float64))
+
+
+def fdr_threshold(pvals, q):
+    """Return the largest p value significant at false discovery rate `q`
+    (Benjamini-Hochberg), or 0 if none is
+
+    >>> fdr_threshold(np.array([0.001, 0.01, 0.03, 0.5]), 0.05)
+    0.03
+    """
+    pvals = np.sort(np.ravel(pvals))
+    if not pvals.size:
+        return 0.
+    below = pvals <= q * np.arange(1, pvals.size + 1) / float(pvals.size)
+    if not np.any(below):
+        return 0.
+    return float(pvals[np.nonzero(below)[0][-1]])
+
+
+class ZtoPInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='z statistic images')
+    mask_file = File(exists=True,
+                     desc='voxels to threshold (default: nonzero voxels)')
+    p_threshold = traits.Float(desc='write masks of the voxels with '
+                               'uncorrected p below this value')
+    fdr_q = traits.Float(desc='write masks of the voxels surviving this '
+                         'false discovery rate')
+    suffix = traits.Str('_pval', usedefault=True,
+                        desc='suffix of the p value images')
+
+
+class ZtoPOutputSpec(TraitedSpec):
+    out_file = OutputMultiPath(File(exists=True), desc='p value images')
+    thresh_files = OutputMultiPath(File(exists=True),
+                                   desc='masks of voxels below p_threshold')
+    fdr_files = OutputMultiPath(File(exists=True),
+                                desc='masks of voxels surviving fdr_q')
+    fdr_thresholds = traits.List(traits.Float,
+                                 desc='p value threshold of each image at '
+                                 'fdr_q (0 if no voxel survives)')
+
+
+class ZtoP(BaseInterface):
+    """Convert z statistic images to p values and threshold them
+
+    Replaces a ``fsl.ImageMaths(op_string='-ztop')`` MapNode; the p value
+    images are named as those of ``fslmaths``.
+
+    Example
+    -------
+
+    >>> from mindflows.gablab.ztop import ZtoP
+    >>> ztop = ZtoP(fdr_q=0.05)
+    >>> ztop.inputs.in_files = ['zstat1.nii', 'zstat2.nii']
+    >>> ztop.run() # doctest: +SKIP
+    """
+
+    input_spec = ZtoPInputSpec
+    output_spec = ZtoPOutputSpec
+
+    def _run_interface(self, runtime):
+        mask = None
+        if isdefined(self.inputs.mask_file):
+            mask = np.asarray(load_image(self.inputs.mask_file)[1]) > 0
+        self._results = dict(out_file=[], thresh_files=[], fdr_files=[],
+                             fdr_thresholds=[])
+        for fname in self.inputs.in_files:
+            img, zstat = load_image(fname)
+            zstat = np.asarray(zstat)
+            pvals = z_to_p(zstat)
+            self._results['out_file'].append(
+                save_image(pvals, img, output_name(fname, self.inputs.suffix,
+                                                   newpath=runtime.cwd),
+                           np.float32))
+            voxels = mask if mask is not None else zstat != 0
+            if isdefined(self.inputs.p_threshold):
+                self._results['thresh_files'].append(
+                    save_image(voxels & (pvals < self.inputs.p_threshold),
+                               img, output_name(fname, '_thresh',
+                                                newpath=runtime.cwd),
+                               np.uint8))
+            if isdefined(self.inputs.fdr_q):
+                thresh = fdr_threshold(pvals[voxels], self.inputs.fdr_q)
+                self._results['fdr_thresholds'].append(thresh)
+                self._results['fdr_files'].append(
+                    save_image(voxels & (pvals <= thresh) & (thresh > 0),
+                               img, output_name(fname, '_fdr',
+                                                newpath=runtime.cwd),
+                               np.uint8))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        for key in outputs:
+            if self._results[key]:
+                outputs[key] = self._results[key]
+        return outputs
@@ -6,18 +6,29 @@ import nipype.algorithms.modelgen as model   # model generation
 import nipype.algorithms.rapidart as ra      # artifact detection
 import nipype.interfaces.freesurfer as fs    # freesurfer
 import nipype.interfaces.io as nio           # i/o routines
-import nipype.interfaces.fsl as fsl          # fsl
 import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
 
 from nibabel import load
 
+from mindflows.gablab.fixedfx import FixedEffects
+from mindflows.gablab.imageio import set_storage_policy
+from mindflows.gablab.ztop import ZtoP
+
 """
 Setup any package specific configuration. The output file format for FSL
-routines is being set to compressed NIFTI.
+routines is being set to uncompressed NIFTI, which downstream nodes can
+memory-map. Only outputs stored by a datasink are compressed.
+
+Note that this changes the default for every FSL interface in the process,
+not only for the workflows defined here: once this module is imported, a
+plain ``nio.DataSink`` elsewhere stores uncompressed images. Use
+:class:`~mindflows.gablab.imageio.CompressingDataSink`, or call
+``set_storage_policy(compress_intermediates=True)`` after the import to
+restore compressed outputs.
 """
 
-fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+set_storage_policy()
 
 from mindflows.gablab.fsl_flow import (preproc, modelfit, overlay,
                                        normalize, applynorm)
@@ -31,60 +42,19 @@ Set up fixed-effects workflow
 
 fixed_fx = pe.Workflow(name='fixedfx')
 
-selectnode = pe.Node(interface=util.IdentityInterface(fields=['runs','funcdata']),
-                    name='idselect')
-
-selectnode.iterables = ('runs', [[0,1],[0,2],[0,3],[1,2],[1,3],[2,3],[0,1,2],
-                                 [0,2,3],[0,1,3],[1,2,3],[0,1,2,3]])
-
-copeselect = pe.MapNode(interface=util.Select(), name='copeselect',
-                        iterfield=['inlist'])
-varcopeselect = pe.MapNode(interface=util.Select(), name='varcopeselect',
-                           iterfield=['inlist'])
-
-# Use :class:`nipype.interfaces.fsl.Merge` to merge the copes and
-# varcopes for each condition
-copemerge    = pe.MapNode(interface=fsl.Merge(dimension='t'),
-                       iterfield=['in_files'],
-                       name="copemerge")
-
-varcopemerge = pe.MapNode(interface=fsl.Merge(dimension='t'),
-                       iterfield=['in_files'],
-                       name="varcopemerge")
-
-# Use :class:`nipype.interfaces.fsl.L2Model` to generate subject and
-# condition specific level 2 model design files
-level2model = pe.Node(interface=fsl.L2Model(),
-                      name='l2model')
-
-def num_copes(files):
-    return len(files)
-
 """
-Use :class:`nipype.interfaces.fsl.FLAMEO` to estimate a second level
-model
+Use :class:`mindflows.gablab.fixedfx.FixedEffects` to combine the runs of
+every subset of at least two runs in closed form, reading the per-run copes
+and varcopes once
 """
 
-flameo = pe.MapNode(interface=fsl.FLAMEO(run_mode='fe'), name="flameo",
-                    iterfield=['cope_file','var_cope_file'])
-
-ztopval = pe.MapNode(interface=fsl.ImageMaths(op_string='-ztop',
-                                              suffix='_pval'),name='ztop',
-                     iterfield=['in_file'])
-                     
-fixed_fx.connect([(selectnode,copeselect,[('runs','index')]),
-                  (selectnode,varcopeselect,[('runs','index')]),
-                  (selectnode,level2model,[(('runs', num_copes),'num_copes')]),
-                  (copeselect,copemerge,[('out','in_files')]),
-                  (varcopeselect,varcopemerge,[('out','in_files')]),
-                  (varcopeselect,varcopemerge,[('out','in_files')]),
-                  (copemerge,flameo,[('merged_file','cope_file')]),
-                  (varcopemerge,flameo,[('merged_file','var_cope_file')]),
-                  (level2model,flameo, [('design_mat','design_file'),
-                                        ('design_con','t_con_file'),
-                                        ('design_grp','cov_split_file')]),
-                  (flameo,ztopval, [('zstats','in_file')]),
-                  ])
+fixedeffects = pe.Node(interface=FixedEffects(subsets='all', min_runs=2),
+                       name='fixedeffects', mem_gb=2)
+
+# Convert the z statistics of all subsets to p values in one process
+ztopval = pe.Node(interface=ZtoP(), name='ztop')
+
+fixed_fx.connect(fixedeffects, 'zstats', ztopval, 'in_files')
 
 
 """
@@ -145,21 +115,17 @@ l1pipeline.connect([(inputnode,preproc,[('func','inputspec.func'),
                                          ('realign.par_file',
                                           'modelspec.realignment_parameters'),
                                          ('art.outlier_files', 'modelspec.outlier_files')]),
-                    # force idselect to get executed after smoothing.
-                    (preproc, fixed_fx, [('dilatemask.out_file', 'flameo.mask_file'),
-                                         ('highpass.out_file','idselect.funcdata')]),
-                    (modelfit, fixed_fx,[(('conestimate.copes', sort_copes),'copeselect.inlist'),
-                                         (('conestimate.varcopes', sort_copes),'varcopeselect.inlist'),
+                    (preproc, fixed_fx, [('tempstats.mask_file', 'fixedeffects.mask_file')]),
+                    (modelfit, fixed_fx,[(('conestimate.copes', sort_copes),'fixedeffects.copes'),
+                                         (('conestimate.varcopes', sort_copes),'fixedeffects.varcopes'),
                                          ]),
-                    (normalize, applynorm, [("fnirt.fieldcoeff_file", "warpfunc.field_file"),
+                    (normalize, applynorm, [("fnirt.fieldcoeff_file", "convertwarp.warp1"),
                                             ("matconcat.out_file", "funcxfm.in_matrix_file")]),
-                    (preproc, applynorm, [("surfregister.out_fsl_file", "warpfunc.premat")]),
-                    (fixed_fx, applynorm, [(("flameo.copes", lambda x:x[0]),
-                                             "warpfunc.in_file"),
-                                           (("flameo.copes", lambda x:x[0]),
-                                             "funcxfm.in_file")]),
+                    (preproc, applynorm, [("surfregister.out_fsl_file", "convertwarp.premat")]),
+                    (fixed_fx, applynorm, [("fixedeffects.copes", "warpfunc.in_files"),
+                                           ("fixedeffects.copes", "funcxfm.in_files")]),
                     (preproc, overlay, [('convert2nii.out_file',
-                                         'overlaystats.background_image')]),
-                    (fixed_fx, overlay, [('flameo.zstats','overlaystats.stat_image')]),
+                                         'statreport.background_image')]),
+                    (fixed_fx, overlay, [('fixedeffects.zstats','statreport.stat_images')]),
                     ])
 